@@ -0,0 +1,96 @@
+"""Times benchmarks, and stores and compares their results across runs."""
+import datetime
+import json
+import platform
+import statistics
+import time
+
+# Define how much slower than its baseline (as a fraction of the baseline) a benchmark must be to count as a regression.
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+
+DEFAULT_NUM_REPEATS = 3
+
+
+def time_function(func, num_repeats=DEFAULT_NUM_REPEATS):
+    """Calls `func` `num_repeats` times, returning the duration of each call in seconds."""
+    durations = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def summarize_durations(durations, **attributes):
+    """Summarizes the durations of a benchmark, with `attributes` such as the shape of its input."""
+    return {
+        "median_seconds": statistics.median(durations),
+        "min_seconds": min(durations),
+        "num_repeats": len(durations),
+        **attributes,
+    }
+
+
+def save_results(results_by_name, path):
+    """Saves the results of each benchmark (by name) to a JSON file at `path`, along with where they were run."""
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "created_at": datetime.datetime.now().isoformat(),
+                "python_version": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results_by_name,
+            },
+            file,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def compare_results(
+    results_by_name, baseline_results_by_name, threshold=DEFAULT_REGRESSION_THRESHOLD
+):
+    """Compares the median duration of each benchmark to its baseline.
+
+    Returns a list of `(name, median seconds, baseline median seconds, ratio, is regression)` tuples, for the
+    benchmarks that are in both results.
+    """
+    comparisons = []
+    for name, result in results_by_name.items():
+        baseline_result = baseline_results_by_name.get(name)
+        if baseline_result is None:
+            continue
+
+        ratio = result["median_seconds"] / baseline_result["median_seconds"]
+        comparisons.append(
+            (
+                name,
+                result["median_seconds"],
+                baseline_result["median_seconds"],
+                ratio,
+                ratio > 1 + threshold,
+            )
+        )
+
+    return comparisons
+
+
+def print_comparisons(comparisons):
+    print(f"{'Benchmark':<60} {'Median':>9} {'Baseline':>9} {'Ratio':>6}")
+    for (
+        name,
+        median_seconds,
+        baseline_median_seconds,
+        ratio,
+        is_regression,
+    ) in comparisons:
+        print(
+            f"{name:<60} {median_seconds:8.3f}s {baseline_median_seconds:8.3f}s {ratio:6.2f}"
+            + (" REGRESSION" if is_regression else "")
+        )
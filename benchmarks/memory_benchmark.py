@@ -0,0 +1,137 @@
+"""Measures the peak memory of the covidtracking transform on synthetic data, and the memory of the frame it returns.
+
+Each measurement runs in a fresh interpreter, so that its peak resident set size (RSS) only covers that run. Run from
+the repository root, e.g. to also measure storing the smoothed fields as `float32` at the county scale:
+
+    $ python -m benchmarks.memory_benchmark --scales medium county --output memory.json
+
+Peak RSS is read with the `resource` module, which is only available on Unix.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+from benchmarks.benchmark_utils import save_results
+from benchmarks.synthetic_data import generate_county_population_df
+from benchmarks.synthetic_data import generate_covidtracking_df
+from benchmarks.transform_benchmark import DEFAULT_SCALES
+from benchmarks.transform_benchmark import SCALES
+from covid.extract import GEOGRAPHY_LEVEL_COUNTY
+from covid.extract import get_state_abbreviations_to_names
+from covid.transform import transform_covidtracking_data
+from covid.transform_utils import SPLINE_BACKEND_NATIVE
+
+# Define the root of the repository, from which the benchmark is imported by each fresh interpreter.
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Define the keyword arguments of the transform in each scenario.
+SCENARIOS = {
+    "default": {},
+    "smoothed_float32": {"smoothed_float32": True},
+}
+
+BYTES_PER_MB = 2 ** 20
+
+
+def get_peak_rss_bytes():
+    """Returns the peak RSS of this process so far, which Linux reports in kilobytes and macOS in bytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def measure_transform(scale, scenario):
+    """Transforms synthetic data at a scale in a scenario, returning the peak RSS it took and the frame's memory.
+
+    This should run in a fresh interpreter (see `measure_transform_in_fresh_interpreter`), since the peak RSS of a
+    process never goes down.
+    """
+    num_states, num_days = SCALES[scale]
+    kwargs = dict(SCENARIOS[scenario])
+    if scale == "county":
+        covidtracking_df = generate_covidtracking_df(
+            num_states=num_states,
+            num_days=num_days,
+            geography_level=GEOGRAPHY_LEVEL_COUNTY,
+        )
+        kwargs["geography_level"] = GEOGRAPHY_LEVEL_COUNTY
+        kwargs["population_data"] = generate_county_population_df(
+            num_counties=num_states
+        )
+    else:
+        # The transforms need real states (which have a population).
+        num_states = min(num_states, len(get_state_abbreviations_to_names()))
+        covidtracking_df = generate_covidtracking_df(
+            num_states=num_states, num_days=num_days
+        )
+
+    input_peak_rss_bytes = get_peak_rss_bytes()
+    transformed_df = transform_covidtracking_data(
+        covidtracking_df=covidtracking_df,
+        spline_backend=SPLINE_BACKEND_NATIVE,
+        **kwargs,
+    )
+    peak_rss_bytes = get_peak_rss_bytes()
+
+    return {
+        "num_states": num_states,
+        "num_days": num_days,
+        "peak_rss_bytes": peak_rss_bytes,
+        "transform_peak_rss_bytes": peak_rss_bytes - input_peak_rss_bytes,
+        "frame_bytes": int(transformed_df.memory_usage(deep=True).sum()),
+        "frame_shape": list(transformed_df.shape),
+    }
+
+
+def measure_transform_in_fresh_interpreter(scale, scenario):
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json; from benchmarks.memory_benchmark import measure_transform; "
+            f"print(json.dumps(measure_transform({scale!r}, {scenario!r})))",
+        ],
+        cwd=REPOSITORY_DIRECTORY,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--scales", nargs="+", choices=sorted(SCALES), default=DEFAULT_SCALES
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS)
+    )
+    parser.add_argument("--output", help="path to save the results to, as JSON")
+    args = parser.parse_args()
+
+    print(f"{'Benchmark':<60} {'Peak RSS':>10} {'Transform':>10} {'Frame':>10}")
+    results_by_name = {}
+    for scale in args.scales:
+        for scenario in args.scenarios:
+            name = f"transform_covidtracking_data[{scale}][{scenario}]"
+            result = measure_transform_in_fresh_interpreter(
+                scale=scale, scenario=scenario
+            )
+            results_by_name[name] = result
+            print(
+                f"{name:<60} {result['peak_rss_bytes'] / BYTES_PER_MB:8.0f}MB "
+                f"{result['transform_peak_rss_bytes'] / BYTES_PER_MB:8.0f}MB "
+                f"{result['frame_bytes'] / BYTES_PER_MB:8.1f}MB"
+            )
+
+    if args.output is not None:
+        save_results(results_by_name=results_by_name, path=args.output)
+
+
+if __name__ == "__main__":
+    main()
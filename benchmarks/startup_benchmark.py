@@ -0,0 +1,106 @@
+"""Measures how long it takes to start the ETL, with heavy dependencies imported lazily (as they are) or eagerly.
+
+Run from the repository root with `python -m benchmarks.startup_benchmark`.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Define the root of the repository, from which `main` is imported.
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Define the dependencies that are only imported once they are used: R (on the first R spline fit), the Google
+# client libraries (on the first upload to Google Sheets) and `df2gspread` (by the CDC beds extract).
+LAZY_IMPORTS = [
+    "rpy2.robjects",
+    "gspread",
+    "oauth2client.service_account",
+    "df2gspread.gspread2df",
+]
+
+# Define the code run by each scenario, in a fresh interpreter.
+SCENARIOS = {
+    "lazy": "import main",
+    "eager": "; ".join(
+        ["import main"] + [f"import {module}" for module in LAZY_IMPORTS]
+    ),
+}
+
+DEFAULT_NUM_REPEATS = 5
+DEFAULT_NUM_SLOWEST_MODULES = 10
+
+
+def time_startup(code, num_repeats=DEFAULT_NUM_REPEATS):
+    """Runs `code` in `num_repeats` fresh interpreters, returning the wall time of each run in seconds."""
+    durations = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code], cwd=REPOSITORY_DIRECTORY, check=True
+        )
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def get_slowest_imports(code, num_modules=DEFAULT_NUM_SLOWEST_MODULES):
+    """Returns the modules imported by `code` that took longest to import (including their own imports).
+
+    Returns a list of (module, cumulative seconds) tuples, as reported by `python -X importtime`.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPOSITORY_DIRECTORY,
+        check=True,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    cumulative_seconds_by_module = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_microseconds, module = line[len("import time:") :].split("|")
+        cumulative_seconds_by_module[module.strip()] = (
+            int(cumulative_microseconds) / 1e6
+        )
+
+    return sorted(
+        cumulative_seconds_by_module.items(), key=lambda item: item[1], reverse=True
+    )[:num_modules]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-repeats", type=int, default=DEFAULT_NUM_REPEATS)
+    args = parser.parse_args()
+
+    median_seconds_by_scenario = {}
+    for scenario, code in SCENARIOS.items():
+        try:
+            durations = time_startup(code=code, num_repeats=args.num_repeats)
+        except subprocess.CalledProcessError:
+            print(f"Skipping the {scenario} scenario, which failed to run: {code}")
+            continue
+        median_seconds_by_scenario[scenario] = statistics.median(durations)
+        print(
+            f"{scenario:<8} median {statistics.median(durations):.3f}s, "
+            f"min {min(durations):.3f}s over {len(durations)} runs"
+        )
+
+    if len(median_seconds_by_scenario) == len(SCENARIOS):
+        print(
+            f"Lazy imports save {median_seconds_by_scenario['eager'] - median_seconds_by_scenario['lazy']:.3f}s "
+            "at startup."
+        )
+
+    print("Slowest imports at startup:")
+    for module, cumulative_seconds in get_slowest_imports(code=SCENARIOS["lazy"]):
+        print(f"  {module:<50} {cumulative_seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
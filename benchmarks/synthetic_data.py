@@ -0,0 +1,176 @@
+"""Generates synthetic extracts, shaped like the real ones, to benchmark the transforms at any scale."""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from covid.extract import COUNTY_FIPS_SOURCE_FIELD
+from covid.extract import DATE_SOURCE_FIELD
+from covid.extract import GEOGRAPHY_LEVEL_COUNTY
+from covid.extract import GEOGRAPHY_LEVEL_STATE
+from covid.extract import get_state_abbreviations_to_names
+from covid.extract import NEW_CASES_NEGATIVE_SOURCE_FIELD
+from covid.extract import NEW_CASES_POSITIVE_SOURCE_FIELD
+from covid.extract import STATE_FIELD
+from covid.extract import STATE_SOURCE_FIELD
+from covid.extract import TOTAL_CASES_SOURCE_FIELD
+
+# Define the first date of the synthetic data.
+DEFAULT_START_DATE = datetime.date(2020, 3, 1)
+
+# Define the range of daily tests per new case, and of the percent of ILI visits.
+MIN_TESTS_PER_CASE = 8
+MAX_TESTS_PER_CASE = 25
+MIN_PERCENT_ILI = 0.5
+MAX_PERCENT_ILI = 4.0
+
+
+def get_entity_abbreviations_and_names(num_entities):
+    """Returns the abbreviations and names of `num_entities` states, followed by synthetic ones if there are too few.
+
+    Only real states have a population (in `covid/data/population.csv`), which the covidtracking transform needs.
+    """
+    names_by_abbreviation = get_state_abbreviations_to_names()
+    abbreviations = sorted(names_by_abbreviation)[:num_entities]
+    names = [names_by_abbreviation[abbreviation] for abbreviation in abbreviations]
+    for index in range(len(abbreviations), num_entities):
+        abbreviations.append(f"S{index}")
+        names.append(f"Synthetic State {index}")
+
+    return abbreviations, names
+
+
+def generate_epidemic_curves(num_entities, num_days, seed=0):
+    """Generates expected daily new cases, as a `num_entities` x `num_days` array of one or two waves per entity."""
+    random_state = np.random.RandomState(seed)
+    days = np.arange(num_days)
+
+    curves = np.zeros(shape=(num_entities, num_days))
+    for _ in range(2):
+        peak_days = random_state.uniform(0, num_days, size=(num_entities, 1))
+        widths = random_state.uniform(10, 40, size=(num_entities, 1))
+        heights = random_state.lognormal(mean=6, sigma=1, size=(num_entities, 1))
+        curves += heights * np.exp(-(((days - peak_days) / widths) ** 2))
+
+    # Keep a floor of cases, so that no entity goes without any.
+    return curves + random_state.uniform(1, 20, size=(num_entities, 1))
+
+
+def get_county_fips_codes(num_counties):
+    """Returns `num_counties` synthetic 5-digit county FIPS codes, with up to 100 counties per state."""
+    return [
+        f"{index // 100 + 1:02d}{index % 100 * 2 + 1:03d}"
+        for index in range(num_counties)
+    ]
+
+
+def generate_county_population_df(num_counties, seed=0):
+    """Generates county populations shaped like `extract_county_population_data`, from 1,000 to about 10 million."""
+    populations = np.round(
+        np.random.RandomState(seed).lognormal(mean=10.3, sigma=1.4, size=num_counties)
+    ).clip(1000, 1e7)
+
+    return pd.DataFrame(
+        data={"population": populations},
+        index=pd.Index(
+            get_county_fips_codes(num_counties=num_counties),
+            name=COUNTY_FIPS_SOURCE_FIELD,
+        ),
+    )
+
+
+def generate_covidtracking_df(
+    num_states,
+    num_days,
+    start_date=DEFAULT_START_DATE,
+    seed=0,
+    geography_level=GEOGRAPHY_LEVEL_STATE,
+):
+    """Generates a daily history shaped like `extract_covidtracking_historical_data`, with states and days in the order
+    covidtracking.com returns them (latest day first).
+
+    At `GEOGRAPHY_LEVEL_COUNTY`, `num_states` counties are identified by FIPS code (see `get_county_fips_codes`).
+    """
+    random_state = np.random.RandomState(seed)
+    if geography_level == GEOGRAPHY_LEVEL_COUNTY:
+        entity_field = COUNTY_FIPS_SOURCE_FIELD
+        abbreviations = get_county_fips_codes(num_counties=num_states)
+    else:
+        entity_field = STATE_SOURCE_FIELD
+        abbreviations, _ = get_entity_abbreviations_and_names(num_entities=num_states)
+    dates = pd.date_range(start=start_date, periods=num_days, freq="D")
+
+    new_cases = random_state.poisson(
+        generate_epidemic_curves(num_entities=num_states, num_days=num_days, seed=seed)
+    ).astype(float)
+    tests_per_case = random_state.uniform(
+        MIN_TESTS_PER_CASE, MAX_TESTS_PER_CASE, size=new_cases.shape
+    )
+    new_negatives = np.round(new_cases * tests_per_case)
+
+    df = pd.DataFrame(
+        data={
+            entity_field: np.repeat(abbreviations, num_days),
+            DATE_SOURCE_FIELD: np.tile(dates.strftime("%Y%m%d"), num_states),
+            TOTAL_CASES_SOURCE_FIELD: np.cumsum(new_cases, axis=1).ravel(),
+            NEW_CASES_POSITIVE_SOURCE_FIELD: new_cases.ravel(),
+            NEW_CASES_NEGATIVE_SOURCE_FIELD: new_negatives.ravel(),
+        }
+    )
+
+    return df.sort_values(
+        by=[DATE_SOURCE_FIELD, entity_field], ascending=[False, True]
+    ).reset_index(drop=True)
+
+
+def generate_cdc_ili_df(num_states, num_weeks, start_date=DEFAULT_START_DATE, seed=0):
+    """Generates weekly ILINet data shaped like `extract_cdc_ili_data`, with values as strings."""
+    random_state = np.random.RandomState(seed)
+    _, names = get_entity_abbreviations_and_names(num_entities=num_states)
+
+    # Weeks start on Sundays, and are numbered from 1 as in the CDC's data.
+    week_starts = pd.date_range(start=start_date, periods=num_weeks, freq="W-SUN")
+    week_numbers = week_starts.strftime("%U").astype(int) + 1
+
+    # Follow a seasonal curve, peaking in winter.
+    seasonality = (
+        np.cos(2 * np.pi * (week_starts.dayofyear.values - 30) / 365) + 1
+    ) / 2
+    percent_ili = MIN_PERCENT_ILI + (MAX_PERCENT_ILI - MIN_PERCENT_ILI) * (
+        seasonality * random_state.uniform(0.5, 1, size=(num_states, 1))
+    )
+    percent_ili = np.clip(
+        percent_ili + random_state.normal(scale=0.1, size=percent_ili.shape),
+        0,
+        None,
+    )
+    num_patients = random_state.randint(2000, 60000, size=(num_states, 1))
+    total_ili = np.round(percent_ili / 100 * num_patients).astype(int)
+
+    return pd.DataFrame(
+        data={
+            "REGION TYPE": "States",
+            "REGION": np.repeat(names, num_weeks),
+            "YEAR": np.tile(week_starts.year, num_states),
+            "WEEK": np.tile(week_numbers, num_states),
+            "%UNWEIGHTED ILI": np.round(percent_ili, 5).ravel().astype(str),
+            "ILITOTAL": total_ili.ravel().astype(str),
+        }
+    )
+
+
+def generate_state_date_series(num_states, num_days, seed=0):
+    """Generates daily new cases for each state, as a series indexed by (state, date) in sorted order."""
+    _, names = get_entity_abbreviations_and_names(num_entities=num_states)
+    names = sorted(names)
+    dates = pd.date_range(start=DEFAULT_START_DATE, periods=num_days, freq="D")
+    new_cases = np.random.RandomState(seed).poisson(
+        generate_epidemic_curves(num_entities=num_states, num_days=num_days, seed=seed)
+    )
+
+    return pd.Series(
+        data=new_cases.ravel().astype(float),
+        index=pd.MultiIndex.from_product(
+            [names, dates], names=[STATE_FIELD, DATE_SOURCE_FIELD]
+        ),
+    )
@@ -0,0 +1,233 @@
+"""Benchmarks the transforms and their utilities on synthetic data at several scales.
+
+Run from the repository root, e.g. to save a baseline and then compare a later run to it:
+
+    $ python -m benchmarks.transform_benchmark --output baseline.json
+    $ python -m benchmarks.transform_benchmark --output results.json --baseline baseline.json
+
+The comparison exits with status 1 if any benchmark got slower than its baseline by more than the threshold.
+"""
+import argparse
+import functools
+import sys
+
+import numpy as np
+
+from benchmarks.benchmark_utils import compare_results
+from benchmarks.benchmark_utils import DEFAULT_NUM_REPEATS
+from benchmarks.benchmark_utils import DEFAULT_REGRESSION_THRESHOLD
+from benchmarks.benchmark_utils import load_results
+from benchmarks.benchmark_utils import print_comparisons
+from benchmarks.benchmark_utils import save_results
+from benchmarks.benchmark_utils import summarize_durations
+from benchmarks.benchmark_utils import time_function
+from benchmarks.synthetic_data import generate_cdc_ili_df
+from benchmarks.synthetic_data import generate_county_population_df
+from benchmarks.synthetic_data import generate_covidtracking_df
+from benchmarks.synthetic_data import generate_state_date_series
+from covid.extract import GEOGRAPHY_LEVEL_COUNTY
+from covid.extract import get_state_abbreviations_to_names
+from covid.transform import transform_cdc_ili_data
+from covid.transform import transform_covidtracking_data
+from covid.transform_utils import apply_by_state
+from covid.transform_utils import calculate_consecutive_boolean_series
+from covid.transform_utils import calculate_max_run_in_window
+from covid.transform_utils import fit_and_predict_cubic_spline
+from covid.transform_utils import fit_and_predict_cubic_spline_by_state
+from covid.transform_utils import generate_lags
+from covid.transform_utils import SPLINE_BACKEND_NATIVE
+from covid.transform_utils import SPLINE_BACKEND_R
+
+# Define the scales to benchmark at, as the number of states and of days. The transforms need real states (which have a
+# population), so they are benchmarked with at most as many states as there are.
+SCALES = {
+    "small": (10, 120),
+    "medium": (56, 240),
+    "large": (200, 480),
+    # Counties, which are benchmarked with the covidtracking transform at the county level.
+    "county": (3200, 240),
+}
+DEFAULT_SCALES = ["small", "medium"]
+
+
+def is_r_available():
+    """Returns whether R and its `smooth.spline` can be used through `rpy2`."""
+    try:
+        from rpy2 import robjects
+
+        robjects.r["smooth.spline"]
+    except Exception:
+        return False
+
+    return True
+
+
+def build_benchmarks(num_states, num_days, include_r=False):
+    """Builds the benchmarks at a scale, returning a function to time and its input's attributes, by name.
+
+    The input of every benchmark is generated up front, so that only the benchmarked function is timed.
+    """
+    series_ = generate_state_date_series(num_states=num_states, num_days=num_days)
+    state_df = series_.rename("value").reset_index()
+    day_over_day_changes = np.diff(series_.values.reshape(num_states, num_days), axis=1)
+
+    num_real_states = min(num_states, len(get_state_abbreviations_to_names()))
+    covidtracking_df = generate_covidtracking_df(
+        num_states=num_real_states, num_days=num_days
+    )
+    ili_df = generate_cdc_ili_df(num_states=num_real_states, num_weeks=num_days // 7)
+
+    benchmarks = {
+        "calculate_max_run_in_window": (
+            functools.partial(
+                calculate_max_run_in_window,
+                series_=day_over_day_changes,
+                positive_values=False,
+            ),
+            {"num_states": num_states, "num_days": num_days},
+        ),
+        "generate_lags": (
+            functools.partial(generate_lags, df=state_df, column="value"),
+            {"num_states": num_states, "num_days": num_days},
+        ),
+        "calculate_consecutive_boolean_series": (
+            functools.partial(
+                calculate_consecutive_boolean_series,
+                boolean_series=series_ > series_.median(),
+            ),
+            {"num_states": num_states, "num_days": num_days},
+        ),
+        "fit_and_predict_cubic_spline": (
+            functools.partial(
+                apply_by_state, series_=series_, func=fit_and_predict_cubic_spline
+            ),
+            {"num_states": num_states, "num_days": num_days},
+        ),
+        "fit_and_predict_cubic_spline_by_state[native]": (
+            functools.partial(
+                fit_and_predict_cubic_spline_by_state,
+                series_=series_,
+                backend=SPLINE_BACKEND_NATIVE,
+            ),
+            {"num_states": num_states, "num_days": num_days},
+        ),
+        "transform_covidtracking_data": (
+            functools.partial(
+                transform_covidtracking_data,
+                covidtracking_df=covidtracking_df,
+                spline_backend=SPLINE_BACKEND_NATIVE,
+            ),
+            {"num_states": num_real_states, "num_days": num_days},
+        ),
+        "transform_covidtracking_data[county]": (
+            functools.partial(
+                transform_covidtracking_data,
+                covidtracking_df=generate_covidtracking_df(
+                    num_states=num_states,
+                    num_days=num_days,
+                    geography_level=GEOGRAPHY_LEVEL_COUNTY,
+                ),
+                spline_backend=SPLINE_BACKEND_NATIVE,
+                geography_level=GEOGRAPHY_LEVEL_COUNTY,
+                population_data=generate_county_population_df(num_counties=num_states),
+            ),
+            {"num_counties": num_states, "num_days": num_days},
+        ),
+        "transform_cdc_ili_data": (
+            functools.partial(
+                _transform_copy_of_cdc_ili_data,
+                ili_df=ili_df,
+                spline_backend=SPLINE_BACKEND_NATIVE,
+            ),
+            {"num_states": num_real_states, "num_weeks": num_days // 7},
+        ),
+    }
+    if include_r:
+        benchmarks["fit_and_predict_cubic_spline_by_state[r]"] = (
+            functools.partial(
+                fit_and_predict_cubic_spline_by_state,
+                series_=series_,
+                backend=SPLINE_BACKEND_R,
+            ),
+            {"num_states": num_states, "num_days": num_days},
+        )
+
+    return benchmarks
+
+
+def _transform_copy_of_cdc_ili_data(ili_df, spline_backend):
+    # The ILI transform adds a date column to the frame it is given, so each run gets its own copy.
+    return transform_cdc_ili_data(ili_df=ili_df.copy(), spline_backend=spline_backend)
+
+
+def run_benchmarks(scales, num_repeats=DEFAULT_NUM_REPEATS, names=None):
+    """Runs the benchmarks (all of them, or those in `names`) at each scale, returning their results by name."""
+    include_r = is_r_available()
+    if not include_r:
+        print("R is not available; skipping benchmarks of the R spline backend.")
+
+    results_by_name = {}
+    for scale in scales:
+        num_states, num_days = SCALES[scale]
+        for name, (func, attributes) in build_benchmarks(
+            num_states=num_states, num_days=num_days, include_r=include_r
+        ).items():
+            if names is not None and name not in names:
+                continue
+
+            # Run once untimed, to warm up caches and lazy imports.
+            func()
+            durations = time_function(func=func, num_repeats=num_repeats)
+            results_by_name[f"{name}[{scale}]"] = summarize_durations(
+                durations, **attributes
+            )
+            print(
+                f"{name}[{scale}]: median {results_by_name[f'{name}[{scale}]']['median_seconds']:.3f}s over "
+                f"{num_repeats} runs"
+            )
+
+    return results_by_name
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--scales", nargs="+", choices=sorted(SCALES), default=DEFAULT_SCALES
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        help="names of the benchmarks to run (by default, all)",
+    )
+    parser.add_argument("--num-repeats", type=int, default=DEFAULT_NUM_REPEATS)
+    parser.add_argument("--output", help="path to save the results to, as JSON")
+    parser.add_argument("--baseline", help="path of results to compare to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="how much slower than its baseline a benchmark may get, as a fraction of the baseline",
+    )
+    args = parser.parse_args()
+
+    results_by_name = run_benchmarks(
+        scales=args.scales, num_repeats=args.num_repeats, names=args.benchmarks
+    )
+    if args.output is not None:
+        save_results(results_by_name=results_by_name, path=args.output)
+
+    if args.baseline is not None:
+        comparisons = compare_results(
+            results_by_name=results_by_name,
+            baseline_results_by_name=load_results(path=args.baseline),
+            threshold=args.threshold,
+        )
+        print_comparisons(comparisons)
+        if any(is_regression for *_, is_regression in comparisons):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 import json
 import logging
+from concurrent import futures as futures
 from io import BytesIO
 
+import numpy as np
 import pandas as pd
 import requests
-from df2gspread import gspread2df
 
 import covid.extract_config.cdc_govcloud as cgc
+from covid.extract_utils import CATEGORY_DTYPE
+from covid.extract_utils import fetch_dataframe_with_cache
+from covid.extract_utils import parse_json_records_incrementally
 from covid.extract_utils import unzip_string
+from covid.instrumentation import instrumented
 
 
 # Define the names of the CSVs returned by the CDC's FluView dashboard API.
@@ -25,6 +30,31 @@ NEW_CASES_NEGATIVE_SOURCE_FIELD = "negativeIncrease"
 NEW_CASES_POSITIVE_SOURCE_FIELD = "positiveIncrease"
 LAST_UPDATED_SOURCE_FIELD = "dateModified"
 
+# Define the geography levels that covidtracking-shaped data can be transformed at. County data identify each county by
+# its 5-digit FIPS code instead of a state abbreviation.
+GEOGRAPHY_LEVEL_STATE = "state"
+GEOGRAPHY_LEVEL_COUNTY = "county"
+GEOGRAPHY_LEVELS = [GEOGRAPHY_LEVEL_STATE, GEOGRAPHY_LEVEL_COUNTY]
+COUNTY_FIPS_SOURCE_FIELD = "fips"
+COUNTY_FIPS_FIELD = "County FIPS"
+COUNTY_FIPS_NUM_DIGITS = 5
+
+# Define the names of the sources that workbooks are calculated from.
+COVIDTRACKING_HISTORICAL_SOURCE = "covidtracking_historical"
+CDC_ILI_SOURCE = "cdc_ili"
+
+# Define the covidtracking fields (and their types) that are kept when streaming the daily history.
+COVIDTRACKING_HISTORICAL_STREAMING_FIELD_DTYPES = {
+    DATE_SOURCE_FIELD: np.int32,
+    STATE_SOURCE_FIELD: CATEGORY_DTYPE,
+    TOTAL_CASES_SOURCE_FIELD: np.float64,
+    NEW_CASES_POSITIVE_SOURCE_FIELD: np.float64,
+    NEW_CASES_NEGATIVE_SOURCE_FIELD: np.float64,
+}
+
+# Define the number of bytes read from a streamed response at a time.
+STREAMING_CHUNK_SIZE = 1 << 16
+
 # For bed utilization data
 CATEGORY_3_DATA_GOOGLE_SHEET_KEY = "1-BSd5eFbNsypygMkhuGX1OWoUsF2u4chpsu6aC4cgVo"
 CATEGORY_3_HISTORICAL_DATA_TAB = "Historical Data"
@@ -32,24 +62,52 @@ CATEGORY_3_HISTORICAL_DATA_TAB = "Historical Data"
 logger = logging.getLogger(__name__)
 
 
-def extract_covidtracking_current_data():
+@instrumented("extract_covidtracking_current_data")
+def extract_covidtracking_current_data(session=None):
     current_url = "https://covidtracking.com/api/v1/states/current.json"
-    current_data = requests.get(current_url).json()
+    current_data = (session or requests).get(current_url).json()
     current_df = pd.DataFrame(current_data)
 
     return current_df
 
 
-def extract_covidtracking_historical_data():
+@instrumented("extract_covidtracking_historical_data")
+def extract_covidtracking_historical_data(
+    cache_directory=None, session=None, streaming=False
+):
+    """Extracts the daily history of every state from covidtracking.com.
+
+    With `streaming`, the response is parsed as it downloads into typed columns, keeping only
+    `COVIDTRACKING_HISTORICAL_STREAMING_FIELD_DTYPES`; dates are `int32`s (e.g. `20200401`) and states are categorical.
+    Otherwise, every field is kept and dates are strings.
+    """
     historical_url = "https://covidtracking.com/api/v1/states/daily.json"
-    historical_data = requests.get(historical_url).json()
-    historical_df = pd.DataFrame(historical_data)
+
+    if streaming:
+        return fetch_dataframe_with_cache(
+            url=historical_url,
+            parse_response=lambda response: parse_json_records_incrementally(
+                chunks=response.iter_content(chunk_size=STREAMING_CHUNK_SIZE),
+                field_dtypes=COVIDTRACKING_HISTORICAL_STREAMING_FIELD_DTYPES,
+            ),
+            cache_directory=cache_directory,
+            session=session,
+            cache_variant="streaming",
+        )
+
+    historical_df = fetch_dataframe_with_cache(
+        url=historical_url,
+        parse_response=lambda response: pd.DataFrame(response.json()),
+        cache_directory=cache_directory,
+        session=session,
+    )
 
     historical_df[DATE_SOURCE_FIELD] = historical_df[DATE_SOURCE_FIELD].astype(str)
 
     return historical_df
 
 
+@instrumented("extract_state_population_data")
 def extract_state_population_data():
     # Note that the working directory is assumed to be the repository root.
     df = pd.read_csv("./covid/data/population.csv")
@@ -59,6 +117,21 @@ def extract_state_population_data():
     return df
 
 
+@instrumented("extract_county_population_data")
+def extract_county_population_data(path):
+    """Reads the population of each county from a CSV with a `fips` column followed by a population column (e.g. the
+    Census Bureau's county population estimates), indexed by 5-digit FIPS code.
+    """
+    df = pd.read_csv(path, dtype={COUNTY_FIPS_SOURCE_FIELD: str})
+    df[COUNTY_FIPS_SOURCE_FIELD] = df[COUNTY_FIPS_SOURCE_FIELD].str.zfill(
+        COUNTY_FIPS_NUM_DIGITS
+    )
+
+    df = df.set_index(keys=[COUNTY_FIPS_SOURCE_FIELD])
+
+    return df
+
+
 def get_state_abbreviations_to_names():
     with open("./covid/data/us_state_abbreviations.json") as state_abbreviations_file:
         abbreviations = json.load(state_abbreviations_file)
@@ -66,9 +139,9 @@ def get_state_abbreviations_to_names():
     return abbreviations
 
 
-def power_bi_extractor(response):
+def power_bi_extractor(response, data_date=None):
     data = json.loads(response.text)
-    timestamp = extract_cdc_data_date()
+    timestamp = data_date if data_date is not None else extract_cdc_data_date()
     value_list = data["results"][0]["result"]["data"]["dsr"]["DS"][0]["PH"][1]["DM1"]
     for vl in value_list:
         data_row = vl["C"]
@@ -78,9 +151,9 @@ def power_bi_extractor(response):
             logger.warning(f"Unexpected power BI response value: {data_row}")
 
 
-def extract_cdc_data_date():
+def extract_cdc_data_date(session=None):
     # Get data date as seen on the website
-    response = requests.post(
+    response = (session or requests).post(
         cgc.URL,
         headers={**cgc.BASE_HEADERS, **cgc.DATA_DATE_HEADERS},
         data=open("./covid/extract_config/data_date.json"),
@@ -90,16 +163,16 @@ def extract_cdc_data_date():
     return data["results"][0]["result"]["data"]["dsr"]["DS"][0]["PH"][0]["DM0"][0]["M0"]
 
 
-def extract_cdc_inpatient_beds():
+def extract_cdc_inpatient_beds(session=None, data_date=None):
     # State Representative Estimates for Percentage of Inpatient Beds Occupied (All Patients)
-    response = requests.post(
+    response = (session or requests).post(
         cgc.URL,
         headers={**cgc.BASE_HEADERS, **cgc.INPATIENT_BED_HEADERS},
         data=open("./covid/extract_config/inpatient_bed_query.json"),
     )
 
     df = pd.DataFrame(
-        power_bi_extractor(response),
+        power_bi_extractor(response, data_date=data_date),
         columns=[
             STATE_FIELD,
             "inpatient_bed_percent_occupied",
@@ -113,16 +186,16 @@ def extract_cdc_inpatient_beds():
     return df
 
 
-def extract_cdc_icu_beds():
+def extract_cdc_icu_beds(session=None, data_date=None):
     # State Representative Estimates for Percentage of ICU Beds Occupied (All Patients)
-    response = requests.post(
+    response = (session or requests).post(
         cgc.URL,
         headers={**cgc.BASE_HEADERS, **cgc.ICU_BED_HEADERS},
         data=open("./covid/extract_config/icu_bed_query.json"),
     )
 
     df = pd.DataFrame(
-        power_bi_extractor(response),
+        power_bi_extractor(response, data_date=data_date),
         columns=[
             STATE_FIELD,
             "icu_percent_occupied",
@@ -136,15 +209,15 @@ def extract_cdc_icu_beds():
     return df
 
 
-def extract_cdc_facilities_reporting():
-    response = requests.post(
+def extract_cdc_facilities_reporting(session=None, data_date=None):
+    response = (session or requests).post(
         cgc.URL,
         headers={**cgc.BASE_HEADERS, **cgc.FACILITIES_REPORTING_HEADERS},
         data=open("./covid/extract_config/facilities_reporting_query.json"),
     )
 
     df = pd.DataFrame(
-        power_bi_extractor(response),
+        power_bi_extractor(response, data_date=data_date),
         columns=[
             STATE_FIELD,
             "facilities_percent_reporting",
@@ -158,7 +231,18 @@ def extract_cdc_facilities_reporting():
     return df
 
 
-def extract_cdc_ili_data():
+def parse_cdc_ili_response(response):
+    filenames_to_contents_map = unzip_string(response.content)
+
+    df = pd.read_csv(
+        filepath_or_buffer=BytesIO(filenames_to_contents_map[ILI_NET_CSV]), skiprows=1
+    )
+
+    return df
+
+
+@instrumented("extract_cdc_ili_data")
+def extract_cdc_ili_data(cache_directory=None, session=None):
     current_url = "https://gis.cdc.gov/grasp/flu2/PostPhase02DataDownload"
     payload = {
         "AppVersion": "Public",
@@ -169,30 +253,48 @@ def extract_cdc_ili_data():
         "SeasonsDT": [{"ID": 59, "Name": "59"}],
     }
 
-    response = requests.post(
+    df = fetch_dataframe_with_cache(
         url=current_url,
+        parse_response=parse_cdc_ili_response,
+        cache_directory=cache_directory,
+        method="POST",
+        payload=json.dumps(payload),
         headers={"Content-Type": "application/json;charset=UTF-8"},
-        data=json.dumps(payload),
-    )
-    filenames_to_contents_map = unzip_string(response.content)
-
-    df = pd.read_csv(
-        filepath_or_buffer=BytesIO(filenames_to_contents_map[ILI_NET_CSV]), skiprows=1
+        session=session,
     )
 
     return df
 
 
-def extract_cdc_beds_current_data():
-    inpatient_bed_df = extract_cdc_inpatient_beds()
-    icu_bed_df = extract_cdc_icu_beds()
-    hospitals_reporting_df = extract_cdc_facilities_reporting()
+@instrumented("extract_cdc_beds_current_data")
+def extract_cdc_beds_current_data(session=None):
+    # Request the data date once, rather than once per query.
+    data_date = extract_cdc_data_date(session=session)
+
+    # The queries are independent, so issue them concurrently.
+    with futures.ThreadPoolExecutor() as executor:
+        inpatient_bed_future, icu_bed_future, hospitals_reporting_future = [
+            executor.submit(extractor, session=session, data_date=data_date)
+            for extractor in [
+                extract_cdc_inpatient_beds,
+                extract_cdc_icu_beds,
+                extract_cdc_facilities_reporting,
+            ]
+        ]
+        inpatient_bed_df = inpatient_bed_future.result()
+        icu_bed_df = icu_bed_future.result()
+        hospitals_reporting_df = hospitals_reporting_future.result()
+
     cdc_df = pd.concat([inpatient_bed_df, icu_bed_df, hospitals_reporting_df], axis=1)
     cdc_df = cdc_df.loc[:, ~cdc_df.columns.duplicated()]
     return cdc_df
 
 
+@instrumented("extract_cdc_beds_historical_data")
 def extract_cdc_beds_historical_data(credentials):
+    # Import `df2gspread` here, since it is slow to import and only needed by this extract.
+    from df2gspread import gspread2df
+
     cdc_historical_df = gspread2df.download(
         CATEGORY_3_DATA_GOOGLE_SHEET_KEY,
         CATEGORY_3_HISTORICAL_DATA_TAB,
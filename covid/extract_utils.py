@@ -1,6 +1,26 @@
+import codecs
+import hashlib
+import json
+import os
 import zipfile
 from io import BytesIO
 
+import numpy as np
+import pandas as pd
+import requests
+
+# Define the HTTP status code returned when a conditional request finds the resource unchanged.
+HTTP_NOT_MODIFIED = 304
+
+# Define the dtype used to request a categorical column from `parse_json_records_incrementally`.
+CATEGORY_DTYPE = "category"
+
+# Define the number of records that column buffers are initially allocated for.
+INITIAL_COLUMN_BUFFER_CAPACITY = 4096
+
+# Define the characters that separate the records of a JSON array.
+_JSON_ARRAY_SEPARATORS = frozenset(" \t\r\n,[")
+
 
 def unzip_string(string):
     # Unzip the response content.
@@ -8,3 +28,199 @@ def unzip_string(string):
         zipfile_contents = {name: zip_file.read(name) for name in zip_file.namelist()}
 
     return zipfile_contents
+
+
+def parse_json_records_incrementally(chunks, field_dtypes):
+    """Parses a JSON array of objects, arriving as an iterable of byte chunks, into a data frame.
+
+    Records are decoded one at a time as soon as they are complete, and only the fields in `field_dtypes` are kept,
+    each written straight into a typed column buffer that grows as needed; the whole payload and the list of parsed
+    records are never held in memory at once. Numeric fields that are missing or null are stored as NaN (for floats);
+    `CATEGORY_DTYPE` fields are stored as categoricals.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    # Store categorical fields as integer codes while parsing.
+    categories = {
+        field: {} for field, dtype in field_dtypes.items() if dtype == CATEGORY_DTYPE
+    }
+    buffers = {
+        field: np.empty(
+            shape=INITIAL_COLUMN_BUFFER_CAPACITY,
+            dtype=np.int32 if field in categories else dtype,
+        )
+        for field, dtype in field_dtypes.items()
+    }
+    num_records = 0
+
+    text = ""
+    is_finished = False
+    for chunk in chunks:
+        text += text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(text) and text[position] in _JSON_ARRAY_SEPARATORS:
+                position += 1
+            if position == len(text):
+                break
+            if text[position] == "]":
+                is_finished = True
+                break
+
+            try:
+                record, position_after_record = decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                # The record is incomplete, so wait for the next chunk.
+                break
+
+            if num_records == len(next(iter(buffers.values()))):
+                buffers = {
+                    field: np.resize(buffer, 2 * len(buffer))
+                    for field, buffer in buffers.items()
+                }
+
+            for field, buffer in buffers.items():
+                value = record.get(field)
+                if field in categories:
+                    # Missing categories are stored with the code `-1`.
+                    value = (
+                        -1
+                        if value is None
+                        else categories[field].setdefault(value, len(categories[field]))
+                    )
+                elif value is None:
+                    value = np.nan
+                buffer[num_records] = value
+
+            num_records += 1
+            position = position_after_record
+
+        text = text[position:]
+        if is_finished:
+            break
+
+    if not is_finished:
+        raise ValueError("The JSON array ended unexpectedly.")
+
+    columns = {}
+    for field, buffer in buffers.items():
+        if field in categories:
+            columns[field] = pd.Categorical.from_codes(
+                codes=buffer[:num_records], categories=list(categories[field])
+            )
+        else:
+            columns[field] = buffer[:num_records].copy()
+
+    return pd.DataFrame(data=columns)
+
+
+def calculate_dataframe_fingerprint(df):
+    """Calculates a content hash of `df`, which doesn't depend on the order of its columns or on its index."""
+    fingerprint = hashlib.sha256()
+    for column in sorted(df.columns, key=str):
+        fingerprint.update(f"{column}\n{df[column].dtype}\n".encode("utf-8"))
+        fingerprint.update(
+            pd.util.hash_pandas_object(df[column], index=False).values.tobytes()
+        )
+    return fingerprint.hexdigest()
+
+
+def get_cache_key(url, payload=None, variant=None):
+    """Generates a file-safe key for the response to a request for `url` with the (optional) `payload` body.
+
+    `variant` distinguishes different data frames parsed from the same response.
+    """
+    key_source = "\n".join(
+        str(part) for part in [url, payload, variant] if part is not None
+    )
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def _write_atomically(path, write):
+    # Write to a temporary file first so that an interrupted write never leaves a partial cache entry behind.
+    temporary_path = f"{path}.tmp"
+    write(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _write_json(path, data):
+    with open(path, "w") as json_file:
+        json.dump(data, json_file)
+
+
+def fetch_dataframe_with_cache(
+    url,
+    parse_response,
+    cache_directory=None,
+    method="GET",
+    payload=None,
+    headers=None,
+    session=None,
+    cache_variant=None,
+):
+    """Fetches `url` and parses the response into a data frame with `parse_response`, caching the result.
+
+    If `cache_directory` is given, the parsed data frame is stored there as Parquet, keyed by the URL and payload,
+    along with the response's `ETag` and `Last-Modified` headers. The next fetch sends them back as `If-None-Match` and
+    `If-Modified-Since`; if the server responds that nothing has changed, the cached data frame is read back instead
+    of downloading and parsing the response again.
+
+    Requests are made with `session` (e.g. a `requests.Session` shared between extractors) if it is given. Responses
+    are streamed, so `parse_response` may read the body incrementally (e.g. with `response.iter_content`). Callers
+    that parse the same URL in different ways must pass a different `cache_variant` for each.
+    """
+    session = session or requests
+
+    if cache_directory is None:
+        response = session.request(
+            method=method, url=url, headers=headers, data=payload, stream=True
+        )
+        return parse_response(response)
+
+    cache_key = get_cache_key(url=url, payload=payload, variant=cache_variant)
+    data_path = os.path.join(cache_directory, f"{cache_key}.parquet")
+    metadata_path = os.path.join(cache_directory, f"{cache_key}.json")
+
+    metadata = {}
+    if os.path.exists(data_path) and os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+
+    conditional_headers = {}
+    if metadata.get("etag"):
+        conditional_headers["If-None-Match"] = metadata["etag"]
+    if metadata.get("last_modified"):
+        conditional_headers["If-Modified-Since"] = metadata["last_modified"]
+
+    response = session.request(
+        method=method,
+        url=url,
+        headers={**(headers or {}), **conditional_headers},
+        data=payload,
+        stream=True,
+    )
+
+    if response.status_code == HTTP_NOT_MODIFIED and conditional_headers:
+        response.close()
+        return pd.read_parquet(data_path)
+
+    # Only cache successful responses.
+    response.raise_for_status()
+    df = parse_response(response)
+
+    os.makedirs(cache_directory, exist_ok=True)
+    _write_atomically(path=data_path, write=lambda path: df.to_parquet(path))
+    _write_atomically(
+        path=metadata_path,
+        write=lambda path: _write_json(
+            path=path,
+            data={
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            },
+        ),
+    )
+
+    return df
@@ -0,0 +1,139 @@
+import json
+import tempfile
+import threading
+import unittest
+from http import server as http_server
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from covid.extract_utils import calculate_dataframe_fingerprint
+from covid.extract_utils import CATEGORY_DTYPE
+from covid.extract_utils import fetch_dataframe_with_cache
+from covid.extract_utils import parse_json_records_incrementally
+
+ETAG = '"version-1"'
+
+
+class _StubHandler(http_server.BaseHTTPRequestHandler):
+    """Serves a fixed JSON body with an `ETag`, and answers matching conditional requests with `304 Not Modified`."""
+
+    requests_received = []
+
+    def do_GET(self):
+        self.requests_received.append(dict(self.headers))
+
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps([{"state": "AK", "positive": 1}]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExtractUtilsTest(unittest.TestCase):
+    def setUp(self):
+        _StubHandler.requests_received = []
+        self.server = http_server.HTTPServer(("127.0.0.1", 0), _StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/states/daily.json"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_dataframe_with_cache(self):
+        parsed_responses = []
+
+        def parse_response(response):
+            parsed_responses.append(response)
+            return pd.DataFrame(response.json())
+
+        with tempfile.TemporaryDirectory() as cache_directory:
+            first_df = fetch_dataframe_with_cache(
+                url=self.url,
+                parse_response=parse_response,
+                cache_directory=cache_directory,
+            )
+            second_df = fetch_dataframe_with_cache(
+                url=self.url,
+                parse_response=parse_response,
+                cache_directory=cache_directory,
+            )
+
+        # The second fetch is revalidated with the `ETag` and served from the cache without parsing the response.
+        self.assertNotIn("If-None-Match", _StubHandler.requests_received[0])
+        self.assertEqual(_StubHandler.requests_received[1]["If-None-Match"], ETAG)
+        self.assertEqual(len(parsed_responses), 1)
+
+        assert_frame_equal(
+            first_df, pd.DataFrame(data={"state": ["AK"], "positive": [1]})
+        )
+        assert_frame_equal(second_df, first_df)
+
+    def test_parse_json_records_incrementally(self):
+        payload = json.dumps(
+            [
+                {"date": 20200402, "state": "AK", "positive": 2, "note": "skipped"},
+                {"date": 20200402, "state": "Ñ", "positive": None},
+                {"date": 20200401, "state": "AK"},
+            ]
+        ).encode("utf-8")
+
+        # Split the payload into small chunks, including in the middle of records and of multi-byte characters.
+        chunks = [payload[i : i + 7] for i in range(0, len(payload), 7)]
+
+        assert_frame_equal(
+            parse_json_records_incrementally(
+                chunks=chunks,
+                field_dtypes={
+                    "date": np.int32,
+                    "state": CATEGORY_DTYPE,
+                    "positive": np.float64,
+                },
+            ),
+            pd.DataFrame(
+                data={
+                    "date": np.array([20200402, 20200402, 20200401], dtype=np.int32),
+                    "state": pd.Categorical(["AK", "Ñ", "AK"], categories=["AK", "Ñ"]),
+                    "positive": [2.0, np.nan, np.nan],
+                }
+            ),
+        )
+
+        with self.assertRaises(ValueError):
+            parse_json_records_incrementally(
+                chunks=[payload[:-10]], field_dtypes={"date": np.int32}
+            )
+
+    def test_calculate_dataframe_fingerprint(self):
+        df = pd.DataFrame(data={"state": ["AK", "AL"], "positive": [1.0, 2.0]})
+        fingerprint = calculate_dataframe_fingerprint(df)
+
+        # The fingerprint doesn't depend on the order of columns or on the index.
+        self.assertEqual(
+            calculate_dataframe_fingerprint(
+                df.loc[:, ["positive", "state"]].set_axis([5, 6], axis=0)
+            ),
+            fingerprint,
+        )
+
+        # But it changes with any value or dtype.
+        self.assertNotEqual(
+            calculate_dataframe_fingerprint(df.assign(positive=[1.0, 3.0])),
+            fingerprint,
+        )
+        self.assertNotEqual(
+            calculate_dataframe_fingerprint(df.astype({"positive": np.float32})),
+            fingerprint,
+        )
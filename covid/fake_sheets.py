@@ -0,0 +1,297 @@
+import collections
+import copy
+import json
+import re
+import threading
+import time
+from http import server as http_server
+
+import requests
+
+from covid.load_utils import count_updated_cells
+from covid.load_utils import SHEETS_CELLS_WRITTEN_PER_MINUTE
+from covid.load_utils import SHEETS_REQUESTS_PER_MINUTE
+
+# Define the paths of the endpoints that are faked.
+GET_PATH_PATTERN = re.compile(r"^/v4/spreadsheets/(?P<workbook_key>[^/:]+)$")
+BATCH_UPDATE_PATH_PATTERN = re.compile(
+    r"^/v4/spreadsheets/(?P<workbook_key>[^/:]+):batchUpdate$"
+)
+
+HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+HTTP_NOT_FOUND = 404
+HTTP_TOO_MANY_REQUESTS = 429
+
+
+class FakeSheetsServer:
+    """Serves a local fake of the Sheets API's `spreadsheets.get` and `spreadsheets.batchUpdate` endpoints.
+
+    The `addSheet`, `updateSheetProperties` (grid size only) and `updateCells` (string values only) requests are
+    supported, and each batch is applied atomically. Batches over `requests_per_minute` or `cells_per_minute` (counted
+    over the last minute) are rejected with `429 Too Many Requests`, as the Sheets API does. The number of requests to
+    each endpoint and the size of each batch (in bytes) are recorded.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=SHEETS_REQUESTS_PER_MINUTE,
+        cells_per_minute=SHEETS_CELLS_WRITTEN_PER_MINUTE,
+        clock=time.monotonic,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.cells_per_minute = cells_per_minute
+        self.clock = clock
+        self.workbooks = collections.defaultdict(dict)
+        self.num_accepted_requests = 0
+        self.num_rejected_requests = 0
+        self.num_requests_by_endpoint = collections.Counter()
+        self.batch_update_sizes = []
+        self._accepted_requests = collections.deque()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        self._server = http_server.HTTPServer(("127.0.0.1", 0), _FakeSheetsHandler)
+        self._server.fake_sheets = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def workbook_url(self):
+        """The URL of the `spreadsheets.get` endpoint, with a `{workbook_key}` placeholder."""
+        return (
+            f"http://127.0.0.1:{self._server.server_port}"
+            "/v4/spreadsheets/{workbook_key}"
+        )
+
+    @property
+    def batch_update_url(self):
+        """The URL of the `spreadsheets.batchUpdate` endpoint, with a `{workbook_key}` placeholder."""
+        return self.workbook_url + ":batchUpdate"
+
+    def open_workbook(self, workbook_key):
+        """Returns a client for a workbook, with the methods of `gspread.Spreadsheet` used by `covid.load`."""
+        return FakeWorkbook(
+            workbook_url=self.workbook_url.format(workbook_key=workbook_key)
+        )
+
+    def get_sheet_properties_by_tab_name(self, workbook_key):
+        """Returns the `sheetId`, `rowCount` and `columnCount` of each tab, as `spreadsheets.get` would."""
+        with self._lock:
+            return {
+                sheet["title"]: {
+                    "sheetId": sheet_id,
+                    "rowCount": sheet["rowCount"],
+                    "columnCount": sheet["columnCount"],
+                }
+                for sheet_id, sheet in self.workbooks[workbook_key].items()
+            }
+
+    def get_values(self, workbook_key, tab_name):
+        """Returns the values of every cell of a tab, as a list of rows."""
+        with self._lock:
+            (sheet,) = [
+                sheet
+                for sheet in self.workbooks[workbook_key].values()
+                if sheet["title"] == tab_name
+            ]
+            return [
+                [
+                    sheet["cells"].get((row_index, column_index), "")
+                    for column_index in range(sheet["columnCount"])
+                ]
+                for row_index in range(sheet["rowCount"])
+            ]
+
+    def batch_update(self, workbook_key, body):
+        """Applies a `spreadsheets.batchUpdate` request body, returning the response status code and body."""
+        num_cells = count_updated_cells(body["requests"])
+
+        with self._lock:
+            now = self.clock()
+            while self._accepted_requests and now - self._accepted_requests[0][0] >= 60:
+                self._accepted_requests.popleft()
+
+            if (
+                len(self._accepted_requests) + 1 > self.requests_per_minute
+                or sum(cells for _, cells in self._accepted_requests) + num_cells
+                > self.cells_per_minute
+            ):
+                self.num_rejected_requests += 1
+                return _build_error(
+                    HTTP_TOO_MANY_REQUESTS,
+                    status="RESOURCE_EXHAUSTED",
+                    message="Quota exceeded for quota metric 'Write requests'.",
+                )
+
+            # Apply the requests to a copy, so that nothing is changed if any of them is invalid.
+            sheets = copy.deepcopy(self.workbooks[workbook_key])
+            try:
+                for request in body["requests"]:
+                    _apply_request(sheets=sheets, request=request)
+            except (KeyError, ValueError) as error:
+                return _build_error(
+                    HTTP_BAD_REQUEST, status="INVALID_ARGUMENT", message=str(error)
+                )
+
+            self.workbooks[workbook_key] = sheets
+            self._accepted_requests.append((now, num_cells))
+            self.num_accepted_requests += 1
+
+        return (
+            HTTP_OK,
+            {"spreadsheetId": workbook_key, "replies": [{} for _ in body["requests"]]},
+        )
+
+
+# Define the worksheet properties returned by `FakeWorkbook.worksheets`, as on `gspread.Worksheet`.
+FakeWorksheet = collections.namedtuple(
+    "FakeWorksheet", ["id", "title", "row_count", "col_count"]
+)
+
+
+class FakeWorkbook:
+    """Requests a workbook from a `FakeSheetsServer` over HTTP, raising `requests.HTTPError` on errors."""
+
+    def __init__(self, workbook_url):
+        self.workbook_url = workbook_url
+
+    def worksheets(self):
+        response = requests.get(self.workbook_url)
+        response.raise_for_status()
+        return [
+            FakeWorksheet(
+                id=sheet["properties"]["sheetId"],
+                title=sheet["properties"]["title"],
+                row_count=sheet["properties"]["gridProperties"]["rowCount"],
+                col_count=sheet["properties"]["gridProperties"]["columnCount"],
+            )
+            for sheet in response.json()["sheets"]
+        ]
+
+    def batch_update(self, body):
+        response = requests.post(f"{self.workbook_url}:batchUpdate", json=body)
+        response.raise_for_status()
+        return response.json()
+
+
+def _apply_request(sheets, request):
+    if "addSheet" in request:
+        properties = request["addSheet"]["properties"]
+        if properties["sheetId"] in sheets:
+            raise ValueError(f"Sheet ID {properties['sheetId']} already exists.")
+        sheets[properties["sheetId"]] = {
+            "title": properties["title"],
+            "rowCount": properties["gridProperties"]["rowCount"],
+            "columnCount": properties["gridProperties"]["columnCount"],
+            "cells": {},
+        }
+    elif "updateSheetProperties" in request:
+        properties = request["updateSheetProperties"]["properties"]
+        sheet = sheets[properties["sheetId"]]
+        sheet["rowCount"] = properties["gridProperties"]["rowCount"]
+        sheet["columnCount"] = properties["gridProperties"]["columnCount"]
+
+        # Cells outside of the resized grid are deleted.
+        sheet["cells"] = {
+            (row_index, column_index): value
+            for (row_index, column_index), value in sheet["cells"].items()
+            if row_index < sheet["rowCount"] and column_index < sheet["columnCount"]
+        }
+    elif "updateCells" in request:
+        start = request["updateCells"]["start"]
+        sheet = sheets[start["sheetId"]]
+        for row_offset, row in enumerate(request["updateCells"]["rows"]):
+            for column_offset, value in enumerate(row["values"]):
+                row_index = start["rowIndex"] + row_offset
+                column_index = start["columnIndex"] + column_offset
+                if (
+                    row_index >= sheet["rowCount"]
+                    or column_index >= sheet["columnCount"]
+                ):
+                    raise ValueError(
+                        f"Cell ({row_index}, {column_index}) is outside of the grid."
+                    )
+                sheet["cells"][(row_index, column_index)] = value["userEnteredValue"][
+                    "stringValue"
+                ]
+    else:
+        raise ValueError(f"Unsupported request: {list(request)}.")
+
+
+def _build_error(status_code, status, message):
+    return (
+        status_code,
+        {"error": {"code": status_code, "message": message, "status": status}},
+    )
+
+
+class _FakeSheetsHandler(http_server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = GET_PATH_PATTERN.match(self.path)
+        fake_sheets = self.server.fake_sheets
+
+        if match is None:
+            status_code, response_body = _build_error(
+                HTTP_NOT_FOUND, status="NOT_FOUND", message="Not found."
+            )
+        else:
+            workbook_key = match.group("workbook_key")
+            fake_sheets.num_requests_by_endpoint["get"] += 1
+            status_code, response_body = (
+                HTTP_OK,
+                {
+                    "spreadsheetId": workbook_key,
+                    "sheets": [
+                        {
+                            "properties": {
+                                "sheetId": properties["sheetId"],
+                                "title": tab_name,
+                                "gridProperties": {
+                                    "rowCount": properties["rowCount"],
+                                    "columnCount": properties["columnCount"],
+                                },
+                            }
+                        }
+                        for tab_name, properties in fake_sheets.get_sheet_properties_by_tab_name(
+                            workbook_key
+                        ).items()
+                    ],
+                },
+            )
+
+        self._send_json(status_code=status_code, response_body=response_body)
+
+    def do_POST(self):
+        match = BATCH_UPDATE_PATH_PATTERN.match(self.path)
+        fake_sheets = self.server.fake_sheets
+        payload = self.rfile.read(int(self.headers["Content-Length"]))
+
+        if match is None:
+            status_code, response_body = _build_error(
+                HTTP_NOT_FOUND, status="NOT_FOUND", message="Not found."
+            )
+        else:
+            fake_sheets.num_requests_by_endpoint["batchUpdate"] += 1
+            fake_sheets.batch_update_sizes.append(len(payload))
+            status_code, response_body = fake_sheets.batch_update(
+                workbook_key=match.group("workbook_key"), body=json.loads(payload)
+            )
+
+        self._send_json(status_code=status_code, response_body=response_body)
+
+    def _send_json(self, status_code, response_body):
+        response = json.dumps(response_body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
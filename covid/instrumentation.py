@@ -0,0 +1,175 @@
+import contextlib
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Define the spans recorded in this process since the run started (or since they were last collected).
+_spans = []
+_spans_lock = threading.Lock()
+
+# Define the spans running in this process, whose peak memory is carried over whenever another span resets the peak.
+_running_spans = set()
+
+
+class Span:
+    """A timed stage of a run, with attributes such as the state it covers or the shape of its output."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.peak_memory_bytes = 0
+
+    def record_dataframe(self, df, prefix=""):
+        """Records the number of rows and columns of `df`, e.g. of a stage's input (`prefix="input_"`) or output."""
+        self.attributes[f"{prefix}num_rows"] = len(df)
+        self.attributes[f"{prefix}num_columns"] = len(df.columns)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Times the enclosed block as a stage named `name`, recording it for the metrics of the run.
+
+    Yields a `Span`, to add attributes to. If `tracemalloc` is tracing (see `start_run`), the peak memory traced while
+    the stage ran is also recorded; as memory is traced for the whole process, this includes concurrent stages.
+    """
+    span_ = Span(name=name, attributes=attributes)
+    is_tracing_memory = tracemalloc.is_tracing()
+    if is_tracing_memory:
+        with _spans_lock:
+            start_memory_bytes, peak_memory_bytes = tracemalloc.get_traced_memory()
+            for running_span in _running_spans:
+                running_span.peak_memory_bytes = max(
+                    running_span.peak_memory_bytes, peak_memory_bytes
+                )
+            # Note: `reset_peak` is only available from Python 3.9, before which the peak covers the run so far.
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            _running_spans.add(span_)
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield span_
+    finally:
+        record = {
+            "name": name,
+            "process_id": os.getpid(),
+            "start_time": start_time,
+            "duration_seconds": time.perf_counter() - start_counter,
+            "attributes": span_.attributes,
+        }
+        if is_tracing_memory:
+            with _spans_lock:
+                _running_spans.discard(span_)
+                if tracemalloc.is_tracing():
+                    (
+                        end_memory_bytes,
+                        peak_memory_bytes,
+                    ) = tracemalloc.get_traced_memory()
+                    record["memory_change_bytes"] = (
+                        end_memory_bytes - start_memory_bytes
+                    )
+                    record["peak_memory_bytes"] = max(
+                        span_.peak_memory_bytes, peak_memory_bytes
+                    )
+        record_spans([record])
+
+
+def instrumented(name):
+    """Decorates a function to run in a span named `name`, recording the shape of the dataframe it returns (if any)."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name) as span_:
+                result = func(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    span_.record_dataframe(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def record_spans(spans):
+    with _spans_lock:
+        _spans.extend(spans)
+
+
+def collect_spans():
+    """Removes and returns the spans recorded in this process, e.g. to return them from a worker process."""
+    with _spans_lock:
+        spans = list(_spans)
+        _spans.clear()
+    return spans
+
+
+def _reset_spans_in_child_process():
+    global _spans_lock
+    _spans.clear()
+    _running_spans.clear()
+    _spans_lock = threading.Lock()
+
+
+# Worker processes that are forked don't inherit the spans of their parent, which would otherwise be recorded twice.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_spans_in_child_process)
+
+
+def call_and_collect_spans(func, *args, **kwargs):
+    """Calls `func`, returning its result and the spans recorded meanwhile in this process.
+
+    Functions run in worker processes are called with this, and the spans they return passed to `record_spans`, so
+    that they are recorded in the metrics of the run. Spans recorded meanwhile by other threads are also returned.
+    """
+    result = func(*args, **kwargs)
+    return result, collect_spans()
+
+
+def start_run(trace_memory=True):
+    """Starts recording the metrics of a run, discarding spans recorded before, and returns its start time."""
+    collect_spans()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return time.time()
+
+
+def finish_run(start_time, metrics_directory):
+    """Writes the spans recorded since `start_time` to a new JSON metrics file in `metrics_directory`.
+
+    Returns the path of the metrics file.
+    """
+    spans = sorted(collect_spans(), key=lambda record: record["start_time"])
+    for record in spans:
+        record["start_seconds"] = record.pop("start_time") - start_time
+
+    metrics = {
+        "started_at": datetime.datetime.fromtimestamp(start_time).isoformat(),
+        "duration_seconds": time.time() - start_time,
+        "spans": spans,
+    }
+    if tracemalloc.is_tracing():
+        # The peak is reset by each span, so the peak of the run is the highest of the peaks recorded.
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+        metrics["peak_memory_bytes"] = max(
+            [peak_memory_bytes]
+            + [record.get("peak_memory_bytes", 0) for record in spans]
+        )
+        tracemalloc.stop()
+
+    os.makedirs(metrics_directory, exist_ok=True)
+    path = os.path.join(
+        metrics_directory,
+        f"metrics-{datetime.datetime.fromtimestamp(start_time):%Y%m%d-%H%M%S}.json",
+    )
+    with open(path, "w") as file:
+        json.dump(metrics, file, indent=2, default=str)
+
+    return path
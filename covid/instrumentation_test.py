@@ -0,0 +1,42 @@
+import json
+import tempfile
+import unittest
+
+import pandas as pd
+
+from covid.instrumentation import finish_run
+from covid.instrumentation import instrumented
+from covid.instrumentation import span
+from covid.instrumentation import start_run
+
+
+@instrumented("make_frame")
+def make_frame(num_rows):
+    return pd.DataFrame(data={"a": range(num_rows), "b": range(num_rows)})
+
+
+class InstrumentationTest(unittest.TestCase):
+    def test_run_metrics(self):
+        start_time = start_run(trace_memory=True)
+        with span("stage", state="Alaska"):
+            make_frame(num_rows=100000)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(
+                finish_run(start_time=start_time, metrics_directory=directory)
+            ) as file:
+                metrics = json.load(file)
+
+        self.assertEqual(
+            [record["name"] for record in metrics["spans"]], ["stage", "make_frame"]
+        )
+        stage, frame = metrics["spans"]
+        self.assertEqual(stage["attributes"], {"state": "Alaska"})
+        self.assertEqual(frame["attributes"], {"num_rows": 100000, "num_columns": 2})
+
+        # The frame's memory counts towards the peaks of both spans, even though the inner span reset the peak.
+        self.assertGreater(frame["peak_memory_bytes"], 100000 * 2 * 8)
+        self.assertGreaterEqual(stage["peak_memory_bytes"], frame["peak_memory_bytes"])
+        self.assertGreaterEqual(
+            metrics["peak_memory_bytes"], stage["peak_memory_bytes"]
+        )
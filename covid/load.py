@@ -1,36 +1,467 @@
-import gspread
-from df2gspread import df2gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from covid.instrumentation import span
+from covid.load_utils import build_workbook_update_requests
+from covid.load_utils import calculate_appended_blocks
+from covid.load_utils import calculate_changed_blocks
+from covid.load_utils import convert_dataframe_to_cell_values
+from covid.load_utils import count_updated_cells
+from covid.load_utils import DEFAULT_TAB_CELL_BUDGET
+from covid.load_utils import plan_tab_upload
+from covid.load_utils import SHEETS_MAX_CELLS_PER_WORKBOOK
+from covid.load_utils import UploadScheduler
+
+logger = logging.getLogger(__name__)
+
+# Define the number of API requests made to update a workbook: opening it, listing its tabs and the batched update.
+WORKBOOK_UPDATE_NUM_REQUESTS = 3
+
+# Define how far before the latest uploaded date rows are rewritten in append mode.
+DEFAULT_REVISION_WINDOW = datetime.timedelta(weeks=4)
 
 
 def post_dataframe_to_google_sheets(
-    df, workbook_key, tab_name, credentials, nan_replacement_value=""
+    df,
+    workbook_key,
+    tab_name,
+    credentials,
+    nan_replacement_value="",
+    snapshot_directory=None,
+    scheduler=None,
+    append_date_field=None,
+    revision_window=DEFAULT_REVISION_WINDOW,
+    cell_budget=DEFAULT_TAB_CELL_BUDGET,
+    float_precision=None,
 ):
-    if nan_replacement_value is not None:
-        df = df.fillna(value=nan_replacement_value)
-
-    print(f"Beginning to upload data to workbook {workbook_key} and tab {tab_name}...")
-    df2gspread.upload(
-        df=df,
-        gfile=workbook_key,
-        wks_name=tab_name,
+    """Uploads `df` (with a header row) to the tab `tab_name` of the workbook `workbook_key`.
+
+    If `append_date_field` and `snapshot_directory` are given, the tab is uploaded in append mode. See
+    `post_dataframes_to_google_sheets`.
+    """
+    return post_dataframes_to_google_sheets(
+        dfs_by_tab_name={tab_name: df},
+        workbook_key=workbook_key,
         credentials=credentials,
-        # Do not include the index in the upload.
-        row_names=False,
-        col_names=True,
+        nan_replacement_value=nan_replacement_value,
+        snapshot_directory=snapshot_directory,
+        scheduler=scheduler,
+        append_date_fields_by_tab_name=(
+            {tab_name: append_date_field} if append_date_field is not None else None
+        ),
+        revision_window=revision_window,
+        cell_budget=cell_budget,
+        float_precision=float_precision,
     )
-    print("Finished uploading data.")
 
 
-# TODO(lbrown): this was created when I was using the Sheets API, at this point we may only need the credentials.
-def get_sheets_client(credential_file_path):
+def post_dataframes_to_google_sheets(
+    dfs_by_tab_name,
+    workbook_key,
+    credentials,
+    nan_replacement_value="",
+    snapshot_directory=None,
+    scheduler=None,
+    open_workbook=None,
+    append_date_fields_by_tab_name=None,
+    revision_window=DEFAULT_REVISION_WINDOW,
+    cell_budget=DEFAULT_TAB_CELL_BUDGET,
+    float_precision=None,
+):
+    """Uploads each dataframe of `dfs_by_tab_name` (with a header row) to its tab of the workbook `workbook_key`.
+
+    All tabs are written in a single, atomic batched request, which also adds missing tabs and resizes each tab to fit
+    its dataframe. By default, every cell of each tab is rewritten. If `snapshot_directory` is given, a snapshot of
+    what was uploaded to each tab is kept there, and later uploads only send the cells that changed since. Tabs without
+    a snapshot, or whose columns changed, are rewritten in full. Note that edits made to a tab outside of this function
+    are not detected.
+
+    If `snapshot_directory` is given, tabs in `append_date_fields_by_tab_name` are uploaded in append mode instead, for
+    history that grows by the given date field: only the number of rows of each date is kept in `snapshot_directory`,
+    and later uploads only rewrite the rows dated from `revision_window` before the latest date uploaded before
+    onwards. Rows are never reordered, so this only applies while those rows are at the bottom of the tab (e.g. when it
+    is ordered by date); otherwise the tab is rewritten in full (see `calculate_appended_blocks`). Without a
+    `snapshot_directory`, these tabs are uploaded like any other.
+
+    Before uploading, floats are rounded to `float_precision` decimals (if given), and the size of each tab is planned
+    and reported: tabs with more cells than `cell_budget` are sharded into numbered tabs (see `plan_tab_upload`),
+    except for tabs in append mode. Tabs left over from earlier, larger shardings are not removed.
+
+    Uploads are paced by `scheduler` (an `UploadScheduler`), which should be shared across uploads to stay within the
+    Sheets API quotas. `open_workbook` returns the workbook for a key (a `gspread.Spreadsheet`, or an object with the
+    same `worksheets` and `batch_update` methods); by default, it is opened with `credentials`.
+
+    Returns the plan of each tab (see `plan_tab_upload`).
+    """
+    if scheduler is None:
+        scheduler = UploadScheduler()
+    if open_workbook is None:
+        open_workbook = functools.partial(open_google_workbook, credentials=credentials)
+
+    # Append mode relies on the snapshot of what was uploaded before, so without one every tab is uploaded as it is.
+    if append_date_fields_by_tab_name is None or snapshot_directory is None:
+        append_date_fields_by_tab_name = {}
+
+    plans = []
+    values_dfs_by_tab_name = {}
+    changed_blocks_by_tab_name = {}
+    for tab_name, df in dfs_by_tab_name.items():
+        append_date_field = append_date_fields_by_tab_name.get(tab_name)
+
+        if float_precision is not None:
+            df = df.round(decimals=float_precision)
+        if nan_replacement_value is not None:
+            df = df.fillna(value=nan_replacement_value)
+
+        # Append mode relies on the rows of a single tab, so those tabs are not sharded.
+        shard_values_dfs_by_tab_name, plan = plan_tab_upload(
+            values_df=convert_dataframe_to_cell_values(df),
+            tab_name=tab_name,
+            cell_budget=cell_budget if append_date_field is None else None,
+        )
+        plans.append(plan)
+        logger.info(
+            f"Planned {plan['num_cells']} cells ({plan['num_rows']} rows and {plan['num_columns']} columns, about "
+            f"{plan['num_bytes'] / 1e6:.1f} MB) for tab {tab_name}, in {len(shard_values_dfs_by_tab_name)} tab(s)."
+        )
+
+        for shard_tab_name, values_df in shard_values_dfs_by_tab_name.items():
+            values_dfs_by_tab_name[shard_tab_name] = values_df
+            # Tabs without a usable snapshot are rewritten in full.
+            changed_blocks_by_tab_name[shard_tab_name] = None
+
+            if snapshot_directory is None:
+                continue
+
+            if append_date_field is not None:
+                previous_num_rows_by_date = _read_num_rows_by_date(
+                    path=get_snapshot_path(
+                        snapshot_directory=snapshot_directory,
+                        workbook_key=workbook_key,
+                        tab_name=shard_tab_name,
+                        extension="json",
+                    ),
+                    columns=values_df.columns,
+                )
+                if previous_num_rows_by_date:
+                    changed_blocks_by_tab_name[
+                        shard_tab_name
+                    ] = calculate_appended_blocks(
+                        values_df=values_df,
+                        dates=df[append_date_field],
+                        previous_num_rows_by_date=previous_num_rows_by_date,
+                        revision_window=revision_window,
+                    )
+                continue
+
+            snapshot_path = get_snapshot_path(
+                snapshot_directory=snapshot_directory,
+                workbook_key=workbook_key,
+                tab_name=shard_tab_name,
+            )
+            previous_values_df = (
+                pd.read_pickle(snapshot_path) if os.path.exists(snapshot_path) else None
+            )
+            if previous_values_df is not None and list(
+                previous_values_df.columns
+            ) == list(values_df.columns):
+                changed_blocks_by_tab_name[shard_tab_name] = calculate_changed_blocks(
+                    previous_values_df=previous_values_df, values_df=values_df
+                )
+
+    num_cells = sum(plan["num_cells"] for plan in plans)
+    if num_cells > SHEETS_MAX_CELLS_PER_WORKBOOK:
+        logger.warning(
+            f"Uploading {num_cells} cells to workbook {workbook_key}, over its limit of "
+            f"{SHEETS_MAX_CELLS_PER_WORKBOOK} cells."
+        )
+
+    logger.info(
+        f"Beginning to upload data to workbook {workbook_key} and tabs {', '.join(values_dfs_by_tab_name)}..."
+    )
+    with span("upload_workbook", workbook_key=workbook_key, num_cells=num_cells):
+        if any(
+            changed_blocks != []
+            for changed_blocks in changed_blocks_by_tab_name.values()
+        ):
+            scheduler.call(
+                func=functools.partial(
+                    _update_workbook,
+                    workbook_key=workbook_key,
+                    open_workbook=open_workbook,
+                    values_dfs_by_tab_name=values_dfs_by_tab_name,
+                    changed_blocks_by_tab_name=changed_blocks_by_tab_name,
+                ),
+                num_requests=WORKBOOK_UPDATE_NUM_REQUESTS,
+                num_cells=sum(
+                    (len(values_df) + 1) * len(values_df.columns)
+                    if changed_blocks_by_tab_name[tab_name] is None
+                    else sum(
+                        len(block["values"]) * len(block["values"][0])
+                        for block in changed_blocks_by_tab_name[tab_name]
+                    )
+                    for tab_name, values_df in values_dfs_by_tab_name.items()
+                ),
+            )
+    logger.info("Finished uploading data.")
+
+    if snapshot_directory is not None:
+        os.makedirs(snapshot_directory, exist_ok=True)
+        for tab_name, values_df in values_dfs_by_tab_name.items():
+            append_date_field = append_date_fields_by_tab_name.get(tab_name)
+            if append_date_field is None:
+                values_df.to_pickle(
+                    get_snapshot_path(
+                        snapshot_directory=snapshot_directory,
+                        workbook_key=workbook_key,
+                        tab_name=tab_name,
+                    )
+                )
+                continue
+
+            num_rows_by_date = (
+                dfs_by_tab_name[tab_name][append_date_field].value_counts().sort_index()
+            )
+            with open(
+                get_snapshot_path(
+                    snapshot_directory=snapshot_directory,
+                    workbook_key=workbook_key,
+                    tab_name=tab_name,
+                    extension="json",
+                ),
+                "w",
+            ) as file:
+                json.dump(
+                    {
+                        "columns": list(values_df.columns),
+                        "num_rows_by_date": [
+                            [date.isoformat(), int(num_rows)]
+                            for date, num_rows in num_rows_by_date.items()
+                        ],
+                    },
+                    file,
+                )
+
+    return plans
+
+
+def get_snapshot_path(snapshot_directory, workbook_key, tab_name, extension="pkl"):
+    snapshot_key = hashlib.sha256(
+        f"{workbook_key}\n{tab_name}".encode("utf-8")
+    ).hexdigest()
+    return os.path.join(snapshot_directory, f"{snapshot_key}.{extension}")
+
+
+def _read_num_rows_by_date(path, columns):
+    """Reads the number of rows of each date uploaded to a tab in append mode, or `None` if its columns changed."""
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file:
+        snapshot = json.load(file)
+    if snapshot["columns"] != list(columns):
+        return None
+
+    return {
+        pd.Timestamp(date): num_rows for date, num_rows in snapshot["num_rows_by_date"]
+    }
+
+
+def open_google_workbook(workbook_key, credentials):
+    import gspread
+
+    return gspread.authorize(credentials).open_by_key(workbook_key)
+
+
+def _update_workbook(
+    workbook_key, open_workbook, values_dfs_by_tab_name, changed_blocks_by_tab_name
+):
+    workbook = open_workbook(workbook_key)
+    sheet_properties_by_tab_name = {
+        worksheet.title: {
+            "sheetId": worksheet.id,
+            "rowCount": worksheet.row_count,
+            "columnCount": worksheet.col_count,
+        }
+        for worksheet in workbook.worksheets()
+    }
+
+    requests = build_workbook_update_requests(
+        sheet_properties_by_tab_name=sheet_properties_by_tab_name,
+        values_dfs_by_tab_name=values_dfs_by_tab_name,
+        changed_blocks_by_tab_name=changed_blocks_by_tab_name,
+    )
+    logger.info(
+        f"Writing {count_updated_cells(requests)} cells in {len(requests)} requests..."
+    )
+    workbook.batch_update({"requests": requests})
+
+
+class Sink:
+    """Writes the dataframes of a workbook, by tab name, to an output.
+
+    Tabs in `append_date_fields_by_tab_name` hold history that grows by the given date field, which sinks may use to
+    only write recent rows (see `post_dataframes_to_google_sheets`).
+    """
+
+    def write(self, workbook_key, dfs_by_tab_name, append_date_fields_by_tab_name=None):
+        raise NotImplementedError()
+
+
+class GoogleSheetsSink(Sink):
+    """Uploads to Google Sheets with `post_dataframes_to_google_sheets`, pacing all uploads with one scheduler.
+
+    Either pass `credentials`, or a `credential_file_path` to load them from on the first upload.
+    """
+
+    def __init__(
+        self,
+        credentials=None,
+        snapshot_directory=None,
+        scheduler=None,
+        revision_window=DEFAULT_REVISION_WINDOW,
+        cell_budget=DEFAULT_TAB_CELL_BUDGET,
+        float_precision=None,
+        credential_file_path=None,
+    ):
+        self.credentials = credentials
+        self.credential_file_path = credential_file_path
+        self.snapshot_directory = snapshot_directory
+        self.scheduler = scheduler if scheduler is not None else UploadScheduler()
+        self.revision_window = revision_window
+        self.cell_budget = cell_budget
+        self.float_precision = float_precision
+        self.open_workbook = None
+        self._credentials_lock = threading.Lock()
+
+    def get_credentials(self):
+        with self._credentials_lock:
+            if self.credentials is None and self.credential_file_path is not None:
+                self.credentials = get_sheets_credentials(
+                    credential_file_path=self.credential_file_path
+                )
+        return self.credentials
+
+    def write(self, workbook_key, dfs_by_tab_name, append_date_fields_by_tab_name=None):
+        return post_dataframes_to_google_sheets(
+            dfs_by_tab_name=dfs_by_tab_name,
+            workbook_key=workbook_key,
+            credentials=self.get_credentials(),
+            snapshot_directory=self.snapshot_directory,
+            scheduler=self.scheduler,
+            open_workbook=self.open_workbook,
+            append_date_fields_by_tab_name=append_date_fields_by_tab_name,
+            revision_window=self.revision_window,
+            cell_budget=self.cell_budget,
+            float_precision=self.float_precision,
+        )
+
+
+class FakeSheetsSink(GoogleSheetsSink):
+    """Uploads to a running `FakeSheetsServer` instead of Google Sheets, through the same load path."""
+
+    def __init__(
+        self,
+        fake_sheets,
+        snapshot_directory=None,
+        scheduler=None,
+        revision_window=DEFAULT_REVISION_WINDOW,
+        cell_budget=DEFAULT_TAB_CELL_BUDGET,
+        float_precision=None,
+    ):
+        super().__init__(
+            credentials=None,
+            snapshot_directory=snapshot_directory,
+            scheduler=scheduler,
+            revision_window=revision_window,
+            cell_budget=cell_budget,
+            float_precision=float_precision,
+        )
+        self.fake_sheets = fake_sheets
+        self.open_workbook = fake_sheets.open_workbook
+
+
+class _DirectorySink(Sink):
+    """Writes each tab to `<directory>/<workbook key>/<tab name>.<extension>`."""
+
+    extension = None
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, workbook_key, dfs_by_tab_name, append_date_fields_by_tab_name=None):
+        workbook_directory = os.path.join(self.directory, workbook_key)
+        os.makedirs(workbook_directory, exist_ok=True)
+        for tab_name, df in dfs_by_tab_name.items():
+            path = os.path.join(workbook_directory, f"{tab_name}.{self.extension}")
+            with span("write_file", path=path) as span_:
+                span_.record_dataframe(df)
+                self.write_file(df=df, path=path)
+
+    def write_file(self, df, path):
+        raise NotImplementedError()
+
+
+class ParquetSink(_DirectorySink):
+    extension = "parquet"
+
+    def write_file(self, df, path):
+        df.to_parquet(path, index=False)
+
+
+class CsvSink(_DirectorySink):
+    extension = "csv"
+
+    def write_file(self, df, path):
+        df.to_csv(path, index=False)
+
+
+class SqliteSink(Sink):
+    """Writes each tab to the table `<workbook key>/<tab name>` of the SQLite database at `path`, replacing it."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, workbook_key, dfs_by_tab_name, append_date_fields_by_tab_name=None):
+        connection = sqlite3.connect(self.path)
+        try:
+            for tab_name, df in dfs_by_tab_name.items():
+                table_name = f"{workbook_key}/{tab_name}"
+                with span("write_table", table_name=table_name) as span_:
+                    span_.record_dataframe(df)
+                    df.to_sql(
+                        table_name, con=connection, if_exists="replace", index=False
+                    )
+        finally:
+            connection.close()
+
+
+def get_sheets_credentials(credential_file_path):
+    """Loads service account credentials for Google Sheets and Drive from a key file."""
+    # Import the Google client libraries here rather than at module load, since they are slow to import and only
+    # needed when uploading.
+    from oauth2client.service_account import ServiceAccountCredentials
+
     scope = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive",
     ]
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        credential_file_path, scope
-    )
+    return ServiceAccountCredentials.from_json_keyfile_name(credential_file_path, scope)
+
+
+# TODO(lbrown): this was created when I was using the Sheets API, at this point we may only need the credentials.
+def get_sheets_client(credential_file_path):
+    import gspread
+
+    credentials = get_sheets_credentials(credential_file_path=credential_file_path)
     client = gspread.authorize(credentials)
 
     return client, credentials
@@ -0,0 +1,219 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from covid.fake_sheets import FakeSheetsServer
+from covid.load import CsvSink
+from covid.load import FakeSheetsSink
+from covid.load import ParquetSink
+from covid.load import SqliteSink
+
+
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            data={"State": ["Alaska", "Alabama"], "a": [1.5, np.nan], "b": [1, 2]}
+        )
+
+    def test_local_sinks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ParquetSink(directory=directory).write(
+                workbook_key="workbook", dfs_by_tab_name={"State Summary": self.df}
+            )
+            assert_frame_equal(
+                pd.read_parquet(
+                    os.path.join(directory, "workbook", "State Summary.parquet")
+                ),
+                self.df,
+            )
+
+            CsvSink(directory=directory).write(
+                workbook_key="workbook", dfs_by_tab_name={"State Summary": self.df}
+            )
+            assert_frame_equal(
+                pd.read_csv(os.path.join(directory, "workbook", "State Summary.csv")),
+                self.df,
+            )
+
+            path = os.path.join(directory, "output.db")
+            SqliteSink(path=path).write(
+                workbook_key="workbook", dfs_by_tab_name={"State Summary": self.df}
+            )
+            connection = sqlite3.connect(path)
+            try:
+                assert_frame_equal(
+                    pd.read_sql('SELECT * FROM "workbook/State Summary"', connection),
+                    self.df,
+                )
+            finally:
+                connection.close()
+
+    def test_fake_sheets_sink(self):
+        with FakeSheetsServer() as fake_sheets, tempfile.TemporaryDirectory() as snapshot_directory:
+            sink = FakeSheetsSink(
+                fake_sheets=fake_sheets, snapshot_directory=snapshot_directory
+            )
+            sink.write(
+                workbook_key="workbook",
+                dfs_by_tab_name={"State Summary": self.df, "Other": self.df},
+            )
+            sink.write(
+                workbook_key="workbook",
+                dfs_by_tab_name={"State Summary": self.df.assign(b=[1, 3])},
+            )
+
+            self.assertEqual(
+                fake_sheets.get_values(
+                    workbook_key="workbook", tab_name="State Summary"
+                ),
+                [["State", "a", "b"], ["Alaska", "1.5", "1"], ["Alabama", "", "3"]],
+            )
+
+            # Each write lists the tabs and sends one batch; the second batch only holds the changed cell.
+            self.assertEqual(
+                fake_sheets.num_requests_by_endpoint, {"get": 2, "batchUpdate": 2}
+            )
+            self.assertLess(
+                fake_sheets.batch_update_sizes[1], fake_sheets.batch_update_sizes[0]
+            )
+
+    def write_history_in_append_mode(self, fake_sheets, history_dfs):
+        with tempfile.TemporaryDirectory() as snapshot_directory:
+            sink = FakeSheetsSink(
+                fake_sheets=fake_sheets,
+                snapshot_directory=snapshot_directory,
+                revision_window=datetime.timedelta(weeks=0),
+            )
+            for df in history_dfs:
+                sink.write(
+                    workbook_key="workbook",
+                    dfs_by_tab_name={"All State Data": df},
+                    append_date_fields_by_tab_name={"All State Data": "date"},
+                )
+
+        return fake_sheets.get_values(
+            workbook_key="workbook", tab_name="All State Data"
+        )
+
+    def test_fake_sheets_sink_in_append_mode(self):
+        history_df = pd.DataFrame(
+            data={
+                "state": ["Alaska", "Alabama", "Alaska", "Alabama"],
+                "date": pd.to_datetime(
+                    ["2020-09-05", "2020-09-05", "2020-09-12", "2020-09-12"]
+                ),
+                "value": [1, 3, 2, 4],
+            }
+        )
+        new_history_df = pd.concat(
+            [
+                history_df.assign(value=[10, 30, 2, 40]),
+                pd.DataFrame(
+                    data={
+                        "state": ["Alaska", "Alabama"],
+                        "date": pd.to_datetime(["2020-09-19", "2020-09-19"]),
+                        "value": [5, 6],
+                    }
+                ),
+            ]
+        )
+
+        # Only rows from the previous latest date onwards were rewritten, so the revised values of the first week were
+        # not uploaded.
+        with FakeSheetsServer() as fake_sheets:
+            self.assertEqual(
+                self.write_history_in_append_mode(
+                    fake_sheets=fake_sheets, history_dfs=[history_df, new_history_df]
+                ),
+                [
+                    ["state", "date", "value"],
+                    ["Alaska", "2020-09-05 00:00:00", "1"],
+                    ["Alabama", "2020-09-05 00:00:00", "3"],
+                    ["Alaska", "2020-09-12 00:00:00", "2"],
+                    ["Alabama", "2020-09-12 00:00:00", "40"],
+                    ["Alaska", "2020-09-19 00:00:00", "5"],
+                    ["Alabama", "2020-09-19 00:00:00", "6"],
+                ],
+            )
+
+    def test_fake_sheets_sink_in_append_mode_with_rows_ordered_by_state(self):
+        history_df = pd.DataFrame(
+            data={
+                "state": ["Alabama", "Alabama", "Alaska", "Alaska"],
+                "date": pd.to_datetime(
+                    ["2020-09-05", "2020-09-12", "2020-09-05", "2020-09-12"]
+                ),
+                "value": [1, 2, 3, 4],
+            }
+        )
+        new_history_df = pd.DataFrame(
+            data={
+                "state": ["Alabama"] * 3 + ["Alaska"] * 3,
+                "date": pd.to_datetime(["2020-09-05", "2020-09-12", "2020-09-19"] * 2),
+                "value": [10, 2, 5, 3, 4, 6],
+            }
+        )
+
+        # New weeks can't be appended without reordering the rows, so the tab is rewritten in full, in its order.
+        with FakeSheetsServer() as fake_sheets:
+            self.assertEqual(
+                self.write_history_in_append_mode(
+                    fake_sheets=fake_sheets, history_dfs=[history_df, new_history_df]
+                ),
+                [
+                    ["state", "date", "value"],
+                    ["Alabama", "2020-09-05 00:00:00", "10"],
+                    ["Alabama", "2020-09-12 00:00:00", "2"],
+                    ["Alabama", "2020-09-19 00:00:00", "5"],
+                    ["Alaska", "2020-09-05 00:00:00", "3"],
+                    ["Alaska", "2020-09-12 00:00:00", "4"],
+                    ["Alaska", "2020-09-19 00:00:00", "6"],
+                ],
+            )
+
+    def test_fake_sheets_sink_in_append_mode_without_snapshots(self):
+        history_df = pd.DataFrame(
+            data={
+                "state": ["Alaska", "Alaska", "Alabama"],
+                "date": pd.to_datetime(["2020-09-05", "2020-09-12", "2020-09-05"]),
+                "value": [1, 2, 3],
+            }
+        )
+
+        # Without snapshots, there is no append upload, so the rows keep their order.
+        with FakeSheetsServer() as fake_sheets:
+            FakeSheetsSink(fake_sheets=fake_sheets).write(
+                workbook_key="workbook",
+                dfs_by_tab_name={"All State Data": history_df},
+                append_date_fields_by_tab_name={"All State Data": "date"},
+            )
+
+            self.assertEqual(
+                fake_sheets.get_values(
+                    workbook_key="workbook", tab_name="All State Data"
+                ),
+                [
+                    ["state", "date", "value"],
+                    ["Alaska", "2020-09-05 00:00:00", "1"],
+                    ["Alaska", "2020-09-12 00:00:00", "2"],
+                    ["Alabama", "2020-09-05 00:00:00", "3"],
+                ],
+            )
+
+    def test_fake_sheets_sink_with_cell_budget(self):
+        with FakeSheetsServer() as fake_sheets:
+            plans = FakeSheetsSink(
+                fake_sheets=fake_sheets, cell_budget=6, float_precision=0
+            ).write(workbook_key="workbook", dfs_by_tab_name={"Tab": self.df})
+
+            self.assertEqual(plans[0]["shard_tab_names"], ["Tab (1)", "Tab (2)"])
+            self.assertEqual(
+                fake_sheets.get_values(workbook_key="workbook", tab_name="Tab (2)"),
+                [["State", "a", "b"], ["Alabama", "", "2"]],
+            )
@@ -1,8 +1,442 @@
+import logging
+import threading
 import time
 
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
 SECONDS_TO_SLEEP = 20
 
+# Define the Sheets API write quota (per user) and a budget for the number of cells written, which keeps large
+# uploads from being sent back to back.
+SHEETS_REQUESTS_PER_MINUTE = 60
+SHEETS_CELLS_WRITTEN_PER_MINUTE = 1000000
+
+# Define the maximum number of cells of a workbook, and the default budget of cells per tab above which tabs are
+# sharded.
+SHEETS_MAX_CELLS_PER_WORKBOOK = 10000000
+DEFAULT_TAB_CELL_BUDGET = 2000000
+
+# Define the number of bytes that each cell adds to an `updateCells` request besides its value, i.e. the length of
+# `{"userEnteredValue": {"stringValue": ""}}, `.
+UPDATE_CELLS_NUM_BYTES_PER_CELL = 43
+
+# Define the response status codes that mean a request should be retried after backing off.
+RETRYABLE_STATUS_CODES = (429, 503)
+MAX_RETRIES = 5
+INITIAL_BACKOFF_SECONDS = 2
+
 
 def sleep_and_log(seconds=SECONDS_TO_SLEEP):
     print(f"Sleeping for {seconds} seconds between posts...")
     time.sleep(seconds)
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled continuously at `refill_per_second`."""
+
+    def __init__(self, capacity, refill_per_second, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.clock = clock
+        self.tokens = capacity
+        self.last_refill_time = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.last_refill_time) * self.refill_per_second,
+        )
+        self.last_refill_time = now
+
+    def seconds_until_available(self, amount):
+        """Returns how long to wait until `amount` tokens (at most `capacity`) can be taken."""
+        self._refill()
+        missing_tokens = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing_tokens / self.refill_per_second)
+
+    def take(self, amount):
+        # Amounts over the capacity empty the bucket, so that the next caller waits for it to refill.
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class UploadScheduler:
+    """Paces uploads to stay within the Sheets API request and cell-write budgets.
+
+    Each upload first waits for both token buckets to hold its (estimated) number of requests and cells, so the next
+    upload starts as soon as budget is available instead of after a fixed pause. Uploads that fail with a 429 or 503
+    response are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=SHEETS_REQUESTS_PER_MINUTE,
+        cells_per_minute=SHEETS_CELLS_WRITTEN_PER_MINUTE,
+        max_retries=MAX_RETRIES,
+        initial_backoff_seconds=INITIAL_BACKOFF_SECONDS,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.request_bucket = TokenBucket(
+            capacity=requests_per_minute,
+            refill_per_second=requests_per_minute / 60,
+            clock=clock,
+        )
+        self.cell_bucket = TokenBucket(
+            capacity=cells_per_minute,
+            refill_per_second=cells_per_minute / 60,
+            clock=clock,
+        )
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.sleep = sleep
+        self._lock = threading.Lock()
+
+    def acquire(self, num_requests=1, num_cells=0):
+        """Waits until `num_requests` requests writing `num_cells` cells are within budget, and uses that budget.
+
+        This is safe to call from several threads.
+        """
+        while True:
+            with self._lock:
+                seconds_to_wait = max(
+                    self.request_bucket.seconds_until_available(num_requests),
+                    self.cell_bucket.seconds_until_available(num_cells),
+                )
+                if seconds_to_wait <= 0:
+                    self.request_bucket.take(num_requests)
+                    self.cell_bucket.take(num_cells)
+                    return
+
+            logger.info(f"Waiting {seconds_to_wait:.1f} seconds for upload quota...")
+            self.sleep(seconds_to_wait)
+
+    def call(self, func, num_requests=1, num_cells=0):
+        """Calls `func` once its budget is available, retrying with exponential backoff on 429 and 503 responses."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(num_requests=num_requests, num_cells=num_cells)
+            try:
+                return func()
+            except Exception as error:
+                status_code = get_response_status_code(error)
+                if (
+                    status_code not in RETRYABLE_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    raise
+
+                backoff_seconds = self.initial_backoff_seconds * 2 ** attempt
+                logger.warning(
+                    f"Received status {status_code}, retrying in {backoff_seconds} seconds..."
+                )
+                self.sleep(backoff_seconds)
+
+
+def get_response_status_code(error):
+    """Returns the HTTP status code of the response attached to `error` (as with `requests` and `gspread` errors)."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def convert_dataframe_to_cell_values(df):
+    """Converts every value to the string that is uploaded to its cell, as `df2gspread.upload` does."""
+    return df.apply(lambda column: column.map(str))
+
+
+def plan_tab_upload(values_df, tab_name, cell_budget=None):
+    """Plans the upload of the cell values of a tab, sharding it if it has more cells than `cell_budget`.
+
+    Tall tabs are sharded by rows, and wide tabs into column groups that each repeat the first column (e.g. the state).
+    Shards are uploaded to tabs numbered from 1 (e.g. `All State Data (1)`).
+
+    Returns the cell values of each tab to upload, by tab name, and a report of the tab's size: its numbers of rows,
+    columns and cells (including the header row) and the estimated number of bytes of its upload.
+    """
+    num_rows = len(values_df) + 1
+    num_columns = len(values_df.columns)
+    num_cells = num_rows * num_columns
+    num_bytes = (
+        int(values_df.apply(lambda column: column.str.len().sum()).sum())
+        + sum(len(str(column)) for column in values_df.columns)
+        + num_cells * UPDATE_CELLS_NUM_BYTES_PER_CELL
+    )
+
+    if cell_budget is None or num_cells <= cell_budget:
+        shards = [values_df]
+    elif num_rows >= num_columns:
+        num_rows_per_shard = max(1, cell_budget // num_columns - 1)
+        shards = [
+            values_df.iloc[start : start + num_rows_per_shard].reset_index(drop=True)
+            for start in range(0, len(values_df), num_rows_per_shard)
+        ]
+    else:
+        num_columns_per_shard = max(1, cell_budget // num_rows - 1)
+        key_column = values_df.columns[0]
+        other_columns = list(values_df.columns[1:])
+        shards = [
+            values_df.loc[
+                :, [key_column] + other_columns[start : start + num_columns_per_shard]
+            ]
+            for start in range(0, len(other_columns), num_columns_per_shard)
+        ]
+
+    values_dfs_by_tab_name = (
+        {tab_name: values_df}
+        if len(shards) == 1
+        else {f"{tab_name} ({index + 1})": shard for index, shard in enumerate(shards)}
+    )
+    plan = {
+        "tab_name": tab_name,
+        "num_rows": num_rows,
+        "num_columns": num_columns,
+        "num_cells": num_cells,
+        "num_bytes": num_bytes,
+        "shard_tab_names": list(values_dfs_by_tab_name),
+    }
+    return values_dfs_by_tab_name, plan
+
+
+def calculate_changed_blocks(previous_values_df, values_df, first_row_index=1):
+    """Calculates the blocks of cells that must be updated for a tab showing `previous_values_df` to show `values_df`.
+
+    Both frames must have the same columns and hold cell values (see `convert_dataframe_to_cell_values`); rows are
+    matched by position, with row `0` of the frames on the 0-indexed sheet row `first_row_index` (i.e. below a header
+    row). Rows that are only in `previous_values_df` are blanked. Within each changed row, the span from the first to
+    the last changed cell is updated; consecutive rows with the same span are combined into one block.
+
+    Returns a list of `{"row_index": ..., "column_index": ..., "values": ...}` dictionaries, with the 0-indexed sheet
+    position of the top-left cell of each block.
+    """
+    num_rows = max(len(previous_values_df), len(values_df))
+    num_columns = len(values_df.columns)
+
+    previous_values = np.full(
+        shape=(num_rows, num_columns), fill_value="", dtype=object
+    )
+    previous_values[: len(previous_values_df)] = previous_values_df.values
+    values = np.full(shape=(num_rows, num_columns), fill_value="", dtype=object)
+    values[: len(values_df)] = values_df.values
+
+    is_changed = previous_values != values
+    changed_rows = np.flatnonzero(is_changed.any(axis=1))
+    first_changed_columns = is_changed.argmax(axis=1)
+    last_changed_columns = num_columns - 1 - is_changed[:, ::-1].argmax(axis=1)
+
+    blocks = []
+    block_start_row = None
+    for row_index, row in enumerate(changed_rows):
+        span = (first_changed_columns[row], last_changed_columns[row])
+        if block_start_row is None:
+            block_start_row = row
+
+        # Extend the block while the next changed row directly follows this one with the same span.
+        next_row = (
+            changed_rows[row_index + 1] if row_index + 1 < len(changed_rows) else None
+        )
+        if (
+            next_row == row + 1
+            and (first_changed_columns[next_row], last_changed_columns[next_row])
+            == span
+        ):
+            continue
+
+        blocks.append(
+            {
+                "row_index": first_row_index + int(block_start_row),
+                "column_index": int(span[0]),
+                "values": values[
+                    block_start_row : row + 1, span[0] : span[1] + 1
+                ].tolist(),
+            }
+        )
+        block_start_row = None
+
+    return blocks
+
+
+def build_add_sheet_request(sheet_id, tab_name, num_rows, num_columns):
+    return {
+        "addSheet": {
+            "properties": {
+                "sheetId": sheet_id,
+                "title": tab_name,
+                "gridProperties": {"rowCount": num_rows, "columnCount": num_columns},
+            }
+        }
+    }
+
+
+def build_resize_sheet_request(sheet_id, num_rows, num_columns):
+    return {
+        "updateSheetProperties": {
+            "properties": {
+                "sheetId": sheet_id,
+                "gridProperties": {"rowCount": num_rows, "columnCount": num_columns},
+            },
+            "fields": "gridProperties.rowCount,gridProperties.columnCount",
+        }
+    }
+
+
+def build_update_cells_request(sheet_id, row_index, column_index, values):
+    """Builds a request writing the rows of string `values`, with the top-left value at the 0-indexed position."""
+    return {
+        "updateCells": {
+            "start": {
+                "sheetId": sheet_id,
+                "rowIndex": row_index,
+                "columnIndex": column_index,
+            },
+            "rows": [
+                {
+                    "values": [
+                        {"userEnteredValue": {"stringValue": value}} for value in row
+                    ]
+                }
+                for row in values
+            ],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def count_updated_cells(requests):
+    """Counts the cells written by the `updateCells` requests of a `spreadsheets.batchUpdate` request body."""
+    return sum(
+        len(row["values"])
+        for request in requests
+        if "updateCells" in request
+        for row in request["updateCells"]["rows"]
+    )
+
+
+def build_workbook_update_requests(
+    sheet_properties_by_tab_name, values_dfs_by_tab_name, changed_blocks_by_tab_name
+):
+    """Builds the `spreadsheets.batchUpdate` requests that write each tab of `values_dfs_by_tab_name` to a workbook.
+
+    `sheet_properties_by_tab_name` holds the `sheetId`, `rowCount` and `columnCount` of the workbook's existing tabs.
+    Tabs whose changed blocks (see `calculate_changed_blocks`) are `None` are added if missing, resized to fit their
+    values and a header row, and written in full. Other tabs only get their changed blocks written, after adding any
+    rows needed for new data.
+    """
+    next_sheet_id = (
+        max(
+            [
+                properties["sheetId"]
+                for properties in sheet_properties_by_tab_name.values()
+            ],
+            default=0,
+        )
+        + 1
+    )
+
+    requests = []
+    for tab_name, values_df in values_dfs_by_tab_name.items():
+        changed_blocks = changed_blocks_by_tab_name[tab_name]
+        properties = sheet_properties_by_tab_name.get(tab_name)
+        num_rows = len(values_df) + 1
+        num_columns = len(values_df.columns)
+
+        if properties is None:
+            sheet_id = next_sheet_id
+            next_sheet_id += 1
+            requests.append(
+                build_add_sheet_request(
+                    sheet_id=sheet_id,
+                    tab_name=tab_name,
+                    num_rows=num_rows,
+                    num_columns=num_columns,
+                )
+            )
+            # A new tab has no previous values to update.
+            changed_blocks = None
+        else:
+            sheet_id = properties["sheetId"]
+
+        if changed_blocks is None:
+            if properties is not None:
+                requests.append(
+                    build_resize_sheet_request(
+                        sheet_id=sheet_id, num_rows=num_rows, num_columns=num_columns
+                    )
+                )
+            requests.append(
+                build_update_cells_request(
+                    sheet_id=sheet_id,
+                    row_index=0,
+                    column_index=0,
+                    values=[[str(column) for column in values_df.columns]]
+                    + values_df.values.tolist(),
+                )
+            )
+            continue
+
+        if not changed_blocks:
+            continue
+
+        if num_rows > properties["rowCount"]:
+            requests.append(
+                build_resize_sheet_request(
+                    sheet_id=sheet_id,
+                    num_rows=num_rows,
+                    num_columns=properties["columnCount"],
+                )
+            )
+        requests.extend(
+            build_update_cells_request(
+                sheet_id=sheet_id,
+                row_index=block["row_index"],
+                column_index=block["column_index"],
+                values=block["values"],
+            )
+            for block in changed_blocks
+        )
+
+    return requests
+
+
+def calculate_appended_blocks(
+    values_df, dates, previous_num_rows_by_date, revision_window, first_row_index=1
+):
+    """Calculates the block of cells that must be updated to append `values_df` to a tab in append mode.
+
+    In append mode, rows keep their order, and new dates are appended at the bottom of the tab. `dates` holds the date
+    of each row of `values_df`, and `previous_num_rows_by_date` the number of rows of each date previously uploaded.
+    Rows dated on or after the latest previous date (the watermark) minus `revision_window` are rewritten, and previous
+    rows past them are blanked; earlier rows are assumed unchanged.
+
+    Returns a list of at most one block (see `calculate_changed_blocks`), or `None` if the rewritten rows are not all
+    at the bottom of `values_df` (e.g. when rows are ordered by state rather than by date) or the number of earlier rows
+    changed, in which case the tab must be rewritten in full.
+    """
+    revision_start = max(previous_num_rows_by_date) - revision_window
+    num_kept_rows = sum(
+        num_rows
+        for date, num_rows in previous_num_rows_by_date.items()
+        if date < revision_start
+    )
+    is_rewritten = (dates >= revision_start).values
+    if len(values_df) - is_rewritten.sum() != num_kept_rows or not all(
+        is_rewritten[num_kept_rows:]
+    ):
+        return None
+
+    values = values_df.values[is_rewritten].tolist()
+    num_blank_rows = (
+        sum(previous_num_rows_by_date.values()) - num_kept_rows - len(values)
+    )
+    values.extend([[""] * len(values_df.columns)] * max(0, num_blank_rows))
+    if not values:
+        return []
+
+    return [
+        {
+            "row_index": first_row_index + num_kept_rows,
+            "column_index": 0,
+            "values": values,
+        }
+    ]
@@ -0,0 +1,312 @@
+import datetime
+import functools
+import unittest
+
+import pandas as pd
+import requests
+
+from covid.fake_sheets import FakeSheetsServer
+from covid.load_utils import build_add_sheet_request
+from covid.load_utils import build_update_cells_request
+from covid.load_utils import build_workbook_update_requests
+from covid.load_utils import calculate_appended_blocks
+from covid.load_utils import calculate_changed_blocks
+from covid.load_utils import plan_tab_upload
+from covid.load_utils import UploadScheduler
+
+
+class _FakeClock:
+    """A clock that only moves forward when slept on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class LoadUtilsTest(unittest.TestCase):
+    def test_calculate_changed_blocks(self):
+        previous_values_df = pd.DataFrame(
+            data=[
+                ["Alaska", "1", "2", "3"],
+                ["Alabama", "4", "5", "6"],
+                ["Arizona", "7", "8", "9"],
+                ["Guam", "0", "0", "0"],
+            ],
+            columns=["State", "a", "b", "c"],
+        )
+        values_df = pd.DataFrame(
+            data=[
+                ["Alaska", "1", "2", "3"],
+                ["Alabama", "4", "50", "60"],
+                ["Arizona", "7", "80", "90"],
+            ],
+            columns=["State", "a", "b", "c"],
+        )
+
+        # Consecutive rows with the same changed span are combined, and rows that were removed are blanked.
+        self.assertEqual(
+            calculate_changed_blocks(
+                previous_values_df=previous_values_df, values_df=values_df
+            ),
+            [
+                {
+                    "row_index": 2,
+                    "column_index": 2,
+                    "values": [["50", "60"], ["80", "90"]],
+                },
+                {"row_index": 4, "column_index": 0, "values": [["", "", "", ""]]},
+            ],
+        )
+
+        self.assertEqual(
+            calculate_changed_blocks(previous_values_df=values_df, values_df=values_df),
+            [],
+        )
+
+    def test_calculate_appended_blocks(self):
+        dates = pd.Series(
+            pd.to_datetime(["2020-09-05", "2020-09-12", "2020-09-12", "2020-09-19"])
+        )
+        values_df = pd.DataFrame(data={"value": ["1", "2", "3", "4"]})
+
+        # Rows from the watermark onwards are rewritten.
+        self.assertEqual(
+            calculate_appended_blocks(
+                values_df=values_df,
+                dates=dates,
+                previous_num_rows_by_date={
+                    pd.Timestamp("2020-09-05"): 1,
+                    pd.Timestamp("2020-09-12"): 2,
+                },
+                revision_window=datetime.timedelta(weeks=0),
+            ),
+            [{"row_index": 2, "column_index": 0, "values": [["2"], ["3"], ["4"]]}],
+        )
+
+        # Previous rows past the rewritten ones are blanked.
+        self.assertEqual(
+            calculate_appended_blocks(
+                values_df=values_df.iloc[:3],
+                dates=dates.iloc[:3],
+                previous_num_rows_by_date={
+                    pd.Timestamp("2020-09-05"): 1,
+                    pd.Timestamp("2020-09-12"): 4,
+                },
+                revision_window=datetime.timedelta(weeks=0),
+            ),
+            [{"row_index": 2, "column_index": 0, "values": [["2"], ["3"], [""], [""]]}],
+        )
+
+        # Tabs whose rewritten rows aren't at the bottom must be rewritten in full, rather than reordered.
+        self.assertIsNone(
+            calculate_appended_blocks(
+                values_df=values_df,
+                dates=dates.iloc[[1, 0, 2, 3]],
+                previous_num_rows_by_date={
+                    pd.Timestamp("2020-09-05"): 1,
+                    pd.Timestamp("2020-09-12"): 2,
+                },
+                revision_window=datetime.timedelta(weeks=0),
+            )
+        )
+
+        # Tabs whose earlier rows changed in number must be rewritten in full.
+        self.assertIsNone(
+            calculate_appended_blocks(
+                values_df=values_df,
+                dates=dates,
+                previous_num_rows_by_date={
+                    pd.Timestamp("2020-09-05"): 2,
+                    pd.Timestamp("2020-09-12"): 2,
+                },
+                revision_window=datetime.timedelta(weeks=0),
+            )
+        )
+
+    def test_plan_tab_upload(self):
+        values_df = pd.DataFrame(
+            data={"State": ["Alaska", "Alabama", "Arizona"], "a": ["1", "2", "3"]}
+        )
+
+        values_dfs_by_tab_name, plan = plan_tab_upload(
+            values_df=values_df, tab_name="Tab", cell_budget=8
+        )
+        self.assertEqual(list(values_dfs_by_tab_name), ["Tab"])
+        self.assertEqual(
+            plan,
+            {
+                "tab_name": "Tab",
+                "num_rows": 4,
+                "num_columns": 2,
+                "num_cells": 8,
+                "num_bytes": 23 + 6 + 8 * 43,
+                "shard_tab_names": ["Tab"],
+            },
+        )
+
+        # Tall tabs are sharded by rows.
+        values_dfs_by_tab_name, _ = plan_tab_upload(
+            values_df=values_df, tab_name="Tab", cell_budget=6
+        )
+        self.assertEqual(list(values_dfs_by_tab_name), ["Tab (1)", "Tab (2)"])
+        self.assertEqual(
+            values_dfs_by_tab_name["Tab (2)"].values.tolist(), [["Arizona", "3"]]
+        )
+
+        # Wide tabs are sharded into column groups, which repeat the first column.
+        wide_values_df = pd.DataFrame(
+            data={"State": ["Alaska"], "a": ["1"], "b": ["2"], "c": ["3"]}
+        )
+        values_dfs_by_tab_name, _ = plan_tab_upload(
+            values_df=wide_values_df, tab_name="Tab", cell_budget=6
+        )
+        self.assertEqual(
+            [list(shard.columns) for shard in values_dfs_by_tab_name.values()],
+            [["State", "a", "b"], ["State", "c"]],
+        )
+
+    def test_build_workbook_update_requests(self):
+        first_df = pd.DataFrame(data={"State": ["Alaska", "Alabama"], "a": ["1", "2"]})
+        second_df = pd.DataFrame(data={"State": ["Alaska"], "b": ["3"]})
+
+        with FakeSheetsServer(
+            requests_per_minute=60, cells_per_minute=1000
+        ) as fake_sheets:
+
+            def update_workbook(values_dfs_by_tab_name, changed_blocks_by_tab_name):
+                requests.post(
+                    fake_sheets.batch_update_url.format(workbook_key="workbook"),
+                    json={
+                        "requests": build_workbook_update_requests(
+                            sheet_properties_by_tab_name=fake_sheets.get_sheet_properties_by_tab_name(
+                                "workbook"
+                            ),
+                            values_dfs_by_tab_name=values_dfs_by_tab_name,
+                            changed_blocks_by_tab_name=changed_blocks_by_tab_name,
+                        )
+                    },
+                ).raise_for_status()
+
+            # Both tabs are added and written in full in one batch.
+            update_workbook(
+                values_dfs_by_tab_name={"First": first_df, "Second": second_df},
+                changed_blocks_by_tab_name={"First": None, "Second": None},
+            )
+            self.assertEqual(fake_sheets.num_accepted_requests, 1)
+            self.assertEqual(
+                fake_sheets.get_values(workbook_key="workbook", tab_name="First"),
+                [["State", "a"], ["Alaska", "1"], ["Alabama", "2"]],
+            )
+
+            # Only changed cells are written to the first tab (adding a row), and the second tab is resized to fit.
+            new_first_df = pd.DataFrame(
+                data={"State": ["Alaska", "Alabama", "Arizona"], "a": ["1", "5", "6"]}
+            )
+            new_second_df = pd.DataFrame(data={"State": ["Alaska", "Guam"]})
+            update_workbook(
+                values_dfs_by_tab_name={"First": new_first_df, "Second": new_second_df},
+                changed_blocks_by_tab_name={
+                    "First": calculate_changed_blocks(
+                        previous_values_df=first_df, values_df=new_first_df
+                    ),
+                    "Second": None,
+                },
+            )
+            self.assertEqual(fake_sheets.num_accepted_requests, 2)
+            self.assertEqual(
+                fake_sheets.get_values(workbook_key="workbook", tab_name="First"),
+                [["State", "a"], ["Alaska", "1"], ["Alabama", "5"], ["Arizona", "6"]],
+            )
+            self.assertEqual(
+                fake_sheets.get_values(workbook_key="workbook", tab_name="Second"),
+                [["State"], ["Alaska"], ["Guam"]],
+            )
+
+    def test_upload_scheduler(self):
+        clock = _FakeClock()
+        scheduler = UploadScheduler(
+            requests_per_minute=60,
+            cells_per_minute=1000,
+            clock=clock.time,
+            sleep=clock.sleep,
+        )
+
+        # The first uploads fit in the cell budget; the next one waits for 400 more cells to be refilled.
+        scheduler.acquire(num_requests=1, num_cells=600)
+        scheduler.acquire(num_requests=1, num_cells=400)
+        self.assertEqual(clock.now, 0)
+        scheduler.acquire(num_requests=1, num_cells=400)
+        self.assertAlmostEqual(clock.now, 24)
+
+        # Uploads larger than the budget wait for it to be full.
+        scheduler.acquire(num_requests=1, num_cells=5000)
+        self.assertAlmostEqual(clock.now, 84)
+
+        # Errors without a 429 or 503 response are not retried.
+        def fail():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            scheduler.call(func=fail)
+        self.assertAlmostEqual(clock.now, 84)
+
+    def test_upload_scheduler_with_fake_sheets(self):
+        clock = _FakeClock()
+        scheduler = UploadScheduler(
+            requests_per_minute=3,
+            cells_per_minute=100,
+            initial_backoff_seconds=10,
+            clock=clock.time,
+            sleep=clock.sleep,
+        )
+
+        def post(url, requests_):
+            requests.post(url, json={"requests": requests_}).raise_for_status()
+
+        with FakeSheetsServer(
+            requests_per_minute=3, cells_per_minute=100, clock=clock.time
+        ) as fake_sheets:
+            url = fake_sheets.batch_update_url.format(workbook_key="workbook")
+            for row_index in range(4):
+                scheduler.call(
+                    func=functools.partial(
+                        post,
+                        url=url,
+                        requests_=(
+                            [
+                                build_add_sheet_request(
+                                    sheet_id=1,
+                                    tab_name="Tab",
+                                    num_rows=4,
+                                    num_columns=2,
+                                )
+                            ]
+                            if row_index == 0
+                            else []
+                        )
+                        + [
+                            build_update_cells_request(
+                                sheet_id=1,
+                                row_index=row_index,
+                                column_index=0,
+                                values=[["a", "b"]],
+                            )
+                        ],
+                    ),
+                    num_requests=1,
+                    num_cells=2,
+                )
+
+            # The token bucket lets a request through before the fake's one-minute window has passed; it is rejected and
+            # retried with backoff until the window allows it.
+            self.assertGreater(fake_sheets.num_rejected_requests, 0)
+            self.assertGreaterEqual(clock.now, 60)
+            self.assertEqual(
+                fake_sheets.get_values(workbook_key="workbook", tab_name="Tab"),
+                [["a", "b"]] * 4,
+            )
@@ -0,0 +1,168 @@
+import collections
+import logging
+import time
+from concurrent import futures
+
+from covid.instrumentation import collect_spans
+from covid.instrumentation import record_spans
+from covid.instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# Define the kinds of nodes: CPU-bound nodes run in worker processes, and I/O-bound nodes in threads.
+NODE_KIND_PROCESS = "process"
+NODE_KIND_THREAD = "thread"
+
+# Define a step of a pipeline: `func` is called with the results of other nodes as keyword arguments, where `inputs`
+# maps each argument name to the name of the node providing it. Functions of process nodes, and their arguments and
+# results, must be picklable.
+Node = collections.namedtuple(
+    "Node", ["name", "func", "inputs", "kind"], defaults=(None, NODE_KIND_THREAD)
+)
+
+# Define the timing of a node, with its start time in seconds since the pipeline started.
+NodeTiming = collections.namedtuple(
+    "NodeTiming", ["name", "kind", "start_seconds", "duration_seconds"]
+)
+
+
+def run_pipeline(nodes, max_workers=None, available_results=None):
+    """Runs each of `nodes` once all of its inputs are available, running independent nodes concurrently.
+
+    `available_results` holds the results of nodes that already ran (e.g. in an earlier pipeline), by name.
+
+    Process nodes run in a pool of `max_workers` processes (or threads, where processes are not available), and thread
+    nodes in a pool of `max_workers` threads. The first error raised by a node stops the pipeline and is re-raised, once
+    running nodes have finished. A timing report is logged at the end.
+
+    Returns the result of each node, by name, and the timing of each node, in the order in which they started.
+    """
+    nodes_by_name = {}
+    for node in nodes:
+        if node.name in nodes_by_name:
+            raise ValueError(f"Node {node.name} is declared more than once.")
+        nodes_by_name[node.name] = node
+
+    pipeline_start_time = time.time()
+    results = dict(available_results or {})
+    timings = []
+    pending_nodes_by_name = dict(nodes_by_name)
+    node_names_by_future = {}
+
+    thread_executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    process_executor = None
+    try:
+        while pending_nodes_by_name or node_names_by_future:
+            for name, node in list(pending_nodes_by_name.items()):
+                inputs = node.inputs or {}
+                if not all(input_name in results for input_name in inputs.values()):
+                    continue
+
+                kwargs = {
+                    argument: results[input_name]
+                    for argument, input_name in inputs.items()
+                }
+                if node.kind != NODE_KIND_PROCESS:
+                    future = thread_executor.submit(
+                        _call_and_time, node=node, kwargs=kwargs
+                    )
+                else:
+                    if process_executor is None:
+                        process_executor = (
+                            start_process_executor(max_workers=max_workers)
+                            or thread_executor
+                        )
+                    future = process_executor.submit(
+                        _call_and_time,
+                        node=node,
+                        kwargs=kwargs,
+                        is_worker_process=process_executor is not thread_executor,
+                    )
+                node_names_by_future[future] = name
+                del pending_nodes_by_name[name]
+
+            if not node_names_by_future:
+                raise ValueError(
+                    f"Nodes {sorted(pending_nodes_by_name)} have missing or circular inputs."
+                )
+
+            done_futures, _ = futures.wait(
+                node_names_by_future, return_when=futures.FIRST_COMPLETED
+            )
+            for future in done_futures:
+                name = node_names_by_future.pop(future)
+                results[name], start_time, duration_seconds, spans = future.result()
+                record_spans(spans)
+                timings.append(
+                    NodeTiming(
+                        name=name,
+                        kind=nodes_by_name[name].kind,
+                        start_seconds=start_time - pipeline_start_time,
+                        duration_seconds=duration_seconds,
+                    )
+                )
+    finally:
+        thread_executor.shutdown()
+        if process_executor is not None and process_executor is not thread_executor:
+            process_executor.shutdown()
+
+    timings.sort(key=lambda timing: timing.start_seconds)
+    log_timing_report(timings=timings, total_seconds=time.time() - pipeline_start_time)
+
+    return results, timings
+
+
+def start_process_executor(max_workers=None):
+    """Starts a pool of `max_workers` worker processes, or returns `None` (with a warning) if they cannot be started.
+
+    The workers are started here, before any work is submitted, so that errors raised by the work itself are never
+    mistaken for a failure to start them.
+    """
+    try:
+        executor = futures.ProcessPoolExecutor(max_workers=max_workers)
+        executor.submit(int).result()
+    except (OSError, NotImplementedError) as error:
+        logger.warning(f"Unable to start worker processes ({error}).")
+        return None
+
+    return executor
+
+
+def select_nodes(nodes, names):
+    """Selects the nodes named `names`, and the nodes that they depend on (directly or not)."""
+    nodes_by_name = {node.name: node for node in nodes}
+    selected_names = set()
+    names_to_visit = list(names)
+    while names_to_visit:
+        name = names_to_visit.pop()
+        if name in selected_names or name not in nodes_by_name:
+            continue
+        selected_names.add(name)
+        names_to_visit.extend((nodes_by_name[name].inputs or {}).values())
+
+    return [node for node in nodes if node.name in selected_names]
+
+
+def log_timing_report(timings, total_seconds):
+    logger.info(
+        "\n".join(
+            [f"Ran {len(timings)} nodes in {total_seconds:.1f} seconds:"]
+            + [
+                f"  {timing.name:<40} {timing.kind:<8} started at {timing.start_seconds:7.1f}s, "
+                f"took {timing.duration_seconds:7.1f}s"
+                for timing in timings
+            ]
+        )
+    )
+
+
+def _call_and_time(node, kwargs, is_worker_process=False):
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    with span(node.name, kind=node.kind):
+        result = node.func(**kwargs)
+    duration_seconds = time.perf_counter() - start_counter
+
+    # Spans recorded in a worker process are returned, to record them in the metrics of the run.
+    spans = collect_spans() if is_worker_process else []
+    return result, start_time, duration_seconds, spans
@@ -0,0 +1,75 @@
+import functools
+import time
+import unittest
+
+from covid.pipeline import Node
+from covid.pipeline import NODE_KIND_PROCESS
+from covid.pipeline import run_pipeline
+from covid.pipeline import select_nodes
+
+
+def add(left, right):
+    return left + right
+
+
+def raise_os_error():
+    raise OSError("No such file.")
+
+
+def sleep_and_return(value):
+    time.sleep(0.5)
+    return value
+
+
+class PipelineTest(unittest.TestCase):
+    def test_run_pipeline(self):
+        results, timings = run_pipeline(
+            nodes=[
+                Node(name="sum", func=add, inputs={"left": "one", "right": "two"}),
+                Node(name="one", func=functools.partial(sleep_and_return, value=1)),
+                Node(name="two", func=functools.partial(sleep_and_return, value=2)),
+                Node(
+                    name="double",
+                    func=add,
+                    inputs={"left": "sum", "right": "sum"},
+                    kind=NODE_KIND_PROCESS,
+                ),
+            ]
+        )
+
+        self.assertEqual(results, {"one": 1, "two": 2, "sum": 3, "double": 6})
+        self.assertEqual([timing.name for timing in timings][2:], ["sum", "double"])
+
+        # The independent nodes ran concurrently.
+        self.assertLess(timings[1].start_seconds, timings[0].duration_seconds)
+
+    def test_run_pipeline_with_circular_inputs(self):
+        with self.assertRaises(ValueError):
+            run_pipeline(
+                nodes=[
+                    Node(name="a", func=add, inputs={"left": "b", "right": "b"}),
+                    Node(name="b", func=add, inputs={"left": "a", "right": "a"}),
+                ]
+            )
+
+    def test_run_pipeline_with_failing_process_node(self):
+        # Errors raised by a node propagate, rather than being mistaken for a failure to start worker processes.
+        with self.assertRaises(OSError):
+            run_pipeline(
+                nodes=[Node(name="fail", func=raise_os_error, kind=NODE_KIND_PROCESS)]
+            )
+
+    def test_run_pipeline_with_selected_nodes(self):
+        nodes = [
+            Node(name="one", func=functools.partial(sleep_and_return, value=1)),
+            Node(name="sum", func=add, inputs={"left": "one", "right": "two"}),
+            Node(name="double", func=add, inputs={"left": "two", "right": "two"}),
+        ]
+        selected_nodes = select_nodes(nodes=nodes, names=["sum"])
+        self.assertEqual([node.name for node in selected_nodes], ["one", "sum"])
+
+        results, timings = run_pipeline(
+            nodes=selected_nodes, available_results={"two": 2}
+        )
+        self.assertEqual(results, {"one": 1, "two": 2, "sum": 3})
+        self.assertEqual([timing.name for timing in timings], ["one", "sum"])
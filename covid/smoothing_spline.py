@@ -0,0 +1,440 @@
+"""A NumPy/SciPy implementation of R's `smooth.spline`, so that splines can be fit without an embedded R interpreter.
+
+This follows the algorithm in R's `stats` package (`smooth.spline`, `sbart.c`, `sgram.f` and `stxwx.f`) for unit
+weights and unique `x` values: a cubic B-spline basis with knots at (a subset of) the scaled `x` values, a penalty on
+the integrated squared second derivative, and the `spar` parameterization `lambda = ratio * 256 ** (3 * spar - 1)`.
+When no `spar` is given, it is chosen by minimizing the GCV criterion with the same Brent search R uses.
+
+Fitted values match R to within a relative tolerance of 1e-8 when `spar` is given (in practice, to machine precision)
+and 1e-6 when `spar` is chosen by GCV.
+"""
+import collections
+
+import numpy as np
+from scipy import interpolate as interpolate
+from scipy import linalg as linalg
+
+# Define the bounds and tolerances R uses to search for `spar` (see `control.spar` in `smooth.spline`).
+SPAR_SEARCH_LOWER_BOUND = -1.5
+SPAR_SEARCH_UPPER_BOUND = 1.5
+SPAR_SEARCH_TOLERANCE = 1e-4
+SPAR_SEARCH_EPSILON = 2e-8
+SPAR_SEARCH_MAX_ITERATIONS = 500
+
+_GOLDEN_SECTION_RATIO = 0.381966011250105151795
+_CUBIC_ORDER = 4
+_MIN_NUM_UNIQUE_X_VALUES = 4
+
+SmoothingSplineDesign = collections.namedtuple(
+    "SmoothingSplineDesign",
+    [
+        # The knot sequence on the scaled `[0, 1]` interval, including the repeated boundary knots.
+        "knots",
+        # The number of B-spline coefficients.
+        "num_coefficients",
+        # For each `x` value, the index of its first non-zero basis function, and the four basis values.
+        "basis_start_positions",
+        "basis_values",
+        # The upper bands of `X'X` and of the penalty matrix, as `(4, num_coefficients)` arrays.
+        "gram_bands",
+        "penalty_bands",
+        # The ratio of traces R uses to make `spar` scale-free.
+        "trace_ratio",
+    ],
+)
+
+
+def calculate_num_knots(num_x_values):
+    """Calculates the number of inner knots R uses by default (`.nknots.smspl`)."""
+    if num_x_values < 50:
+        return num_x_values
+
+    a1 = np.log2(50)
+    a2 = np.log2(100)
+    a3 = np.log2(140)
+    a4 = np.log2(200)
+
+    if num_x_values < 200:
+        num_knots = 2 ** (a1 + (a2 - a1) * (num_x_values - 50) / 150)
+    elif num_x_values < 800:
+        num_knots = 2 ** (a2 + (a3 - a2) * (num_x_values - 200) / 600)
+    elif num_x_values < 3200:
+        num_knots = 2 ** (a3 + (a4 - a3) * (num_x_values - 800) / 2400)
+    else:
+        num_knots = 200 + (num_x_values - 3200) ** 0.2
+
+    return int(np.trunc(num_knots))
+
+
+def evaluate_cubic_bspline_basis(knots, x, num_coefficients):
+    """Evaluates the four non-zero cubic B-spline basis functions at each `x` (de Boor's `bsplvb`).
+
+    Returns the index of the first non-zero basis function for each `x`, and an `(len(x), 4)` array of values.
+    """
+    # Find the knot interval for each value, treating the right boundary as part of the last interval.
+    intervals = np.clip(
+        np.searchsorted(knots, x, side="right") - 1,
+        _CUBIC_ORDER - 1,
+        num_coefficients - 1,
+    )
+
+    basis_values = np.zeros(shape=(len(x), _CUBIC_ORDER))
+    basis_values[:, 0] = 1.0
+    right_deltas = np.zeros(shape=(len(x), _CUBIC_ORDER - 1))
+    left_deltas = np.zeros(shape=(len(x), _CUBIC_ORDER - 1))
+
+    for j in range(_CUBIC_ORDER - 1):
+        right_deltas[:, j] = knots[intervals + j + 1] - x
+        left_deltas[:, j] = x - knots[intervals - j]
+
+        saved = np.zeros(len(x))
+        for r in range(j + 1):
+            term = basis_values[:, r] / (right_deltas[:, r] + left_deltas[:, j - r])
+            basis_values[:, r] = saved + right_deltas[:, r] * term
+            saved = left_deltas[:, j - r] * term
+        basis_values[:, j + 1] = saved
+
+    return intervals - (_CUBIC_ORDER - 1), basis_values
+
+
+def _calculate_penalty_bands(knots, num_coefficients):
+    """Calculates the bands of the matrix of integrated products of basis second derivatives (R's `sgram`)."""
+    # Second derivatives of a cubic spline are linear on each knot interval, so each interval's contribution can be
+    # integrated exactly from the values at its two ends.
+    intervals = np.arange(_CUBIC_ORDER - 1, num_coefficients)
+    left_knots = knots[intervals]
+    right_knots = knots[intervals + 1]
+
+    second_derivatives = interpolate.BSpline(
+        t=knots, c=np.eye(num_coefficients), k=_CUBIC_ORDER - 1
+    ).derivative(nu=2)
+    left_values = second_derivatives(left_knots)
+    slopes = second_derivatives(right_knots) - left_values
+    widths = (right_knots - left_knots)[:, np.newaxis]
+
+    # Note: R's `sgram` uses `.3330` rather than `1 / 3` for the quadratic term, so we do the same to reproduce it.
+    penalty = (
+        (widths * left_values).T @ left_values
+        + 0.5 * ((widths * slopes).T @ left_values + (widths * left_values).T @ slopes)
+        + 0.3330 * ((widths * slopes).T @ slopes)
+    )
+
+    return _get_upper_bands(penalty)
+
+
+def _get_upper_bands(matrix):
+    bands = np.zeros(shape=(_CUBIC_ORDER, matrix.shape[0]))
+    for offset in range(_CUBIC_ORDER):
+        bands[offset, : matrix.shape[0] - offset] = np.diagonal(matrix, offset=offset)
+
+    return bands
+
+
+def prepare_smoothing_spline(x):
+    """Builds everything about a smoothing spline fit that depends only on the (sorted, unique) `x` values.
+
+    The returned design can be reused to fit any number of `y` series observed at the same `x` values.
+    """
+    x = np.asarray(x, dtype=float)
+
+    if len(np.unique(x)) < _MIN_NUM_UNIQUE_X_VALUES:
+        raise ValueError(
+            f"Need at least {_MIN_NUM_UNIQUE_X_VALUES} unique x values to fit a smoothing spline."
+        )
+
+    if not np.all(np.diff(x) > 0):
+        raise ValueError("The x values must be sorted and unique.")
+
+    # Scale `x` to `[0, 1]`, and place knots at evenly spaced (by rank) values, as R does.
+    scaled_x = (x - x[0]) / (x[-1] - x[0])
+    num_knots = calculate_num_knots(len(x))
+    # Note: R truncates the fractional indices produced by `seq.int(1, nx, length.out = nknots)`.
+    knot_positions = np.linspace(1, len(x), num_knots).astype(int) - 1
+    knots = np.concatenate(
+        [
+            np.repeat(scaled_x[0], _CUBIC_ORDER - 1),
+            scaled_x[knot_positions],
+            np.repeat(scaled_x[-1], _CUBIC_ORDER - 1),
+        ]
+    )
+    num_coefficients = num_knots + 2
+
+    basis_start_positions, basis_values = evaluate_cubic_bspline_basis(
+        knots=knots, x=scaled_x, num_coefficients=num_coefficients
+    )
+
+    # Accumulate the bands of `X'X` (R's `stxwx`, with unit weights).
+    gram_bands = np.zeros(shape=(_CUBIC_ORDER, num_coefficients))
+    for offset in range(_CUBIC_ORDER):
+        for i in range(_CUBIC_ORDER - offset):
+            np.add.at(
+                gram_bands[offset],
+                basis_start_positions + i,
+                basis_values[:, i] * basis_values[:, i + offset],
+            )
+
+    penalty_bands = _calculate_penalty_bands(
+        knots=knots, num_coefficients=num_coefficients
+    )
+
+    # R only sums the inner diagonal entries when calculating the trace ratio.
+    trace_ratio = (
+        gram_bands[0, 2 : num_coefficients - 3].sum()
+        / penalty_bands[0, 2 : num_coefficients - 3].sum()
+    )
+
+    return SmoothingSplineDesign(
+        knots=knots,
+        num_coefficients=num_coefficients,
+        basis_start_positions=basis_start_positions,
+        basis_values=basis_values,
+        gram_bands=gram_bands,
+        penalty_bands=penalty_bands,
+        trace_ratio=trace_ratio,
+    )
+
+
+def factor_smoothing_spline(design, smoothing_parameter):
+    """Calculates the banded Cholesky factor of `X'X + lambda * penalty` for the given `spar`."""
+    smoothing_lambda = design.trace_ratio * 256.0 ** (3.0 * smoothing_parameter - 1.0)
+
+    # Convert to the upper banded storage expected by LAPACK.
+    banded_system = np.zeros(shape=(_CUBIC_ORDER, design.num_coefficients))
+    for offset in range(_CUBIC_ORDER):
+        banded_system[_CUBIC_ORDER - 1 - offset, offset:] = (
+            design.gram_bands[offset] + smoothing_lambda * design.penalty_bands[offset]
+        )[: design.num_coefficients - offset]
+
+    return linalg.cholesky_banded(banded_system)
+
+
+def solve_smoothing_spline(design, cholesky_factor, y):
+    """Fits the spline for `y` (one series, or one series per column) and returns the fitted values at `x`."""
+    y = np.asarray(y, dtype=float)
+    basis_positions = design.basis_start_positions[:, np.newaxis] + np.arange(
+        _CUBIC_ORDER
+    )
+
+    # Calculate `X'y` for every series at once.
+    weighted_y = np.zeros(shape=(design.num_coefficients,) + y.shape[1:])
+    for i in range(_CUBIC_ORDER):
+        np.add.at(
+            weighted_y,
+            basis_positions[:, i],
+            design.basis_values[:, i].reshape((-1,) + (1,) * (y.ndim - 1)) * y,
+        )
+
+    coefficients = linalg.cho_solve_banded((cholesky_factor, False), weighted_y)
+
+    return np.einsum(
+        "ni,ni...->n...", design.basis_values, coefficients[basis_positions]
+    )
+
+
+def calculate_inverse_bands(cholesky_factor):
+    """Calculates the upper bands of the inverse of `U'U`, given its upper banded Cholesky factor `U` (R's `sinerp`).
+
+    Returns them in the same layout as `SmoothingSplineDesign.gram_bands`, i.e. row `offset` holds the entries
+    `(i, i + offset)`. Following Hutchinson and de Hoog, each row of the inverse's band is calculated from the rows
+    below it, in O(n) time and memory, without calculating the rest of the inverse.
+    """
+    bandwidth = cholesky_factor.shape[0] - 1
+    num_coefficients = cholesky_factor.shape[1]
+
+    # Unpack `U[i, i + offset]` from LAPACK's upper banded storage, padded with zeros past the last row.
+    factor_bands = np.zeros(shape=(bandwidth + 1, num_coefficients + bandwidth))
+    for offset in range(bandwidth + 1):
+        factor_bands[offset, : num_coefficients - offset] = cholesky_factor[
+            bandwidth - offset, offset:
+        ]
+    factor_bands = factor_bands.tolist()
+
+    # Note: the recursion runs one row at a time, so it is calculated on lists of floats, which are faster to index.
+    inverse_bands = [
+        [0.0] * (num_coefficients + bandwidth) for _ in range(bandwidth + 1)
+    ]
+    for i in reversed(range(num_coefficients)):
+        inverse_diagonal = 1.0 / factor_bands[0][i]
+        for offset in range(1, bandwidth + 1):
+            # The inverse at (i + d, i + offset), which lies in the band of the rows already calculated.
+            total = 0.0
+            for d in range(1, bandwidth + 1):
+                total += (
+                    factor_bands[d][i]
+                    * inverse_bands[abs(offset - d)][i + min(offset, d)]
+                )
+            inverse_bands[offset][i] = -total * inverse_diagonal
+
+        total = 0.0
+        for d in range(1, bandwidth + 1):
+            total += factor_bands[d][i] * inverse_bands[d][i]
+        inverse_bands[0][i] = inverse_diagonal * (inverse_diagonal - total)
+
+    return np.array(inverse_bands)[:, :num_coefficients]
+
+
+def _calculate_leverages(design, cholesky_factor):
+    # Each fitted value only depends on four neighboring coefficients, so only the band of the inverse is needed.
+    inverse_bands = calculate_inverse_bands(cholesky_factor=cholesky_factor)
+    offsets = np.arange(_CUBIC_ORDER)
+    basis_positions = design.basis_start_positions[
+        :, np.newaxis, np.newaxis
+    ] + np.minimum(offsets[:, np.newaxis], offsets[np.newaxis, :])
+
+    return np.einsum(
+        "ni,nij,nj->n",
+        design.basis_values,
+        inverse_bands[
+            np.abs(offsets[:, np.newaxis] - offsets[np.newaxis, :]), basis_positions
+        ],
+        design.basis_values,
+    )
+
+
+def _calculate_gcv_criterion(design, y, smoothing_parameter):
+    cholesky_factor = factor_smoothing_spline(
+        design=design, smoothing_parameter=smoothing_parameter
+    )
+    fitted_values = solve_smoothing_spline(
+        design=design, cholesky_factor=cholesky_factor, y=y
+    )
+    degrees_of_freedom = _calculate_leverages(
+        design=design, cholesky_factor=cholesky_factor
+    ).sum()
+
+    residual_sum_of_squares = np.sum((y - fitted_values) ** 2)
+    criterion = (residual_sum_of_squares / len(y)) / (
+        (1.0 - degrees_of_freedom / len(y)) ** 2
+    )
+
+    return criterion, fitted_values
+
+
+def fit_smoothing_spline_by_gcv(design, y):
+    """Chooses `spar` by minimizing GCV, with the same Brent search as R's `sbart.c`.
+
+    Returns the chosen `spar` and the fitted values. As in R, the fitted values are those of the last evaluation of
+    the search, which is within the search tolerance of the chosen `spar`.
+    """
+    y = np.asarray(y, dtype=float)
+    lower_bound = SPAR_SEARCH_LOWER_BOUND
+    upper_bound = SPAR_SEARCH_UPPER_BOUND
+
+    x = w = v = lower_bound + _GOLDEN_SECTION_RATIO * (upper_bound - lower_bound)
+    step = previous_step = 0.0
+    fx, fitted_values = _calculate_gcv_criterion(
+        design=design, y=y, smoothing_parameter=x
+    )
+    fv = fw = fx
+
+    for _ in range(SPAR_SEARCH_MAX_ITERATIONS):
+        midpoint = (lower_bound + upper_bound) * 0.5
+        tolerance_1 = SPAR_SEARCH_EPSILON * abs(x) + SPAR_SEARCH_TOLERANCE / 3.0
+        tolerance_2 = tolerance_1 * 2.0
+
+        if abs(x - midpoint) <= tolerance_2 - (upper_bound - lower_bound) * 0.5:
+            break
+
+        use_golden_section = True
+        if abs(previous_step) > tolerance_1:
+            # Try a parabolic interpolation step.
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = (q - r) * 2.0
+            if q > 0.0:
+                p = -p
+            q = abs(q)
+            r = previous_step
+            previous_step = step
+
+            if not (
+                abs(p) >= abs(0.5 * q * r)
+                or q == 0.0
+                or p <= q * (lower_bound - x)
+                or p >= q * (upper_bound - x)
+            ):
+                step = p / q
+                u = x + step
+
+                # The criterion must not be evaluated too close to the bounds.
+                if u - lower_bound < tolerance_2 or upper_bound - u < tolerance_2:
+                    step = np.copysign(tolerance_1, midpoint - x)
+
+                use_golden_section = False
+
+        if use_golden_section:
+            previous_step = (lower_bound - x) if x >= midpoint else (upper_bound - x)
+            step = _GOLDEN_SECTION_RATIO * previous_step
+
+        # The criterion must not be evaluated too close to `x`.
+        u = x + (step if abs(step) >= tolerance_1 else np.copysign(tolerance_1, step))
+        fu, fitted_values = _calculate_gcv_criterion(
+            design=design, y=y, smoothing_parameter=u
+        )
+
+        if fu <= fx:
+            if u >= x:
+                lower_bound = x
+            else:
+                upper_bound = x
+            v, fv = w, fw
+            w, fw = x, fx
+            x, fx = u, fu
+        else:
+            if u < x:
+                lower_bound = u
+            else:
+                upper_bound = u
+            if fu <= fw or w == x:
+                v, fv = w, fw
+                w, fw = u, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+
+    return x, fitted_values
+
+
+def fit_smoothing_spline(x, y, smoothing_parameter=None):
+    """Fits a smoothing spline to `y` at the (sorted, unique) `x` values and returns the fitted values.
+
+    Equivalent to `predict(smooth.spline(x, y, spar=smoothing_parameter), x)$y` in R.
+    """
+    design = prepare_smoothing_spline(x=x)
+
+    if smoothing_parameter is None:
+        _, fitted_values = fit_smoothing_spline_by_gcv(design=design, y=y)
+        return fitted_values
+
+    return solve_smoothing_spline(
+        design=design,
+        cholesky_factor=factor_smoothing_spline(
+            design=design, smoothing_parameter=smoothing_parameter
+        ),
+        y=y,
+    )
+
+
+def calculate_equivalent_smoothing_parameter(x, reference_x, smoothing_parameter):
+    """Calculates the `spar` that smooths a fit at the `x` values as much as `smoothing_parameter` smooths one at the
+    `reference_x` values.
+
+    R scales `x` to `[0, 1]` and `lambda` by a ratio of traces that depends on the `x` values, so the same `spar`
+    penalizes curvature differently over different ranges of `x`. The returned `spar` gives the same `lambda` in the
+    units of `x`, so that a fit over a trailing window of `reference_x` closely follows the full fit near the window's
+    end.
+    """
+
+    def calculate_log_lambda(x_values, spar):
+        # Note: `lambda` scales with the cube of the range of `x`, since the penalty integrates the second derivative.
+        x_values = np.asarray(x_values, dtype=float)
+        return (
+            np.log(prepare_smoothing_spline(x=x_values).trace_ratio)
+            + (3.0 * spar - 1.0) * np.log(256.0)
+            + 3.0 * np.log(x_values[-1] - x_values[0])
+        )
+
+    return smoothing_parameter + (
+        calculate_log_lambda(x_values=reference_x, spar=smoothing_parameter)
+        - calculate_log_lambda(x_values=x, spar=smoothing_parameter)
+    ) / (3.0 * np.log(256.0))
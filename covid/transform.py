@@ -1,21 +1,45 @@
 import datetime
+import functools
+import logging
+import os
 
 import numpy as np
 import pandas as pd
 
+from covid.extract import COUNTY_FIPS_FIELD
+from covid.extract import COUNTY_FIPS_NUM_DIGITS
+from covid.extract import COUNTY_FIPS_SOURCE_FIELD
 from covid.extract import DATE_SOURCE_FIELD
 from covid.extract import extract_state_population_data
+from covid.extract import GEOGRAPHY_LEVEL_COUNTY
+from covid.extract import GEOGRAPHY_LEVEL_STATE
+from covid.extract import GEOGRAPHY_LEVELS
 from covid.extract import get_state_abbreviations_to_names
 from covid.extract import NEW_CASES_NEGATIVE_SOURCE_FIELD
 from covid.extract import NEW_CASES_POSITIVE_SOURCE_FIELD
 from covid.extract import STATE_SOURCE_FIELD
 from covid.extract import TOTAL_CASES_SOURCE_FIELD
-from covid.transform_utils import calculate_consecutive_boolean_series
-from covid.transform_utils import calculate_consecutive_positive_or_negative_values
+from covid.extract_utils import calculate_dataframe_fingerprint
+from covid.instrumentation import instrumented
+from covid.smoothing_spline import calculate_equivalent_smoothing_parameter
+from covid.transform_utils import apply_by_state
+from covid.transform_utils import apply_to_state_date_matrix
+from covid.transform_utils import apply_to_state_matrix
+from covid.transform_utils import apply_to_state_partitions
 from covid.transform_utils import calculate_max_run_in_window
-from covid.transform_utils import fit_and_predict_cubic_spline_in_r
+from covid.transform_utils import calculate_rolling_aggregation
+from covid.transform_utils import calculate_run_lengths
+from covid.transform_utils import calculate_state_matrix_positions
+from covid.transform_utils import calculate_streaks_by_state
+from covid.transform_utils import compact_dtypes
+from covid.transform_utils import fit_and_predict_cubic_spline_by_state
 from covid.transform_utils import generate_lag_column_name_formatter_and_column_names
-from covid.transform_utils import generate_lags
+from covid.transform_utils import generate_lags_for_columns
+from covid.transform_utils import get_spline_x_values
+from covid.transform_utils import join_lags
+from covid.transform_utils import SPLINE_BACKEND_R
+
+logger = logging.getLogger(__name__)
 
 # Define miscellaneous constants.
 ONE_MILLION = 1_000_000
@@ -253,6 +277,107 @@ CDC_CRITERIA_6_NEGATIVE_STREAK_STATE_SUMMARY_FIELDS = [
     for criteria_field in _CDC_CRITERIA_6_STREAK_STATE_SUMMARY_FIELDS
 ]
 
+# Define the cumulative covidtracking fields that must be carried over from earlier rows when only the most recent
+# rows are recomputed.
+COVIDTRACKING_CARRIED_STATE_FIELDS = [
+    CONSECUTIVE_INCREASE_NEW_CASES_3DCS_FIELD,
+    CONSECUTIVE_DECREASE_NEW_CASES_3DCS_FIELD,
+    TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD,
+    *CDC_CRITERIA_1_POSITIVE_STREAK_STATE_SUMMARY_FIELDS,
+    *CDC_CRITERIA_1_NEGATIVE_STREAK_STATE_SUMMARY_FIELDS,
+    *CDC_CRITERIA_2_POSITIVE_STREAK_STATE_SUMMARY_FIELDS,
+    *CDC_CRITERIA_2_NEGATIVE_STREAK_STATE_SUMMARY_FIELDS,
+    *CDC_CRITERIA_6_POSITIVE_STREAK_STATE_SUMMARY_FIELDS,
+    *CDC_CRITERIA_6_NEGATIVE_STREAK_STATE_SUMMARY_FIELDS,
+]
+
+# Define the covidtracking source fields that are compared to detect new or revised rows.
+COVIDTRACKING_SOURCE_FIELDS = [
+    TOTAL_CASES_SOURCE_FIELD,
+    NEW_CASES_POSITIVE_SOURCE_FIELD,
+    NEW_CASES_NEGATIVE_SOURCE_FIELD,
+]
+
+# Define the covidtracking criteria fields, which are stored as booleans.
+COVIDTRACKING_CRITERIA_FIELDS = [
+    CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD,
+    CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD,
+    CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD,
+    TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD,
+    TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD,
+    CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE,
+    CDC_CRITERIA_1_COMBINED_FIELD,
+    CDC_CRITERIA_2A_COVID_PERCENT_CONTINUOUS_DECLINE_FIELD,
+    CDC_CRITERIA_2B_COVID_TOTAL_TEST_VOLUME_INCREASING_FIELD,
+    CDC_CRITERIA_2C_COVID_PERCENT_OVERALL_DECLINE_FIELD,
+    CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD,
+    CDC_CRITERIA_2_COMBINED_FIELD,
+    CDC_CRITERIA_6A_14_DAY_MAX_PERCENT_POSITIVE,
+    CDC_CRITERIA_ALL_COMBINED_FIELD,
+    CDC_CRITERIA_ALL_COMBINED_OR_FIELD,
+]
+
+# Define the CDC ILI criteria fields, which are also stored as booleans.
+CDC_ILI_CRITERIA_FIELDS = [
+    CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI,
+    CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI,
+    CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI,
+    CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI,
+    CDC_CRITERIA_5_COMBINED,
+]
+
+# Define the covidtracking fields that count days, which are stored as small integers.
+COVIDTRACKING_COUNT_FIELDS = [
+    MAX_RUN_OF_DECREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD,
+    MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD,
+    MAX_RUN_OF_DECREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD,
+    MAX_RUN_OF_INCREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD,
+    MAX_RUN_OF_INCREASING_TOTAL_TESTS_3DCS_FIELD,
+    *[
+        field
+        for field in COVIDTRACKING_CARRIED_STATE_FIELDS
+        if field
+        != TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD
+    ],
+]
+
+# Define the covidtracking fields calculated from the smoothed (3-day average and cubic spline) metrics, which can be
+# stored as `float32` (see `transform_covidtracking_data`).
+COVIDTRACKING_SMOOTHED_FIELDS = [
+    TOTAL_CASES_3_DAY_AVERAGE_FIELD,
+    TOTAL_CASES_3_DAY_AVERAGE_CUBIC_SPLINE_FIELD,
+    NEW_CASES_3_DAY_AVERAGE_FIELD,
+    NEW_CASES_3DCS_FIELD,
+    NEW_CASES_3DCS_DIFF_FIELD,
+    NEW_CASES_TODAY_MINUS_NEW_CASES_14_DAYS_AGO_3DCS_FIELD,
+    NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD,
+    NEW_TESTS_TOTAL_3DCS_FIELD,
+    NEW_TESTS_TOTAL_DIFF_3DCS_FIELD,
+    POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD,
+    POSITIVE_TESTS_TOTAL_3DCS_FIELD,
+    FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD,
+    PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD,
+    PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD,
+    PERCENT_POSITIVE_NEW_TESTS_3D_FIELD,
+    MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3DCS_FIELD,
+    MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3D_FIELD,
+    POLICY_VS_TREND_3DCS_CASES_PER_MILLION,
+    POLICY_VS_TREND_3DCS_POSITIVITY,
+]
+
+# Define the `spar` of the covidtracking splines.
+COVIDTRACKING_SPLINE_SMOOTHING_PARAMETER = 0.5
+
+# Define how many trailing rows per state are recomputed by an incremental run whenever a state has new data, where
+# `None` recomputes all of them. The spline is a global smoother, so a new day moves its values slightly on every row;
+# rows before the horizon keep the values of the previous run, which is checked by `check_incremental_parity`.
+DEFAULT_REFIT_HORIZON_NUM_ROWS = 28
+
+# Define how many rows before the recomputed rows are re-read by an incremental run. This must cover the longest
+# lookback of the windowed fields (diffs, rolling windows and max runs) so that they are exact, and it anchors the
+# start of the spline fit.
+INCREMENTAL_CONTEXT_NUM_ROWS = 60
+
 
 # Define the list of columns that should appear in summary workbooks.
 # TODO: is there a smarter way to keep these in sync with what's generated?
@@ -415,24 +540,79 @@ CRITERIA_COMBINED_SUMMARY_COLUMNS = [
 ]
 
 
-def transform_covidtracking_data(covidtracking_df):
-    """Transforms data from https://covidtracking.com/ and calculates CDC Criteria 1 (A, B, C, D) and 2 (A, B, C, D)."""
+@instrumented("transform_covidtracking_data")
+def transform_covidtracking_data(
+    covidtracking_df,
+    spline_backend=SPLINE_BACKEND_R,
+    max_workers=None,
+    incremental_state_path=None,
+    refit_horizon=DEFAULT_REFIT_HORIZON_NUM_ROWS,
+    check_incremental_parity=False,
+    geography_level=GEOGRAPHY_LEVEL_STATE,
+    population_data=None,
+    smoothed_float32=False,
+):
+    """Transforms data from https://covidtracking.com/ and calculates CDC Criteria 1 (A, B, C, D) and 2 (A, B, C, D).
+
+    At `GEOGRAPHY_LEVEL_STATE`, `covidtracking_df` identifies states by abbreviation, and each state's population is
+    looked up in `extract_state_population_data` unless `population_data` is given. At `GEOGRAPHY_LEVEL_COUNTY`, the
+    same fields identify counties by FIPS code (in `COUNTY_FIPS_SOURCE_FIELD`), and `population_data` must give the
+    population of every county (see `extract_county_population_data`); the transformed counties are identified by
+    `COUNTY_FIPS_FIELD`, and only their latest date is returned (as used by `calculate_state_summary`). On one core,
+    ~3,200 counties with 240 days each take about 6 seconds and 1.1 GB of peak memory over that of the input (see
+    `benchmarks/transform_benchmark.py` and `benchmarks/memory_benchmark.py`).
+
+    If `incremental_state_path` is given, the calculated criteria are saved there, along with the `spline_backend`,
+    `geography_level`, `smoothed_float32` and populations they were calculated with; the criteria include the
+    cumulative fields (`COVIDTRACKING_CARRIED_STATE_FIELDS`) that later runs carry on from. The next run that is given
+    the same path and parameters only recomputes the rows that are new, revised, or within `refit_horizon` rows of the
+    end of the states that have any, reusing the rest, which is an approximation of a full recompute (see
+    `calculate_covidtracking_criteria_incrementally`); a `refit_horizon` of `None` recomputes those states in full,
+    which is exact. With `check_incremental_parity`, an incremental run also does a full recompute and reports the
+    fields that differ.
+
+    The transformed frame is stored compactly: criteria are booleans, counts of days are small integers, states are
+    categorical, and lags are sparse columns (see `join_lags`), which `calculate_state_summary` stores densely again.
+    With `smoothed_float32`, the smoothed fields (`COVIDTRACKING_SMOOTHED_FIELDS`) are also stored as `float32`.
+    """
+    if geography_level not in GEOGRAPHY_LEVELS:
+        raise ValueError(
+            f"Unknown geography level {geography_level}; expected one of {GEOGRAPHY_LEVELS}."
+        )
+    if geography_level == GEOGRAPHY_LEVEL_COUNTY and population_data is None:
+        raise ValueError("The population of each county must be given.")
+
     # Rename state field into column called "State" instead of "state".
+    # Note: counties also use the "State" field until the end of the transform, since the calculations are the same.
     covidtracking_df = covidtracking_df.rename(
-        columns={STATE_SOURCE_FIELD: STATE_FIELD}
+        columns={STATE_SOURCE_FIELD: STATE_FIELD, COUNTY_FIPS_SOURCE_FIELD: STATE_FIELD}
     )
 
     # Replace abbreviations with full names.
     state_abbreviations_to_names = get_state_abbreviations_to_names()
-    covidtracking_df = covidtracking_df.replace(
-        {STATE_FIELD: state_abbreviations_to_names}
-    )
-
-    states = covidtracking_df[STATE_FIELD].unique()
+    if geography_level == GEOGRAPHY_LEVEL_COUNTY:
+        # Pad FIPS codes that were read as numbers, dropping their leading zero.
+        covidtracking_df[STATE_FIELD] = (
+            covidtracking_df[STATE_FIELD].astype(str).str.zfill(COUNTY_FIPS_NUM_DIGITS)
+        )
+    elif isinstance(covidtracking_df[STATE_FIELD].dtype, pd.CategoricalDtype):
+        # Streamed extracts store states as categories, so only the categories need to be renamed. The rest of the
+        #   transform expects plain strings.
+        covidtracking_df[STATE_FIELD] = (
+            covidtracking_df[STATE_FIELD]
+            .cat.rename_categories(
+                lambda state: state_abbreviations_to_names.get(state, state)
+            )
+            .astype(str)
+        )
+    else:
+        covidtracking_df = covidtracking_df.replace(
+            {STATE_FIELD: state_abbreviations_to_names}
+        )
 
-    # Make the date column explicitly a date
+    # Make the date column explicitly a date. Dates are either strings or integers, formatted as `YYYYMMDD`.
     covidtracking_df[DATE_SOURCE_FIELD] = pd.to_datetime(
-        covidtracking_df[DATE_SOURCE_FIELD]
+        covidtracking_df[DATE_SOURCE_FIELD].astype(str), format="%Y%m%d"
     )
 
     # Use a multi-index for state and date.
@@ -442,445 +622,587 @@ def transform_covidtracking_data(covidtracking_df):
     covidtracking_df = covidtracking_df.sort_index()
 
     # Load state population data.
-    state_population_data = extract_state_population_data()
+    state_population_data = (
+        population_data
+        if population_data is not None
+        else extract_state_population_data()
+    )
 
-    for state in states:
-        print(f"Processing covid tracking data for state {state}...")
+    # Only reuse criteria calculated with the same parameters and populations; anything else is recomputed in full.
+    incremental_state_parameters = {
+        "spline_backend": spline_backend,
+        "geography_level": geography_level,
+        "smoothed_float32": smoothed_float32,
+        "population_fingerprint": calculate_dataframe_fingerprint(
+            state_population_data.reset_index()
+        ),
+    }
+    previous_criteria_df = None
+    if incremental_state_path is not None and os.path.exists(incremental_state_path):
+        incremental_state = pd.read_pickle(incremental_state_path)
+        if (
+            isinstance(incremental_state, dict)
+            and incremental_state.get("parameters") == incremental_state_parameters
+        ):
+            previous_criteria_df = incremental_state["criteria"]
+        else:
+            logger.info(
+                f"The covidtracking criteria in {incremental_state_path} were calculated with different parameters; "
+                f"recomputing every state."
+            )
 
-        ###### Calculate criteria category 1. ######
-        # Calculate new cases (raw).
-        covidtracking_df.loc[(state,), NEW_CASES_FIELD] = (
-            covidtracking_df.loc[(state,), TOTAL_CASES_SOURCE_FIELD]
-            .diff(periods=1)
-            .values
+    if previous_criteria_df is None:
+        criteria_df = apply_to_state_partitions(
+            df=covidtracking_df,
+            func=functools.partial(
+                calculate_covidtracking_criteria,
+                state_population_data=state_population_data,
+                spline_backend=spline_backend,
+            ),
+            max_workers=max_workers,
         )
-
-        # Calculate new cases (raw diff).
-        covidtracking_df.loc[(state,), NEW_CASES_DIFF_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_FIELD].diff(periods=1).values
+    else:
+        criteria_df = calculate_covidtracking_criteria_incrementally(
+            covidtracking_df=covidtracking_df,
+            previous_criteria_df=previous_criteria_df,
+            state_population_data=state_population_data,
+            spline_backend=spline_backend,
+            max_workers=max_workers,
+            refit_horizon=refit_horizon,
         )
 
-        # Calculate 3-day rolling average of total cases.
-        covidtracking_df.loc[(state,), TOTAL_CASES_3_DAY_AVERAGE_FIELD] = (
-            covidtracking_df.loc[(state,), TOTAL_CASES_SOURCE_FIELD]
-            .rolling(window=3, min_periods=1, center=False)
-            .mean()
-            .values
-        )
+        if check_incremental_parity:
+            full_criteria_df = apply_to_state_partitions(
+                df=covidtracking_df,
+                func=functools.partial(
+                    calculate_covidtracking_criteria,
+                    state_population_data=state_population_data,
+                    spline_backend=spline_backend,
+                ),
+                max_workers=max_workers,
+            )
+            differences = compare_criteria(
+                criteria_df=criteria_df, expected_criteria_df=full_criteria_df
+            )
+            logger.log(
+                logging.WARNING if (differences > 0).any() else logging.INFO,
+                f"Incremental covidtracking criteria differ from a full recompute in {(differences > 0).sum()} "
+                f"fields:\n{differences[differences > 0].to_string()}",
+            )
 
-        # Calculate the cubic spline on the 3 day average of total cases.
-        covidtracking_df.loc[
-            (state,), TOTAL_CASES_3_DAY_AVERAGE_CUBIC_SPLINE_FIELD
-        ] = fit_and_predict_cubic_spline_in_r(
-            series_=covidtracking_df.loc[(state,), TOTAL_CASES_3_DAY_AVERAGE_FIELD],
-            smoothing_parameter=0.5,
-        ).values
+    criteria_df = compact_dtypes(
+        df=criteria_df,
+        bool_fields=COVIDTRACKING_CRITERIA_FIELDS,
+        count_fields=COVIDTRACKING_COUNT_FIELDS,
+        float32_fields=COVIDTRACKING_SMOOTHED_FIELDS if smoothed_float32 else (),
+    )
 
-        # Calculate 3-day rolling average of new cases.
-        covidtracking_df.loc[(state,), NEW_CASES_3_DAY_AVERAGE_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_FIELD]
-            .rolling(window=3, min_periods=1, center=False)
-            .mean()
-            # Replace NA new cases with `0` to fit the spline.
-            .fillna(value=0)
-            .values
+    if incremental_state_path is not None:
+        pd.to_pickle(
+            {"parameters": incremental_state_parameters, "criteria": criteria_df},
+            incremental_state_path,
         )
 
-        # Calculate the cubic spline on the 3 day average of total cases.
-        covidtracking_df.loc[
-            (state,), NEW_CASES_3DCS_FIELD
-        ] = fit_and_predict_cubic_spline_in_r(
-            series_=covidtracking_df.loc[(state,), NEW_CASES_3_DAY_AVERAGE_FIELD],
-            smoothing_parameter=0.5,
-        ).values
+    covidtracking_df = criteria_df
 
-        # Calculate 3DCS new cases diff.
-        covidtracking_df.loc[(state,), NEW_CASES_3DCS_DIFF_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_3DCS_FIELD].diff(periods=1).values
-        )
+    # Add an update time.
+    covidtracking_df[LAST_RAN_FIELD] = datetime.datetime.now()
 
-        # Calculate consecutive increases or decreases.
-        covidtracking_df.loc[
-            (state,), CONSECUTIVE_INCREASE_NEW_CASES_3DCS_FIELD
-        ] = calculate_consecutive_positive_or_negative_values(
-            series_=covidtracking_df.loc[(state,), NEW_CASES_3DCS_DIFF_FIELD],
-            positive_values=True,
-        ).values
+    # Remove the multi-index, converting date and state back to just columns.
+    covidtracking_df = covidtracking_df.reset_index(drop=False)
 
-        covidtracking_df.loc[
-            (state,), CONSECUTIVE_DECREASE_NEW_CASES_3DCS_FIELD
-        ] = calculate_consecutive_positive_or_negative_values(
-            series_=covidtracking_df.loc[(state,), NEW_CASES_3DCS_DIFF_FIELD],
-            positive_values=False,
-        ).values
+    # Use the date for each data entry as when the data were last updated.
+    covidtracking_df[LAST_UPDATED_FIELD] = covidtracking_df[DATE_SOURCE_FIELD]
 
-        # Calculate criteria 1A: must see at least 9 days of a decrease in new cases over a 14 day window.
-        covidtracking_df.loc[
-            (state,), MAX_RUN_OF_DECREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
-        ] = calculate_max_run_in_window(
-            series_=covidtracking_df.loc[(state,), NEW_CASES_3DCS_DIFF_FIELD],
-            positive_values=False,
-            window_size=14,
-        ).values
+    # Join to lags of important variables that we want to plot in sparklines.
+    lags = generate_lags_for_columns(
+        df=covidtracking_df,
+        lag_specifications=[
+            (NEW_CASES_3DCS_FIELD, 121, False),
+            (PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD, 31, False),
+            (NEW_TESTS_TOTAL_3DCS_FIELD, 31, False),
+            (POLICY_VS_TREND_RAW_CASES_PER_MILLION, 300, True),
+            (POLICY_VS_TREND_3DCS_CASES_PER_MILLION, 300, True),
+            (POLICY_VS_TREND_3DCS_POSITIVITY, 300, True),
+        ],
+    )
+    if geography_level == GEOGRAPHY_LEVEL_COUNTY:
+        # Lags are only filled in for the latest date, and spreading their ~1,100 columns over every row of every
+        #   county would take gigabytes, so only the latest date of each county is kept.
+        covidtracking_df = covidtracking_df.loc[
+            covidtracking_df[DATE_SOURCE_FIELD]
+            == covidtracking_df[DATE_SOURCE_FIELD].max()
+        ]
+    covidtracking_df = join_lags(df=covidtracking_df, lags_df=lags)
 
-        covidtracking_df.loc[
-            (state,), CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD
-        ] = (
-            covidtracking_df.loc[
-                (state,), MAX_RUN_OF_DECREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
-            ]
-            >= 10
-        ).values
+    if geography_level == GEOGRAPHY_LEVEL_COUNTY:
+        return covidtracking_df.rename(columns={STATE_FIELD: COUNTY_FIPS_FIELD})
 
-        # Calculate criteria 1B: must not see 5 or more days of an increase in new cases over a 14 day window.
-        covidtracking_df.loc[
-            (state,), MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
-        ] = calculate_max_run_in_window(
-            series_=covidtracking_df.loc[(state,), NEW_CASES_3DCS_DIFF_FIELD],
-            positive_values=True,
-            window_size=14,
-        ).values
+    # Store each state's name once.
+    covidtracking_df[STATE_FIELD] = covidtracking_df[STATE_FIELD].astype("category")
 
-        covidtracking_df.loc[(state,), CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD] = (
-            covidtracking_df.loc[
-                (state,), MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
-            ]
-            < 5
-        ).values
+    # Drop American Samoa because it's not reporting data
+    covidtracking_df = covidtracking_df.loc[
+        covidtracking_df[STATE_FIELD] != "American Samoa",
+    ]
+
+    return covidtracking_df
+
+
+def calculate_covidtracking_criteria(
+    covidtracking_df,
+    state_population_data,
+    spline_backend=SPLINE_BACKEND_R,
+    initial_state_df=None,
+    spline_smoothing_parameters=None,
+):
+    """Calculates the derived fields for CDC Criteria 1, 2 and 6 for every state at once.
 
-        # Calculate criteria 1C: new cases on T-0 must be < T-14.
-        covidtracking_df.loc[
-            (state,), NEW_CASES_TODAY_MINUS_NEW_CASES_14_DAYS_AGO_3DCS_FIELD
-        ] = (
-            covidtracking_df.loc[(state,), NEW_CASES_3DCS_FIELD].diff(periods=14).values
+    `covidtracking_df` must be indexed by (state, date) and sorted by that index. Every field is calculated for all
+    states with grouped operations, and the new columns are added to the frame in a single step at the end.
+
+    `initial_state_df` optionally carries in the cumulative fields (`COVIDTRACKING_CARRIED_STATE_FIELDS`) from a
+    previous run over earlier data. It is indexed by (state, date), with at most one row per state. Each state's rows
+    up to and including that date are only read as context for the windowed fields: the cumulative fields continue
+    from the carried-in values after that date, and are not meaningful up to it. States missing from it start from
+    scratch.
+
+    `spline_smoothing_parameters` optionally gives the `spar` of each state's splines, by state, instead of
+    `COVIDTRACKING_SPLINE_SMOOTHING_PARAMETER`.
+    """
+    fields = {}
+    states = covidtracking_df.index.get_level_values(STATE_FIELD)
+    dates = covidtracking_df.index.get_level_values(DATE_SOURCE_FIELD)
+
+    if initial_state_df is None:
+        initial_state_df = pd.DataFrame(
+            columns=COVIDTRACKING_CARRIED_STATE_FIELDS,
+            index=pd.MultiIndex.from_arrays(
+                arrays=[[], pd.DatetimeIndex([])],
+                names=[STATE_FIELD, DATE_SOURCE_FIELD],
+            ),
         )
-        covidtracking_df.loc[(state,), CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD] = (
-            covidtracking_df.loc[
-                (state,), NEW_CASES_TODAY_MINUS_NEW_CASES_14_DAYS_AGO_3DCS_FIELD
-            ]
-            < 0
-        ).values
+    initial_state_dates = pd.Series(
+        data=initial_state_df.index.get_level_values(DATE_SOURCE_FIELD),
+        index=initial_state_df.index.get_level_values(STATE_FIELD),
+    )
+    is_context = dates.values <= initial_state_dates.reindex(states).values
+    initial_state_df = initial_state_df.droplevel(level=DATE_SOURCE_FIELD)
 
-        # Calculate criteria 1D: total cases from the last 14 days must be less than 10 per 100k population.
-        covidtracking_df.loc[(state,), TOTAL_NEW_CASES_IN_14_DAY_WINDOW_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_FIELD]
-            .fillna(value=0)
-            .rolling(window=14, min_periods=1, center=False)
-            .sum()
-            .values
+    def by_state(series_):
+        return series_.groupby(level=STATE_FIELD, sort=False)
+
+    # Place each state's rows in a matrix once, for every field calculated with an array kernel.
+    matrix_positions = calculate_state_matrix_positions(index=covidtracking_df.index)
+    output_matrix_positions = calculate_state_matrix_positions(
+        index=covidtracking_df.index[~is_context]
+    )
+
+    def rolling_by_state(series_, window, aggregation):
+        return apply_to_state_matrix(
+            series_=series_,
+            func=lambda matrix: calculate_rolling_aggregation(
+                matrix=matrix, window=window, aggregation=aggregation
+            ),
+            matrix_positions=matrix_positions,
+        )
+
+    def max_in_14_days_by_state(series_):
+        return apply_to_state_date_matrix(
+            series_=series_,
+            func=lambda matrix: calculate_rolling_aggregation(
+                matrix=matrix, window=14, aggregation="max"
+            ),
         )
-        state_population = float(state_population_data.loc[state][0])
-        covidtracking_df.loc[
-            (state,), TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_FIELD
-        ] = (
-            (
-                100000.0
-                * covidtracking_df.loc[(state,), TOTAL_NEW_CASES_IN_14_DAY_WINDOW_FIELD]
+
+    def spline_by_state(series_):
+        if spline_smoothing_parameters is None:
+            return fit_and_predict_cubic_spline_by_state(
+                series_=series_,
+                smoothing_parameter=COVIDTRACKING_SPLINE_SMOOTHING_PARAMETER,
+                backend=spline_backend,
             )
-            / state_population
-        ).values
 
-        covidtracking_df.loc[
-            (state,),
-            TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD,
-        ] = (
-            covidtracking_df.loc[
-                (state,), TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_FIELD
+        # Fit the states that share a smoothing parameter together.
+        row_smoothing_parameters = spline_smoothing_parameters.reindex(states).values
+        return pd.concat(
+            [
+                fit_and_predict_cubic_spline_by_state(
+                    series_=series_[row_smoothing_parameters == smoothing_parameter],
+                    smoothing_parameter=float(smoothing_parameter),
+                    backend=spline_backend,
+                )
+                for smoothing_parameter in np.unique(row_smoothing_parameters)
             ]
-            <= 10
-        ).values
+        ).reindex(series_.index)
+
+    def max_run_in_window_by_state(series_, positive_values, window_size):
+        return apply_to_state_matrix(
+            series_=series_,
+            func=lambda matrix: calculate_max_run_in_window(
+                series_=matrix, positive_values=positive_values, window_size=window_size
+            ),
+            matrix_positions=matrix_positions,
+        )
 
-        covidtracking_df.loc[
-            (state,),
-            TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD,
-        ] = (
-            (
-                covidtracking_df.loc[
-                    (state,),
-                    TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD,
-                ]
-                == 0
-            ).cumsum()
-            > 0
-        ).values
+    # Find the states with rows past the context rows, in order, once for every run length field.
+    output_states = states[~is_context].unique()
 
-        # To be true on 1D, the state must be (1) lower than the threshold, AND (2) previously above the threshold.
-        covidtracking_df.loc[(state,), CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE] = (
-            covidtracking_df.loc[
-                (state,),
-                TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD,
-            ]
-            & covidtracking_df.loc[
-                (state,),
-                TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD,
-            ]
+    def run_lengths_by_state(meets_criteria, field):
+        # Continue any runs carried in from the previous run, skipping the context rows.
+        initial_run_lengths = (
+            initial_state_df[field].reindex(output_states).fillna(0).values
+        )
+        # Note: counts are exact in `float32`, which (unlike integers) also holds the missing values of context rows.
+        run_lengths = np.full(
+            shape=len(meets_criteria), fill_value=np.nan, dtype=np.float32
+        )
+        run_lengths[~is_context] = apply_to_state_matrix(
+            series_=meets_criteria[~is_context],
+            func=lambda matrix: calculate_run_lengths(
+                meets_criteria=matrix, initial_run_lengths=initial_run_lengths
+            ),
+            fill_value=False,
+            matrix_positions=output_matrix_positions,
         ).values
+        return pd.Series(data=run_lengths, index=covidtracking_df.index)
 
-        # Calculate a textual indicator function for the rebound.
-        covidtracking_df.loc[(state,), INDICATION_OF_NEW_CASES_REBOUND_FIELD] = (
-            covidtracking_df.loc[
-                (state,),
-                [
-                    MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD,
-                    CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE,
-                ],
-            ].apply(func=indication_of_rebound, axis=1)
-        ).values
+    def streaks_by_state(criteria_fields):
+        positive_streak_fields = [
+            CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(criteria_field=field)
+            for field in criteria_fields
+        ]
+        negative_streak_fields = [
+            CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(criteria_field=field)
+            for field in criteria_fields
+        ]
 
-        # Calculate all of the criteria combined in category 1.
-        covidtracking_df.loc[(state,), CDC_CRITERIA_1_COMBINED_FIELD] = (
-            (
-                covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD
-                ]
-                & covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD
-                ]
-                & covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD
-                ]
-            )
-            | covidtracking_df.loc[(state,), CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE]
-        ).values
+        # Continue any streaks carried in from the previous run, skipping the context rows.
+        initial_streaks = (
+            initial_state_df[positive_streak_fields]
+            .reindex(output_states)
+            .fillna(0)
+            .values
+            - initial_state_df[negative_streak_fields]
+            .reindex(output_states)
+            .fillna(0)
+            .values
+        )
+        positive_streaks, negative_streaks = calculate_streaks_by_state(
+            meets_criteria_df=pd.DataFrame(
+                data={field: fields[field] for field in criteria_fields},
+                index=covidtracking_df.index,
+            )[~is_context],
+            initial_streaks=initial_streaks,
+            matrix_positions=output_matrix_positions,
+        )
 
-        ###### Calculate criteria category 2. ######
-        # For the criteria, we must add positive to negative tests to get the total (discarding inconclusive).
-        covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_POSITIVE_SOURCE_FIELD]
-            + covidtracking_df.loc[(state,), NEW_CASES_NEGATIVE_SOURCE_FIELD]
-        ).values
+        # Note: as for run lengths, streaks are stored as `float32`, in which context rows are missing. Each criteria's
+        #   positive streak field is added before its negative one, as when they were calculated apart.
+        for index, criteria_field in enumerate(criteria_fields):
+            for streak_field, streaks_df in [
+                (positive_streak_fields[index], positive_streaks),
+                (negative_streak_fields[index], negative_streaks),
+            ]:
+                streaks = np.full(
+                    shape=len(covidtracking_df), fill_value=np.nan, dtype=np.float32
+                )
+                streaks[~is_context] = streaks_df[criteria_field].values
+                fields[streak_field] = pd.Series(
+                    data=streaks, index=covidtracking_df.index
+                )
 
-        new_tests_total_negatives_removed = covidtracking_df.loc[
-            (state,), NEW_TESTS_TOTAL_FIELD
-        ].values
-        new_tests_total_negatives_removed[new_tests_total_negatives_removed < 0] = None
+    # Note: `covidtracking.com` has been returning `nan` values for the `negativeIncrease` signal for Hawaii since
+    #   October 8th. This has resulted in our 3DCS to go haywire. Fields that depend on those 3DCS are masked to
+    #   prevent bad data from showing up on the site.
+    is_masked_hawaii_data = (states == "Hawaii") & (dates >= "2020-10-01")
+
+    # Look up each row's state population.
+    state_populations = (
+        state_population_data.iloc[:, 0]
+        .astype(float)
+        .loc[states.unique()]
+        .reindex(states)
+        .values
+    )
 
-        covidtracking_df.loc[
-            (state,), NEW_TESTS_TOTAL_FIELD
-        ] = new_tests_total_negatives_removed
+    ###### Calculate criteria category 1. ######
+    # Calculate new cases (raw).
+    fields[NEW_CASES_FIELD] = by_state(covidtracking_df[TOTAL_CASES_SOURCE_FIELD]).diff(
+        periods=1
+    )
 
-        covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_FIELD]
-            .rolling(window=3, min_periods=1, center=False)
-            .mean()
-            .values
-        )
+    # Calculate new cases (raw diff).
+    fields[NEW_CASES_DIFF_FIELD] = by_state(fields[NEW_CASES_FIELD]).diff(periods=1)
 
-        covidtracking_df.loc[
-            (state,), NEW_TESTS_TOTAL_3DCS_FIELD
-        ] = fit_and_predict_cubic_spline_in_r(
-            series_=covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD],
-            smoothing_parameter=0.5,
-        ).values
+    # Calculate 3-day rolling average of total cases.
+    fields[TOTAL_CASES_3_DAY_AVERAGE_FIELD] = rolling_by_state(
+        series_=covidtracking_df[TOTAL_CASES_SOURCE_FIELD], window=3, aggregation="mean"
+    )
 
-        covidtracking_df.loc[(state,), POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_POSITIVE_SOURCE_FIELD]
-            .rolling(window=3, min_periods=1, center=False)
-            .mean()
-            .values
-        )
+    # Calculate the cubic spline on the 3 day average of total cases.
+    fields[TOTAL_CASES_3_DAY_AVERAGE_CUBIC_SPLINE_FIELD] = spline_by_state(
+        fields[TOTAL_CASES_3_DAY_AVERAGE_FIELD]
+    )
 
-        covidtracking_df.loc[
-            (state,), POSITIVE_TESTS_TOTAL_3DCS_FIELD
-        ] = fit_and_predict_cubic_spline_in_r(
-            series_=covidtracking_df.loc[
-                (state,), POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD
-            ],
-            smoothing_parameter=0.5,
-        ).values
+    # Calculate 3-day rolling average of new cases.
+    fields[NEW_CASES_3_DAY_AVERAGE_FIELD] = rolling_by_state(
+        series_=fields[NEW_CASES_FIELD], window=3, aggregation="mean"
+    ).fillna(
+        # Replace NA new cases with `0` to fit the spline.
+        value=0
+    )
 
-        covidtracking_df.loc[(state,), FRACTION_POSITIVE_NEW_TESTS_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_CASES_POSITIVE_SOURCE_FIELD].astype(
-                float
-            )
-            / covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_FIELD]
-        ).values
+    # Calculate the cubic spline on the 3 day average of total cases.
+    fields[NEW_CASES_3DCS_FIELD] = spline_by_state(
+        fields[NEW_CASES_3_DAY_AVERAGE_FIELD]
+    )
 
-        # Note: `covidtracking.com` has been returning `nan` values for the `negativeIncrease` signal for Hawaii since
-        #   October 8th. This has resulted in our 3DCS to go haywire. This field depends on those 3DCS so we mask it to
-        #   prevent bad data from showing up on the site.
-        if state == "Hawaii":
-            # Note: This is incredibly hacky but I couldn't figure out a way to make `pd.IndexSlice["2020-10": ]`
-            #   include the last value but doing this does.
-            covidtracking_df.loc[
-                (state, pd.IndexSlice["2020-10":"2261"]),
-                FRACTION_POSITIVE_NEW_TESTS_FIELD,
-            ] = np.nan
-
-        covidtracking_df.loc[(state,), FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD] = (
-            covidtracking_df.loc[(state,), POSITIVE_TESTS_TOTAL_3DCS_FIELD].astype(
-                float
-            )
-            / covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3DCS_FIELD]
-        ).values
+    # Calculate 3DCS new cases diff.
+    fields[NEW_CASES_3DCS_DIFF_FIELD] = by_state(fields[NEW_CASES_3DCS_FIELD]).diff(
+        periods=1
+    )
 
-        if state == "Hawaii":
-            covidtracking_df.loc[
-                (state, pd.IndexSlice["2020-10":"2261"]),
-                FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD,
-            ] = np.nan
+    # Calculate consecutive increases or decreases.
+    fields[CONSECUTIVE_INCREASE_NEW_CASES_3DCS_FIELD] = run_lengths_by_state(
+        meets_criteria=fields[NEW_CASES_3DCS_DIFF_FIELD] > 0,
+        field=CONSECUTIVE_INCREASE_NEW_CASES_3DCS_FIELD,
+    )
 
-        covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD] = (
-            100.0
-            * covidtracking_df.loc[(state,), FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD]
-        ).values
+    fields[CONSECUTIVE_DECREASE_NEW_CASES_3DCS_FIELD] = run_lengths_by_state(
+        meets_criteria=fields[NEW_CASES_3DCS_DIFF_FIELD] < 0,
+        field=CONSECUTIVE_DECREASE_NEW_CASES_3DCS_FIELD,
+    )
 
-        covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD].diff(
-                periods=1
-            )
-        ).values
+    # Calculate criteria 1A: must see at least 9 days of a decrease in new cases over a 14 day window.
+    fields[
+        MAX_RUN_OF_DECREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
+    ] = max_run_in_window_by_state(
+        series_=fields[NEW_CASES_3DCS_DIFF_FIELD], positive_values=False, window_size=14
+    )
 
-        if state == "Hawaii":
-            covidtracking_df.loc[
-                (state, pd.IndexSlice["2020-10":"2261"]),
-                PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD,
-            ] = np.nan
-
-        # Calculate 2A: Achieve 14 or more consecutive days of decline in percent positive ... with up to 2-3
-        # consecutive days of increasing or stable percent positive allowed as a grace period if data are inconsistent.
-        covidtracking_df.loc[
-            (state,), MAX_RUN_OF_DECREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD
-        ] = calculate_max_run_in_window(
-            series_=covidtracking_df.loc[
-                (state,), PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD
-            ],
-            window_size=14,
-            positive_values=False,
-        ).values
+    fields[CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD] = (
+        fields[MAX_RUN_OF_DECREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD] >= 10
+    )
 
-        covidtracking_df.loc[
-            (state,), MAX_RUN_OF_INCREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD
-        ] = calculate_max_run_in_window(
-            series_=covidtracking_df.loc[
-                (state,), PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD
-            ],
-            window_size=14,
-            positive_values=True,
-        ).values
+    # Calculate criteria 1B: must not see 5 or more days of an increase in new cases over a 14 day window.
+    fields[
+        MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
+    ] = max_run_in_window_by_state(
+        series_=fields[NEW_CASES_3DCS_DIFF_FIELD], positive_values=True, window_size=14
+    )
+
+    fields[CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD] = (
+        fields[MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD] < 5
+    )
 
-        covidtracking_df.loc[
-            (state,), CDC_CRITERIA_2A_COVID_PERCENT_CONTINUOUS_DECLINE_FIELD
-        ] = (
-            covidtracking_df.loc[
-                (state,), MAX_RUN_OF_DECREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD
+    # Calculate criteria 1C: new cases on T-0 must be < T-14.
+    fields[NEW_CASES_TODAY_MINUS_NEW_CASES_14_DAYS_AGO_3DCS_FIELD] = by_state(
+        fields[NEW_CASES_3DCS_FIELD]
+    ).diff(periods=14)
+    fields[CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD] = (
+        fields[NEW_CASES_TODAY_MINUS_NEW_CASES_14_DAYS_AGO_3DCS_FIELD] < 0
+    )
+
+    # Calculate criteria 1D: total cases from the last 14 days must be less than 10 per 100k population.
+    fields[TOTAL_NEW_CASES_IN_14_DAY_WINDOW_FIELD] = rolling_by_state(
+        series_=fields[NEW_CASES_FIELD].fillna(value=0), window=14, aggregation="sum"
+    )
+    fields[TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_FIELD] = (
+        100000.0 * fields[TOTAL_NEW_CASES_IN_14_DAY_WINDOW_FIELD]
+    ) / state_populations
+
+    fields[
+        TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD
+    ] = (fields[TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_FIELD] <= 10)
+
+    fields[
+        TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD
+    ] = (
+        by_state(
+            ~fields[
+                TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD
             ]
-            >= 11
-        ).values
+            & ~is_context
+        ).cumsum()
+        > 0
+    ) | initial_state_df[
+        TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD
+    ].reindex(
+        states
+    ).fillna(
+        False
+    ).astype(
+        bool
+    ).values
+
+    # To be true on 1D, the state must be (1) lower than the threshold, AND (2) previously above the threshold.
+    fields[CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE] = (
+        fields[
+            TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_PREVIOUSLY_ELEVATED_FIELD
+        ]
+        & fields[
+            TOTAL_NEW_CASES_IN_14_DAY_WINDOW_PER_100_K_POPULATION_LOWER_THAN_THRESHOLD_FIELD
+        ]
+    )
 
-        # Calculate 2B: Total test volume is stable or increasing.
-        covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_DIFF_3DCS_FIELD] = (
-            covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3DCS_FIELD]
-            .diff(periods=1)
-            .values
-        )
+    # Calculate a textual indicator function for the rebound.
+    fields[INDICATION_OF_NEW_CASES_REBOUND_FIELD] = calculate_indication_of_rebound(
+        max_run_of_increasing_new_cases=fields[
+            MAX_RUN_OF_INCREASING_NEW_CASES_IN_14_DAY_WINDOW_3DCS_FIELD
+        ],
+        near_zero_incidence=fields[CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE],
+    )
 
-        covidtracking_df.loc[
-            (state,), MAX_RUN_OF_INCREASING_TOTAL_TESTS_3DCS_FIELD
-        ] = calculate_max_run_in_window(
-            series_=covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_DIFF_3DCS_FIELD],
-            window_size=14,
-            positive_values=False,
-        ).values
+    # Calculate all of the criteria combined in category 1.
+    fields[CDC_CRITERIA_1_COMBINED_FIELD] = (
+        fields[CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD]
+        & fields[CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD]
+        & fields[CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD]
+    ) | fields[CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE]
+
+    ###### Calculate criteria category 2. ######
+    # For the criteria, we must add positive to negative tests to get the total (discarding inconclusive).
+    new_tests_total = (
+        covidtracking_df[NEW_CASES_POSITIVE_SOURCE_FIELD]
+        + covidtracking_df[NEW_CASES_NEGATIVE_SOURCE_FIELD]
+    ).astype(float)
+    fields[NEW_TESTS_TOTAL_FIELD] = new_tests_total.mask(new_tests_total < 0)
+
+    fields[NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD] = rolling_by_state(
+        series_=fields[NEW_TESTS_TOTAL_FIELD], window=3, aggregation="mean"
+    )
 
-        covidtracking_df.loc[
-            (state,), CDC_CRITERIA_2B_COVID_TOTAL_TEST_VOLUME_INCREASING_FIELD
-        ] = (
-            covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3DCS_FIELD].diff(periods=14)
-            >= 0
-        ).values
+    fields[NEW_TESTS_TOTAL_3DCS_FIELD] = spline_by_state(
+        fields[NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
+    )
 
-        # Calculate 2C: 14th day [of positive percentage of tests] must be lower than 1st day.
-        covidtracking_df.loc[
-            (state,), CDC_CRITERIA_2C_COVID_PERCENT_OVERALL_DECLINE_FIELD
-        ] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD].diff(
-                periods=14
-            )
-            < 0
-        ).values
+    fields[POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD] = rolling_by_state(
+        series_=covidtracking_df[NEW_CASES_POSITIVE_SOURCE_FIELD],
+        window=3,
+        aggregation="mean",
+    )
 
-        # Calculate 2D: Near-zero percent positive tests. [What is the explicit threshold here?]
-        covidtracking_df.loc[
-            (state,), CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD
-        ] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD] <= 1
-        ).values
+    fields[POSITIVE_TESTS_TOTAL_3DCS_FIELD] = spline_by_state(
+        fields[POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
+    )
 
-        # Calculate all of the criteria combined in category 2.
-        covidtracking_df.loc[(state,), CDC_CRITERIA_2_COMBINED_FIELD] = (
-            (
-                covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_2A_COVID_PERCENT_CONTINUOUS_DECLINE_FIELD
-                ]
-                & covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_2B_COVID_TOTAL_TEST_VOLUME_INCREASING_FIELD
-                ]
-                & covidtracking_df.loc[
-                    (state,), CDC_CRITERIA_2C_COVID_PERCENT_OVERALL_DECLINE_FIELD
-                ]
-            )
-            | covidtracking_df.loc[
-                (state,), CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD
-            ]
-        ).values
+    fields[FRACTION_POSITIVE_NEW_TESTS_FIELD] = (
+        covidtracking_df[NEW_CASES_POSITIVE_SOURCE_FIELD].astype(float)
+        / fields[NEW_TESTS_TOTAL_FIELD]
+    ).mask(is_masked_hawaii_data)
 
-        # Calculate Criteria 6A
-        covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_FIELD] = (
-            covidtracking_df.loc[(state,), FRACTION_POSITIVE_NEW_TESTS_FIELD] * 100
-        ).values
+    fields[FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD] = (
+        fields[POSITIVE_TESTS_TOTAL_3DCS_FIELD].astype(float)
+        / fields[NEW_TESTS_TOTAL_3DCS_FIELD]
+    ).mask(is_masked_hawaii_data)
 
-        covidtracking_df.loc[(state,), MAX_PERCENT_POSITIVE_TESTS_14_DAYS_FIELD] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_FIELD]
-            .rolling("14D")
-            .max()
-            .values
-        )
+    fields[PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD] = (
+        100.0 * fields[FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD]
+    )
 
-        covidtracking_df.loc[
-            (state,), MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3DCS_FIELD
-        ] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD]
-            .rolling("14D")
-            .max()
-            .values
-        )
+    fields[PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD] = (
+        by_state(fields[PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD])
+        .diff(periods=1)
+        .mask(is_masked_hawaii_data)
+    )
 
-        covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3D_FIELD] = (
-            100
-            * covidtracking_df.loc[(state,), POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
-            / covidtracking_df.loc[(state,), NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
-        ).values
+    # Calculate 2A: Achieve 14 or more consecutive days of decline in percent positive ... with up to 2-3
+    # consecutive days of increasing or stable percent positive allowed as a grace period if data are inconsistent.
+    fields[
+        MAX_RUN_OF_DECREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD
+    ] = max_run_in_window_by_state(
+        series_=fields[PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD],
+        window_size=14,
+        positive_values=False,
+    )
 
-        covidtracking_df.loc[(state,), MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3D_FIELD] = (
-            covidtracking_df.loc[(state,), PERCENT_POSITIVE_NEW_TESTS_3D_FIELD]
-            .rolling("14D")
-            .max()
-            .values
-        )
+    fields[
+        MAX_RUN_OF_INCREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD
+    ] = max_run_in_window_by_state(
+        series_=fields[PERCENT_POSITIVE_NEW_TESTS_DIFF_3DCS_FIELD],
+        window_size=14,
+        positive_values=True,
+    )
 
-        covidtracking_df.loc[(state,), CDC_CRITERIA_6A_14_DAY_MAX_PERCENT_POSITIVE] = (
-            covidtracking_df.loc[
-                (state,), MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3DCS_FIELD
-            ]
-            <= CDC_CRITERIA_6A_MAX_PERCENT_THRESHOLD
-        ).values
+    fields[CDC_CRITERIA_2A_COVID_PERCENT_CONTINUOUS_DECLINE_FIELD] = (
+        fields[MAX_RUN_OF_DECREASING_PERCENT_POSITIVE_TESTS_3DCS_FIELD] >= 11
+    )
 
-        # Calculate all of the criteria combined.
-        covidtracking_df.loc[(state,), CDC_CRITERIA_ALL_COMBINED_FIELD] = (
-            covidtracking_df.loc[(state,), CDC_CRITERIA_1_COMBINED_FIELD]
-            & covidtracking_df.loc[(state,), CDC_CRITERIA_2_COMBINED_FIELD]
-        ).values
+    # Calculate 2B: Total test volume is stable or increasing.
+    fields[NEW_TESTS_TOTAL_DIFF_3DCS_FIELD] = by_state(
+        fields[NEW_TESTS_TOTAL_3DCS_FIELD]
+    ).diff(periods=1)
 
-        # Calculate all of the criteria combined.
-        covidtracking_df.loc[(state,), CDC_CRITERIA_ALL_COMBINED_OR_FIELD] = (
-            covidtracking_df.loc[(state,), CDC_CRITERIA_1_COMBINED_FIELD]
-            | covidtracking_df.loc[(state,), CDC_CRITERIA_2_COMBINED_FIELD]
-        ).values
+    fields[MAX_RUN_OF_INCREASING_TOTAL_TESTS_3DCS_FIELD] = max_run_in_window_by_state(
+        series_=fields[NEW_TESTS_TOTAL_DIFF_3DCS_FIELD],
+        window_size=14,
+        positive_values=False,
+    )
+
+    fields[CDC_CRITERIA_2B_COVID_TOTAL_TEST_VOLUME_INCREASING_FIELD] = (
+        by_state(fields[NEW_TESTS_TOTAL_3DCS_FIELD]).diff(periods=14) >= 0
+    )
+
+    # Calculate 2C: 14th day [of positive percentage of tests] must be lower than 1st day.
+    fields[CDC_CRITERIA_2C_COVID_PERCENT_OVERALL_DECLINE_FIELD] = (
+        by_state(fields[PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD]).diff(periods=14) < 0
+    )
+
+    # Calculate 2D: Near-zero percent positive tests. [What is the explicit threshold here?]
+    fields[CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD] = (
+        fields[PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD] <= 1
+    )
 
-        # Calculate criteria streaks for Criteria 1 (A, B, C, D, Combined), Criteria 2 (A, B, C, D, Combined), and
-        # Criteria 6 (A).
-        for criteria_field in [
+    # Calculate all of the criteria combined in category 2.
+    fields[CDC_CRITERIA_2_COMBINED_FIELD] = (
+        fields[CDC_CRITERIA_2A_COVID_PERCENT_CONTINUOUS_DECLINE_FIELD]
+        & fields[CDC_CRITERIA_2B_COVID_TOTAL_TEST_VOLUME_INCREASING_FIELD]
+        & fields[CDC_CRITERIA_2C_COVID_PERCENT_OVERALL_DECLINE_FIELD]
+    ) | fields[CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD]
+
+    # Calculate Criteria 6A
+    fields[PERCENT_POSITIVE_NEW_TESTS_FIELD] = (
+        fields[FRACTION_POSITIVE_NEW_TESTS_FIELD] * 100
+    )
+
+    fields[MAX_PERCENT_POSITIVE_TESTS_14_DAYS_FIELD] = max_in_14_days_by_state(
+        fields[PERCENT_POSITIVE_NEW_TESTS_FIELD]
+    )
+
+    fields[MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3DCS_FIELD] = max_in_14_days_by_state(
+        fields[PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD]
+    )
+
+    fields[PERCENT_POSITIVE_NEW_TESTS_3D_FIELD] = (
+        100
+        * fields[POSITIVE_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
+        / fields[NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD]
+    )
+
+    fields[MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3D_FIELD] = max_in_14_days_by_state(
+        fields[PERCENT_POSITIVE_NEW_TESTS_3D_FIELD]
+    )
+
+    fields[CDC_CRITERIA_6A_14_DAY_MAX_PERCENT_POSITIVE] = (
+        fields[MAX_PERCENT_POSITIVE_TESTS_14_DAYS_3DCS_FIELD]
+        <= CDC_CRITERIA_6A_MAX_PERCENT_THRESHOLD
+    )
+
+    # Calculate all of the criteria combined.
+    fields[CDC_CRITERIA_ALL_COMBINED_FIELD] = (
+        fields[CDC_CRITERIA_1_COMBINED_FIELD] & fields[CDC_CRITERIA_2_COMBINED_FIELD]
+    )
+
+    # Calculate all of the criteria combined.
+    fields[CDC_CRITERIA_ALL_COMBINED_OR_FIELD] = (
+        fields[CDC_CRITERIA_1_COMBINED_FIELD] | fields[CDC_CRITERIA_2_COMBINED_FIELD]
+    )
+
+    # Calculate criteria streaks for Criteria 1 (A, B, C, D, Combined), Criteria 2 (A, B, C, D, Combined), and
+    # Criteria 6 (A), all at once.
+    streaks_by_state(
+        criteria_fields=[
             CDC_CRITERIA_1A_COVID_CONTINUOUS_DECLINE_FIELD,
             CDC_CRITERIA_1B_COVID_NO_REBOUNDS_FIELD,
             CDC_CRITERIA_1C_COVID_OVERALL_DECLINE_FIELD,
@@ -892,87 +1214,191 @@ def transform_covidtracking_data(covidtracking_df):
             CDC_CRITERIA_2D_COVID_NEAR_ZERO_POSITIVE_TESTS_FIELD,
             CDC_CRITERIA_2_COMBINED_FIELD,
             CDC_CRITERIA_6A_14_DAY_MAX_PERCENT_POSITIVE,
-        ]:
-            # Calculate both the negative (not meeting criteria) and positive (meeting criteria) streak series.
-            (
-                positive_streak_series,
-                negative_streak_series,
-            ) = calculate_consecutive_boolean_series(
-                boolean_series=covidtracking_df.loc[(state,), criteria_field]
-            )
+        ]
+    )
 
-            # Add the positive streak series to the combined frame.
-            covidtracking_df.loc[
-                (state,),
-                CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                ),
-            ] = positive_streak_series.values
+    # Calculate policy vs. trend charts data.
+    # Calculate raw cases per million.
+    fields[POLICY_VS_TREND_RAW_CASES_PER_MILLION] = (
+        fields[NEW_CASES_FIELD] / state_populations
+    ) * ONE_MILLION
 
-            # Add the negative streak series to the combined frame.
-            covidtracking_df.loc[
-                (state,),
-                CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                ),
-            ] = negative_streak_series.values
-
-        # Calculate policy vs. trend charts data.
-        # Calculate raw cases per million.
-        covidtracking_df.loc[(state,), POLICY_VS_TREND_RAW_CASES_PER_MILLION] = (
-            covidtracking_df.loc[(state,), NEW_CASES_FIELD].values / state_population
-        ) * ONE_MILLION
-
-        # Calculate 3DCS cases per million.
-        covidtracking_df.loc[(state,), POLICY_VS_TREND_3DCS_CASES_PER_MILLION] = (
-            covidtracking_df.loc[(state,), NEW_CASES_3DCS_FIELD].values
-            / state_population
-        ) * ONE_MILLION
-
-        # Calculate positivity 3DCS.
-        covidtracking_df.loc[
-            (state,), POLICY_VS_TREND_3DCS_POSITIVITY
-        ] = covidtracking_df.loc[
-            (state,), FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD
-        ].values
+    # Calculate 3DCS cases per million.
+    fields[POLICY_VS_TREND_3DCS_CASES_PER_MILLION] = (
+        fields[NEW_CASES_3DCS_FIELD] / state_populations
+    ) * ONE_MILLION
 
-    # Add an update time.
-    covidtracking_df[LAST_RAN_FIELD] = datetime.datetime.now()
+    # Calculate positivity 3DCS.
+    fields[POLICY_VS_TREND_3DCS_POSITIVITY] = fields[
+        FRACTION_POSITIVE_NEW_TESTS_3DCS_FIELD
+    ]
 
-    # Remove the multi-index, converting date and state back to just columns.
-    covidtracking_df = covidtracking_df.reset_index(drop=False)
+    # Add all of the new columns at once.
+    return pd.concat(
+        [covidtracking_df, pd.DataFrame(data=fields, index=covidtracking_df.index)],
+        axis=1,
+    )
 
-    # Use the date for each data entry as when the data were last updated.
-    covidtracking_df[LAST_UPDATED_FIELD] = covidtracking_df[DATE_SOURCE_FIELD]
 
-    # Join to lags of important variables that we want to plot in sparklines.
-    for field_to_lag, num_lags, suffix_with_date in [
-        (NEW_CASES_3DCS_FIELD, 121, False),
-        (PERCENT_POSITIVE_NEW_TESTS_3DCS_FIELD, 31, False),
-        (NEW_TESTS_TOTAL_3DCS_FIELD, 31, False),
-        (POLICY_VS_TREND_RAW_CASES_PER_MILLION, 300, True),
-        (POLICY_VS_TREND_3DCS_CASES_PER_MILLION, 300, True),
-        (POLICY_VS_TREND_3DCS_POSITIVITY, 300, True),
-    ]:
-        lags = generate_lags(
-            df=covidtracking_df,
-            column=field_to_lag,
-            num_lags=num_lags,
-            suffix_with_date=suffix_with_date,
-        )
-        covidtracking_df = covidtracking_df.merge(
-            right=lags, on=[STATE_FIELD, DATE_SOURCE_FIELD], how="left"
-        )
+def calculate_covidtracking_criteria_incrementally(
+    covidtracking_df,
+    previous_criteria_df,
+    state_population_data,
+    spline_backend=SPLINE_BACKEND_R,
+    max_workers=None,
+    refit_horizon=DEFAULT_REFIT_HORIZON_NUM_ROWS,
+):
+    """Updates the criteria calculated by a previous run, recomputing only the trailing rows of each state.
+
+    Rows are new or revised if they are missing from `previous_criteria_df` or if any of their source fields changed.
+    States without new, revised or removed rows are reused as they are. With a `refit_horizon` of `None`, every other
+    state is recomputed in full, so that every field matches a full recompute.
+
+    Otherwise, only the rows of a state from its first new or revised row, or from `refit_horizon` rows before its end
+    if that is earlier, are recomputed; every state with removed rows is still recomputed in full. Recomputed rows
+    re-read `INCREMENTAL_CONTEXT_NUM_ROWS` earlier rows and carry in the cumulative fields from the previous run. The
+    spline is only refit over the recomputed and context rows, with the `spar` that penalizes it as much as a fit over
+    all of the state's rows (see `calculate_equivalent_smoothing_parameter`), so that splined fields closely follow a
+    full recompute on the recomputed rows. A full recompute would also move the spline slightly on the earlier rows,
+    which keep the values of the previous run, so the criteria derived from it and their streaks and runs are only an
+    approximation of a full recompute.
+    """
+    states = covidtracking_df.index.get_level_values(STATE_FIELD)
+    positions = covidtracking_df.groupby(level=STATE_FIELD, sort=False).cumcount()
+    num_rows = positions.groupby(level=STATE_FIELD, sort=False).transform("size")
 
-    # Drop American Samoa because it's not reporting data
-    covidtracking_df = covidtracking_df.loc[
-        covidtracking_df[STATE_FIELD] != "American Samoa",
+    # Find the rows that are new or were revised since the previous run.
+    previous_source_df = previous_criteria_df[COVIDTRACKING_SOURCE_FIELDS].reindex(
+        covidtracking_df.index
+    )
+    source_df = covidtracking_df[COVIDTRACKING_SOURCE_FIELDS]
+    is_unchanged = (
+        (previous_source_df == source_df)
+        | (previous_source_df.isna() & source_df.isna())
+    ).all(axis=1) & covidtracking_df.index.isin(previous_criteria_df.index)
+
+    # Find the first changed position of each row's state, or the end of the state if nothing changed.
+    first_changed_positions = (
+        positions.where(~is_unchanged)
+        .groupby(level=STATE_FIELD, sort=False)
+        .transform("min")
+        .fillna(num_rows)
+    )
+
+    # Recompute states that have had rows removed from the start.
+    previous_states = previous_criteria_df.index.get_level_values(STATE_FIELD)
+    states_with_removed_rows = previous_states[
+        ~previous_criteria_df.index.isin(covidtracking_df.index)
+    ].unique()
+    first_changed_positions[states.isin(states_with_removed_rows)] = 0
+
+    if refit_horizon is None:
+        refit_horizon = num_rows
+    output_start_positions = np.where(
+        first_changed_positions < num_rows,
+        np.maximum(np.minimum(first_changed_positions, num_rows - refit_horizon), 0),
+        num_rows,
+    )
+    context_start_positions = np.maximum(
+        output_start_positions - INCREMENTAL_CONTEXT_NUM_ROWS, 0
+    )
+
+    is_recomputed = positions.values >= context_start_positions
+    is_output = positions.values >= output_start_positions
+    if not is_output.any():
+        return previous_criteria_df.reindex(covidtracking_df.index)
+
+    # Carry in the cumulative fields from the row just before each state's recomputed rows.
+    is_last_row_before_output = (positions.values == output_start_positions - 1) & (
+        output_start_positions < num_rows
+    )
+    initial_state_df = previous_criteria_df.loc[
+        covidtracking_df.index[is_last_row_before_output],
+        COVIDTRACKING_CARRIED_STATE_FIELDS,
     ]
 
-    return covidtracking_df
+    # Refit each state's splines over its recomputed rows with the same penalty, in days, as a fit over all of its
+    #   rows, so that they closely follow a full recompute near the end of the state.
+    x_values_df = pd.DataFrame(
+        data={
+            "x": get_spline_x_values(
+                covidtracking_df.index.get_level_values(DATE_SOURCE_FIELD)
+            ),
+            "is_recomputed": is_recomputed,
+        },
+        index=states,
+    )
+    smoothing_parameters_by_x_values = {}
+    spline_smoothing_parameters = {}
+    for state, state_x_values_df in x_values_df.groupby(level=STATE_FIELD, sort=False):
+        reference_x = state_x_values_df["x"].values
+        x = reference_x[state_x_values_df["is_recomputed"].values]
+        if len(x) == 0:
+            continue
+        key = (reference_x.tobytes(), x.tobytes())
+        if key not in smoothing_parameters_by_x_values:
+            smoothing_parameters_by_x_values[key] = float(
+                calculate_equivalent_smoothing_parameter(
+                    x=x,
+                    reference_x=reference_x,
+                    smoothing_parameter=COVIDTRACKING_SPLINE_SMOOTHING_PARAMETER,
+                )
+            )
+        spline_smoothing_parameters[state] = smoothing_parameters_by_x_values[key]
+
+    recomputed_df = apply_to_state_partitions(
+        df=covidtracking_df.loc[is_recomputed],
+        func=functools.partial(
+            calculate_covidtracking_criteria,
+            state_population_data=state_population_data,
+            spline_backend=spline_backend,
+            initial_state_df=initial_state_df,
+            spline_smoothing_parameters=pd.Series(
+                data=spline_smoothing_parameters, dtype=float
+            ),
+        ),
+        max_workers=max_workers,
+    )
+
+    return pd.concat(
+        [
+            previous_criteria_df.loc[covidtracking_df.index[~is_output]],
+            recomputed_df.loc[covidtracking_df.index[is_output]],
+        ],
+        axis=0,
+    ).reindex(covidtracking_df.index)
+
+
+def compare_criteria(criteria_df, expected_criteria_df):
+    """Compares two frames of calculated criteria that have the same index, e.g. an incremental and a full run.
+
+    Returns the maximum absolute difference of each numeric field, and the number of mismatched values of every other
+    field, indexed by field.
+    """
+    differences = {}
+    for field in expected_criteria_df.columns:
+        values = criteria_df[field]
+        expected_values = expected_criteria_df[field]
+        if pd.api.types.is_numeric_dtype(expected_values) and not (
+            pd.api.types.is_bool_dtype(expected_values)
+        ):
+            # Count values that are only missing on one side as infinitely different.
+            differences[field] = (
+                (values - expected_values)
+                .abs()
+                .mask(values.isna() != expected_values.isna(), np.inf)
+                .max()
+            )
+        else:
+            differences[field] = (
+                (values != expected_values) & ~(values.isna() & expected_values.isna())
+            ).sum()
+
+    return pd.Series(data=differences, dtype=float).fillna(0)
 
 
-def transform_cdc_ili_data(ili_df):
+@instrumented("transform_cdc_ili_data")
+def transform_cdc_ili_data(ili_df, spline_backend=SPLINE_BACKEND_R, max_workers=None):
     """Transforms data from https://gis.cdc.gov/grasp/fluview/fluportaldashboard.html and calculates CDC Criteria 5
     (A, B, C).
     """
@@ -999,8 +1425,6 @@ def transform_cdc_ili_data(ili_df):
         }
     )
 
-    states = ili_df[STATE_FIELD].unique()
-
     # Create a new multi-index containing the state name (`REGION`) and timestamp of the week.
     ili_df = ili_df.set_index(keys=[STATE_FIELD, DATE_SOURCE_FIELD])
 
@@ -1014,129 +1438,27 @@ def transform_cdc_ili_data(ili_df):
     ili_df[TOTAL_ILI] = ili_df[TOTAL_ILI].astype(float)
     ili_df[PERCENT_ILI] = ili_df[PERCENT_ILI].astype(float)
 
-    for state in states:
-        print(f"Processing CDC ILI data for state {state}...")
-
-        ###### Calculate criteria category 5. ######
-        # Calculate total cases (spline).
-        ili_df.loc[(state,), TOTAL_ILI_SPLINE] = fit_and_predict_cubic_spline_in_r(
-            series_=ili_df.loc[(state,), TOTAL_ILI], smoothing_parameter=0.5
-        ).values
-
-        # Calculate percent cases (spline).
-        ili_df.loc[(state,), PERCENT_ILI_SPLINE] = fit_and_predict_cubic_spline_in_r(
-            series_=ili_df.loc[(state,), PERCENT_ILI], smoothing_parameter=0.5
-        ).values
-
-        # Calculate change in total ILI
-        ili_df.loc[(state,), TOTAL_ILI_SPLINE_DIFF] = (
-            ili_df.loc[(state,), TOTAL_ILI_SPLINE].diff(periods=1).values
-        )
-
-        # Calculate change in percent ILI
-        ili_df.loc[(state,), PERCENT_ILI_SPLINE_DIFF] = (
-            ili_df.loc[(state,), PERCENT_ILI_SPLINE].diff(periods=1).values
-        )
-
-        # Calculate criteria 5A: must see two consecutive declines in weekly total ILI data.
-        ili_df.loc[
-            (state,), MAX_RUN_OF_DECREASING_TOTAL_ILI_SPLINE_DIFF
-        ] = calculate_max_run_in_window(
-            series_=ili_df.loc[(state,), TOTAL_ILI_SPLINE_DIFF],
-            positive_values=False,
-            window_size=2,
-        ).values
-
-        ili_df.loc[(state,), CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI] = (
-            ili_df.loc[(state,), MAX_RUN_OF_DECREASING_TOTAL_ILI_SPLINE_DIFF] >= 2
-        ).values
-
-        # Calculate criteria 5B: weekly total must be lower than weekly total 2 weeks ago.
-        ili_df.loc[(state,), TOTAL_ILI_TODAY_MINUS_TOTAL_ILI_14_DAYS_AGO] = (
-            ili_df.loc[(state,), TOTAL_ILI].diff(periods=2).values
-        )
-        ili_df.loc[(state,), CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI] = (
-            ili_df.loc[(state,), TOTAL_ILI_TODAY_MINUS_TOTAL_ILI_14_DAYS_AGO] < 0
-        ).values
-
-        # Calculate criteria 5C: must see two consecutive declines in weekly percent ILI data.
-        ili_df.loc[
-            (state,), MAX_RUN_OF_DECREASING_PERCENT_ILI_SPLINE_DIFF
-        ] = calculate_max_run_in_window(
-            series_=ili_df.loc[(state,), PERCENT_ILI_SPLINE_DIFF],
-            positive_values=False,
-            window_size=2,
-        ).values
-
-        ili_df.loc[(state,), CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI] = (
-            ili_df.loc[(state,), MAX_RUN_OF_DECREASING_PERCENT_ILI_SPLINE_DIFF] >= 2
-        ).values
-
-        # Calculate criteria 5D: weekly percent must be lower than weekly percent 2 weeks ago.
-        ili_df.loc[(state,), PERCENT_ILI_TODAY_MINUS_PERCENT_ILI_14_DAYS_AGO] = (
-            ili_df.loc[(state,), PERCENT_ILI].diff(periods=2).values
-        )
-        ili_df.loc[(state,), CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI] = (
-            ili_df.loc[(state,), PERCENT_ILI_TODAY_MINUS_PERCENT_ILI_14_DAYS_AGO] < 0
-        ).values
-
-        # Calculate the combined rating so far.
-        ili_df.loc[(state,), CDC_CRITERIA_5_COMBINED] = (
-            ili_df.loc[(state,), CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI]
-            & ili_df.loc[(state,), CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI]
-            & ili_df.loc[(state,), CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI]
-            & ili_df.loc[(state,), CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI]
-        ).values
-
-        # Calculate criteria streaks for Criteria 5 (A, B, C, D, Combined).
-        for criteria_field in [
-            CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI,
-            CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI,
-            CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI,
-            CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI,
-            CDC_CRITERIA_5_COMBINED,
-        ]:
-            # Calculate both the negative (not meeting criteria) and positive (meeting criteria) streak series.
-            (
-                positive_streak_series,
-                negative_streak_series,
-            ) = calculate_consecutive_boolean_series(
-                boolean_series=ili_df.loc[(state,), criteria_field]
-            )
-
-            # Add the positive streak series to the combined frame.
-            ili_df.loc[
-                (state,),
-                CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                ),
-            ] = positive_streak_series.values
-
-            # Add the negative streak series to the combined frame.
-            ili_df.loc[
-                (state,),
-                CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                ),
-            ] = negative_streak_series.values
+    ili_df = apply_to_state_partitions(
+        df=ili_df,
+        func=functools.partial(
+            calculate_cdc_ili_criteria, spline_backend=spline_backend
+        ),
+        max_workers=max_workers,
+    )
 
     # Remove the multi-index, converting date and state back to just columns.
     ili_df = ili_df.reset_index(drop=False)
 
     # Join to lags of important variables that we want to plot in sparklines.
-    for field_to_lag, num_lags in [
-        (PERCENT_ILI, PERCENT_ILI_NUM_LAGS),
-        (TOTAL_ILI, TOTAL_ILI_NUM_LAGS),
-    ]:
-        lags = generate_lags(
-            df=ili_df,
-            column=field_to_lag,
-            num_lags=num_lags,
-            lag_timedelta=datetime.timedelta(days=7),
-        )
-        ili_df = ili_df.merge(
-            right=lags, on=[STATE_FIELD, DATE_SOURCE_FIELD], how="left"
-        )
+    lags = generate_lags_for_columns(
+        df=ili_df,
+        lag_specifications=[
+            (PERCENT_ILI, PERCENT_ILI_NUM_LAGS, False),
+            (TOTAL_ILI, TOTAL_ILI_NUM_LAGS, False),
+        ],
+        lag_timedelta=datetime.timedelta(days=7),
+    )
+    ili_df = ili_df.merge(right=lags, on=[STATE_FIELD, DATE_SOURCE_FIELD], how="left")
 
     ili_df[LAST_UPDATED_FIELD] = ili_df[DATE_SOURCE_FIELD]
     ili_df[LAST_RAN_FIELD] = datetime.datetime.now()
@@ -1144,7 +1466,10 @@ def transform_cdc_ili_data(ili_df):
     return ili_df
 
 
-def transform_cdc_beds_data(cdc_beds_current_df, cdc_beds_historical_df):
+@instrumented("transform_cdc_beds_data")
+def transform_cdc_beds_data(
+    cdc_beds_current_df, cdc_beds_historical_df, max_workers=None
+):
     """Transforms data from https://www.cdc.gov/nhsn/covid19/report-patient-impact.html and calculates CDC Criteria 3
     (A).
     """
@@ -1176,60 +1501,9 @@ def transform_cdc_beds_data(cdc_beds_current_df, cdc_beds_historical_df):
 
     cdc_df = cdc_df.sort_index()  # ascending date and state
 
-    # Calculate 3A: ICU and in-patient beds must have < 80% utilization for 7 consecutive days
-    # Hack because GROUPBY ROLLING doesn't work for datetimeindex. Thanks Pandas.
-    states = cdc_df.index.get_level_values(STATE_FIELD).unique()
-    state_dfs = []
-    for state in states:
-        print(f"Transforming CDC beds data for state {state}...")
-        state_df = cdc_df.xs(state, axis=0, level=STATE_FIELD)
-        state_df[MAX_INPATIENT_BED_OCCUPATION_7_DAYS] = (
-            state_df[INPATIENT_PERCENT_OCCUPIED]
-            .rolling(f"{CRITERIA_3A_NUM_CONSECUTIVE_DAYS}D")
-            .max()
-        )
-        state_df[MAX_ICU_BED_OCCUPATION_7_DAYS] = (
-            state_df[ICU_PERCENT_OCCUPIED]
-            .rolling(f"{CRITERIA_3A_NUM_CONSECUTIVE_DAYS}D")
-            .max()
-        )
-        state_df[CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD] = (
-            state_df[MAX_INPATIENT_BED_OCCUPATION_7_DAYS] < PHASE_1_OCCUPATION_THRESHOLD
-        ) & (state_df[MAX_ICU_BED_OCCUPATION_7_DAYS] < PHASE_1_OCCUPATION_THRESHOLD)
-        state_df[CDC_CRITERIA_3_COMBINED_FIELD] = state_df[
-            CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD
-        ]
-
-        # Calculate criteria streaks for Criteria 5 (A, B, C, D, Combined).
-        for criteria_field in [
-            CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD,
-            CDC_CRITERIA_3_COMBINED_FIELD,
-        ]:
-            # Calculate both the negative (not meeting criteria) and positive (meeting criteria) streak series.
-            (
-                positive_streak_series,
-                negative_streak_series,
-            ) = calculate_consecutive_boolean_series(
-                boolean_series=state_df[criteria_field]
-            )
-
-            # Add the positive streak series to the combined frame.
-            state_df[
-                CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                )
-            ] = positive_streak_series.values
-
-            # Add the negative streak series to the combined frame.
-            state_df[
-                CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(
-                    criteria_field=criteria_field
-                )
-            ] = negative_streak_series.values
-
-        state_dfs.append(state_df)
-
-    combined_df = pd.concat(state_dfs, keys=states, names=[STATE_FIELD])
+    combined_df = apply_to_state_partitions(
+        df=cdc_df, func=calculate_cdc_beds_criteria, max_workers=max_workers
+    )
 
     # Reindex so gaps are NaN instead of missing
     unique_dates = combined_df.index.get_level_values(level=DATE_SOURCE_FIELD).unique()
@@ -1243,6 +1517,165 @@ def transform_cdc_beds_data(cdc_beds_current_df, cdc_beds_historical_df):
     return combined_df
 
 
+def calculate_cdc_ili_criteria(ili_df, spline_backend=SPLINE_BACKEND_R):
+    """Calculates the derived fields for CDC Criteria 5 for every state at once.
+
+    `ili_df` must be indexed by (state, date) and sorted by that index.
+    """
+    fields = {}
+
+    def by_state(series_):
+        return series_.groupby(level=STATE_FIELD, sort=False)
+
+    def spline_by_state(series_):
+        return fit_and_predict_cubic_spline_by_state(
+            series_=series_, smoothing_parameter=0.5, backend=spline_backend
+        )
+
+    def max_run_in_window_by_state(series_, positive_values, window_size):
+        return apply_to_state_matrix(
+            series_=series_,
+            func=lambda matrix: calculate_max_run_in_window(
+                series_=matrix, positive_values=positive_values, window_size=window_size
+            ),
+        )
+
+    ###### Calculate criteria category 5. ######
+    # Calculate total cases (spline).
+    fields[TOTAL_ILI_SPLINE] = spline_by_state(ili_df[TOTAL_ILI])
+
+    # Calculate percent cases (spline).
+    fields[PERCENT_ILI_SPLINE] = spline_by_state(ili_df[PERCENT_ILI])
+
+    # Calculate change in total ILI
+    fields[TOTAL_ILI_SPLINE_DIFF] = by_state(fields[TOTAL_ILI_SPLINE]).diff(periods=1)
+
+    # Calculate change in percent ILI
+    fields[PERCENT_ILI_SPLINE_DIFF] = by_state(fields[PERCENT_ILI_SPLINE]).diff(
+        periods=1
+    )
+
+    # Calculate criteria 5A: must see two consecutive declines in weekly total ILI data.
+    fields[MAX_RUN_OF_DECREASING_TOTAL_ILI_SPLINE_DIFF] = max_run_in_window_by_state(
+        series_=fields[TOTAL_ILI_SPLINE_DIFF], positive_values=False, window_size=2
+    )
+
+    fields[CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI] = (
+        fields[MAX_RUN_OF_DECREASING_TOTAL_ILI_SPLINE_DIFF] >= 2
+    )
+
+    # Calculate criteria 5B: weekly total must be lower than weekly total 2 weeks ago.
+    fields[TOTAL_ILI_TODAY_MINUS_TOTAL_ILI_14_DAYS_AGO] = by_state(
+        ili_df[TOTAL_ILI]
+    ).diff(periods=2)
+    fields[CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI] = (
+        fields[TOTAL_ILI_TODAY_MINUS_TOTAL_ILI_14_DAYS_AGO] < 0
+    )
+
+    # Calculate criteria 5C: must see two consecutive declines in weekly percent ILI data.
+    fields[MAX_RUN_OF_DECREASING_PERCENT_ILI_SPLINE_DIFF] = max_run_in_window_by_state(
+        series_=fields[PERCENT_ILI_SPLINE_DIFF], positive_values=False, window_size=2
+    )
+
+    fields[CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI] = (
+        fields[MAX_RUN_OF_DECREASING_PERCENT_ILI_SPLINE_DIFF] >= 2
+    )
+
+    # Calculate criteria 5D: weekly percent must be lower than weekly percent 2 weeks ago.
+    fields[PERCENT_ILI_TODAY_MINUS_PERCENT_ILI_14_DAYS_AGO] = by_state(
+        ili_df[PERCENT_ILI]
+    ).diff(periods=2)
+    fields[CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI] = (
+        fields[PERCENT_ILI_TODAY_MINUS_PERCENT_ILI_14_DAYS_AGO] < 0
+    )
+
+    # Calculate the combined rating so far.
+    fields[CDC_CRITERIA_5_COMBINED] = (
+        fields[CDC_CRITERIA_5A_14_DAY_DECLINE_TOTAL_ILI]
+        & fields[CDC_CRITERIA_5B_OVERALL_DECLINE_TOTAL_ILI]
+        & fields[CDC_CRITERIA_5C_14_DAY_DECLINE_PERCENT_ILI]
+        & fields[CDC_CRITERIA_5D_OVERALL_DECLINE_PERCENT_ILI]
+    )
+
+    # Calculate criteria streaks for Criteria 5 (A, B, C, D, Combined), all at once.
+    criteria_fields = CDC_ILI_CRITERIA_FIELDS
+    positive_streaks, negative_streaks = calculate_streaks_by_state(
+        meets_criteria_df=pd.DataFrame(
+            data={field: fields[field] for field in criteria_fields},
+            index=ili_df.index,
+        )
+    )
+    for criteria_field in criteria_fields:
+        fields[
+            CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(
+                criteria_field=criteria_field
+            )
+        ] = positive_streaks[criteria_field].astype(float)
+        fields[
+            CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(
+                criteria_field=criteria_field
+            )
+        ] = negative_streaks[criteria_field].astype(float)
+
+    # Store the criteria fields as `bool`, as the covidtracking criteria are.
+    for criteria_field in criteria_fields:
+        fields[criteria_field] = fields[criteria_field].astype(bool)
+
+    # Add all of the new columns at once.
+    return pd.concat([ili_df, pd.DataFrame(data=fields, index=ili_df.index)], axis=1)
+
+
+def calculate_cdc_beds_criteria(cdc_df):
+    """Calculates the derived fields for CDC Criteria 3 for every state at once.
+
+    `cdc_df` must be indexed by (state, date) and sorted by that index.
+    """
+    cdc_df = cdc_df.copy()
+
+    # Calculate 3A: ICU and in-patient beds must have < 80% utilization for 7 consecutive days
+    # Note: rolling by a time offset needs a single datetime index, so each state is rolled separately.
+    cdc_df[MAX_INPATIENT_BED_OCCUPATION_7_DAYS] = apply_by_state(
+        series_=cdc_df[INPATIENT_PERCENT_OCCUPIED],
+        func=lambda state_series: state_series.rolling(
+            f"{CRITERIA_3A_NUM_CONSECUTIVE_DAYS}D"
+        ).max(),
+    )
+    cdc_df[MAX_ICU_BED_OCCUPATION_7_DAYS] = apply_by_state(
+        series_=cdc_df[ICU_PERCENT_OCCUPIED],
+        func=lambda state_series: state_series.rolling(
+            f"{CRITERIA_3A_NUM_CONSECUTIVE_DAYS}D"
+        ).max(),
+    )
+    cdc_df[CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD] = (
+        cdc_df[MAX_INPATIENT_BED_OCCUPATION_7_DAYS] < PHASE_1_OCCUPATION_THRESHOLD
+    ) & (cdc_df[MAX_ICU_BED_OCCUPATION_7_DAYS] < PHASE_1_OCCUPATION_THRESHOLD)
+    cdc_df[CDC_CRITERIA_3_COMBINED_FIELD] = cdc_df[
+        CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD
+    ]
+
+    # Calculate criteria streaks for Criteria 3 (A, Combined), all at once.
+    criteria_fields = [
+        CDC_CRITERIA_3A_HOSPITAL_BED_UTILIZATION_FIELD,
+        CDC_CRITERIA_3_COMBINED_FIELD,
+    ]
+    positive_streaks, negative_streaks = calculate_streaks_by_state(
+        meets_criteria_df=cdc_df[criteria_fields]
+    )
+    for criteria_field in criteria_fields:
+        cdc_df[
+            CDC_CRITERIA_POSITIVE_STREAK_FIELD_PRE_FORMAT.format(
+                criteria_field=criteria_field
+            )
+        ] = positive_streaks[criteria_field]
+        cdc_df[
+            CDC_CRITERIA_NEGATIVE_STREAK_FIELD_PRE_FORMAT.format(
+                criteria_field=criteria_field
+            )
+        ] = negative_streaks[criteria_field]
+
+    return cdc_df
+
+
 def indication_of_rebound(series_):
     indicator = None
     if series_[CDC_CRITERIA_1D_COVID_NEAR_ZERO_INCIDENCE] is True:
@@ -1256,3 +1689,18 @@ def indication_of_rebound(series_):
             indicator = "Rebound"
 
     return indicator
+
+
+def calculate_indication_of_rebound(
+    max_run_of_increasing_new_cases, near_zero_incidence
+):
+    """Calculates `indication_of_rebound` for every row at once."""
+    indication = pd.Series(data=None, index=near_zero_incidence.index, dtype=object)
+
+    # Later conditions take precedence, as in `indication_of_rebound`.
+    for threshold, indicator in [(0, "Clear"), (3, "Caution"), (5, "Rebound")]:
+        indication[max_run_of_increasing_new_cases >= threshold] = indicator
+
+    indication[near_zero_incidence.astype(bool)] = "Low Case Count"
+
+    return indication
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from covid.extract import DATE_SOURCE_FIELD
+from covid.extract import extract_state_population_data
+from covid.extract import NEW_CASES_NEGATIVE_SOURCE_FIELD
+from covid.extract import NEW_CASES_POSITIVE_SOURCE_FIELD
+from covid.extract import STATE_SOURCE_FIELD
+from covid.extract import TOTAL_CASES_SOURCE_FIELD
+from covid.transform import CDC_ILI_CRITERIA_FIELDS
+from covid.transform import compare_criteria
+from covid.transform import COVIDTRACKING_CRITERIA_FIELDS
+from covid.transform import COVIDTRACKING_SMOOTHED_FIELDS
+from covid.transform import DEFAULT_REFIT_HORIZON_NUM_ROWS
+from covid.transform import NEW_CASES_3_DAY_AVERAGE_FIELD
+from covid.transform import NEW_CASES_3DCS_FIELD
+from covid.transform import NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD
+from covid.transform import NEW_TESTS_TOTAL_3DCS_FIELD
+from covid.transform import transform_cdc_ili_data
+from covid.transform import transform_covidtracking_data
+from covid.transform_utils import SPLINE_BACKEND_NATIVE
+
+
+def make_covidtracking_df(num_days):
+    random_state = np.random.RandomState(0)
+    dfs = []
+    for index, state in enumerate(["AK", "AL", "AR"]):
+        # Give each state a wave, so that criteria and their streaks change over time.
+        days = np.arange(num_days)
+        new_cases = random_state.poisson(
+            200 + 150 * np.sin(days / (10.0 + index)) + 150
+        ).astype(float)
+        dfs.append(
+            pd.DataFrame(
+                data={
+                    STATE_SOURCE_FIELD: state,
+                    DATE_SOURCE_FIELD: pd.date_range(
+                        start="2020-05-01", periods=num_days
+                    ).strftime("%Y%m%d"),
+                    TOTAL_CASES_SOURCE_FIELD: np.cumsum(new_cases),
+                    NEW_CASES_POSITIVE_SOURCE_FIELD: new_cases,
+                    NEW_CASES_NEGATIVE_SOURCE_FIELD: random_state.poisson(
+                        3000, size=num_days
+                    ).astype(float),
+                }
+            )
+        )
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+def make_cdc_ili_df(num_weeks):
+    random_state = np.random.RandomState(0)
+    states = ["Alaska", "Alabama"]
+    return pd.DataFrame(
+        data={
+            "REGION TYPE": "States",
+            "REGION": np.repeat(states, num_weeks),
+            "YEAR": 2020,
+            "WEEK": np.tile(np.arange(1, num_weeks + 1), len(states)),
+            "%UNWEIGHTED ILI": random_state.uniform(
+                0.5, 4, size=len(states) * num_weeks
+            )
+            .round(3)
+            .astype(str),
+            "ILITOTAL": random_state.randint(
+                50, 900, size=len(states) * num_weeks
+            ).astype(str),
+        }
+    )
+
+
+class TransformTest(unittest.TestCase):
+    def test_criteria_dtypes(self):
+        # The criteria of every source are stored as `bool`, so that they are uploaded the same way.
+        covidtracking_df = transform_covidtracking_data(
+            covidtracking_df=make_covidtracking_df(num_days=60),
+            spline_backend=SPLINE_BACKEND_NATIVE,
+        )
+        ili_df = transform_cdc_ili_data(
+            ili_df=make_cdc_ili_df(num_weeks=20), spline_backend=SPLINE_BACKEND_NATIVE
+        )
+
+        for df, criteria_fields in [
+            (covidtracking_df, COVIDTRACKING_CRITERIA_FIELDS),
+            (ili_df, CDC_ILI_CRITERIA_FIELDS),
+        ]:
+            self.assertEqual(
+                df[criteria_fields].dtypes.unique().tolist(), [np.dtype(bool)]
+            )
+
+    def transform_and_read_criteria(
+        self,
+        covidtracking_df,
+        incremental_state_path,
+        population_data=None,
+        refit_horizon=None,
+        check_incremental_parity=False,
+    ):
+        transform_covidtracking_data(
+            covidtracking_df=covidtracking_df.copy(),
+            spline_backend=SPLINE_BACKEND_NATIVE,
+            incremental_state_path=incremental_state_path,
+            refit_horizon=refit_horizon,
+            check_incremental_parity=check_incremental_parity,
+            population_data=population_data,
+        )
+        return pd.read_pickle(incremental_state_path)["criteria"]
+
+    def transform_nightly_update(self, refit_horizon, check_incremental_parity=False):
+        covidtracking_df = make_covidtracking_df(num_days=120)
+        is_latest_day = (
+            covidtracking_df[DATE_SOURCE_FIELD]
+            == covidtracking_df[DATE_SOURCE_FIELD].max()
+        )
+
+        # Add a day for every state but Arkansas, and revise a day of Alabama, as a nightly update would.
+        updated_df = covidtracking_df.loc[
+            ~is_latest_day | (covidtracking_df[STATE_SOURCE_FIELD] != "AR")
+        ].copy()
+        updated_df.loc[
+            (updated_df[STATE_SOURCE_FIELD] == "AL")
+            & (updated_df[DATE_SOURCE_FIELD] == "20200610"),
+            NEW_CASES_POSITIVE_SOURCE_FIELD,
+        ] += 50
+
+        with tempfile.TemporaryDirectory() as directory:
+            incremental_state_path = os.path.join(directory, "incremental.pkl")
+            self.transform_and_read_criteria(
+                covidtracking_df=covidtracking_df.loc[~is_latest_day],
+                incremental_state_path=incremental_state_path,
+            )
+            criteria_df = self.transform_and_read_criteria(
+                covidtracking_df=updated_df,
+                incremental_state_path=incremental_state_path,
+                refit_horizon=refit_horizon,
+                check_incremental_parity=check_incremental_parity,
+            )
+            expected_criteria_df = self.transform_and_read_criteria(
+                covidtracking_df=updated_df,
+                incremental_state_path=os.path.join(directory, "full.pkl"),
+            )
+
+        return criteria_df, expected_criteria_df
+
+    def test_transform_covidtracking_data_incrementally(self):
+        # Without a refit horizon, states with new or revised rows are recomputed in full.
+        criteria_df, expected_criteria_df = self.transform_nightly_update(
+            refit_horizon=None
+        )
+
+        # Every field that isn't smoothed, including the criteria derived from the spline and their streaks and runs,
+        # matches a full recompute exactly; smoothed fields may differ in their last bits, as states are fit in batches.
+        differences = compare_criteria(
+            criteria_df=criteria_df, expected_criteria_df=expected_criteria_df
+        )
+        is_smoothed_field = differences.index.isin(COVIDTRACKING_SMOOTHED_FIELDS)
+        self.assertEqual(
+            differences[~is_smoothed_field & (differences > 0)].to_dict(), {}
+        )
+        self.assertLess(differences[is_smoothed_field].max(), 1e-9)
+
+    def test_transform_covidtracking_data_incrementally_with_refit_horizon(self):
+        with self.assertLogs("covid.transform", level="INFO") as logs:
+            criteria_df, expected_criteria_df = self.transform_nightly_update(
+                refit_horizon=DEFAULT_REFIT_HORIZON_NUM_ROWS,
+                check_incremental_parity=True,
+            )
+
+        # The parity check reports how far the incremental run is from a full recompute.
+        self.assertTrue(
+            any("differ from a full recompute" in output for output in logs.output)
+        )
+
+        # Fields that don't depend on the spline match exactly, and the refit splines closely follow a full recompute
+        #   over the refit horizon.
+        is_refit = (
+            expected_criteria_df.groupby(level=0).cumcount(ascending=False)
+            < DEFAULT_REFIT_HORIZON_NUM_ROWS
+        ).values
+        differences = compare_criteria(
+            criteria_df=criteria_df, expected_criteria_df=expected_criteria_df
+        )
+        for field in [
+            NEW_CASES_3_DAY_AVERAGE_FIELD,
+            NEW_TESTS_TOTAL_3_DAY_AVERAGE_FIELD,
+        ]:
+            self.assertEqual(differences[field], 0)
+        for field in [NEW_CASES_3DCS_FIELD, NEW_TESTS_TOTAL_3DCS_FIELD]:
+            expected_values = expected_criteria_df.loc[is_refit, field]
+            self.assertLess(
+                (criteria_df.loc[is_refit, field] - expected_values).abs().max(),
+                1e-3 * expected_values.abs().max(),
+            )
+
+    def test_transform_covidtracking_data_incrementally_with_other_parameters(self):
+        covidtracking_df = make_covidtracking_df(num_days=60)
+
+        with tempfile.TemporaryDirectory() as directory:
+            incremental_state_path = os.path.join(directory, "incremental.pkl")
+            self.transform_and_read_criteria(
+                covidtracking_df=covidtracking_df,
+                incremental_state_path=incremental_state_path,
+                population_data=extract_state_population_data() * 2,
+            )
+            criteria_df = self.transform_and_read_criteria(
+                covidtracking_df=covidtracking_df,
+                incremental_state_path=incremental_state_path,
+            )
+            expected_criteria_df = self.transform_and_read_criteria(
+                covidtracking_df=covidtracking_df,
+                incremental_state_path=os.path.join(directory, "full.pkl"),
+            )
+
+        # Criteria calculated with other populations aren't reused, even though no rows changed.
+        differences = compare_criteria(
+            criteria_df=criteria_df, expected_criteria_df=expected_criteria_df
+        )
+        self.assertEqual(differences[differences > 0].to_dict(), {})
@@ -1,12 +1,29 @@
 import datetime
+import functools
+import logging
 
 import numpy as np
 import pandas as pd
-from rpy2 import robjects as robjects
 from scipy import interpolate as interpolate
 
 from covid.extract import DATE_SOURCE_FIELD
 from covid.extract import STATE_FIELD
+from covid.instrumentation import call_and_collect_spans
+from covid.instrumentation import record_spans
+from covid.instrumentation import span
+from covid.pipeline import start_process_executor
+from covid.smoothing_spline import factor_smoothing_spline
+from covid.smoothing_spline import fit_smoothing_spline
+from covid.smoothing_spline import fit_smoothing_spline_by_gcv
+from covid.smoothing_spline import prepare_smoothing_spline
+from covid.smoothing_spline import solve_smoothing_spline
+
+logger = logging.getLogger(__name__)
+
+# Define the backends that can be used to fit smoothing splines.
+SPLINE_BACKEND_R = "r"
+SPLINE_BACKEND_NATIVE = "native"
+SPLINE_BACKENDS = [SPLINE_BACKEND_R, SPLINE_BACKEND_NATIVE]
 
 
 def fit_and_predict_cubic_spline(series_):
@@ -33,11 +50,15 @@ def fit_and_predict_cubic_spline(series_):
 
 
 def fit_and_predict_cubic_spline_in_r(
-    series_, smoothing_parameter=None, replace_nan=True
+    series_, smoothing_parameter=None, replace_nan=True, backend=SPLINE_BACKEND_R
 ):
-    if not smoothing_parameter:
-        # Import `NULL` from R.
-        smoothing_parameter = robjects.r["as.null"]()
+    """Fits a smoothing spline to the series, as R's `smooth.spline` does, and predicts it at the series' index.
+
+    Set `backend` to `SPLINE_BACKEND_NATIVE` to fit the spline in NumPy/SciPy (see `covid.smoothing_spline`) instead
+    of through an embedded R interpreter.
+    """
+    if backend not in SPLINE_BACKENDS:
+        raise ValueError(f"Unknown spline backend {backend}.")
 
     # Assert that the index is sorted.
     if not series_.index.is_monotonic_increasing:
@@ -47,6 +68,23 @@ def fit_and_predict_cubic_spline_in_r(
     if replace_nan:
         series_ = series_.fillna(value=0)
 
+    if backend == SPLINE_BACKEND_NATIVE:
+        predicted_spline_values = fit_smoothing_spline(
+            x=get_spline_x_values(series_.index),
+            y=series_.values.astype(float),
+            # Note: like R's `NULL`, a missing (or zero) smoothing parameter chooses one by GCV.
+            smoothing_parameter=smoothing_parameter or None,
+        )
+
+        return pd.Series(data=predicted_spline_values, index=series_.index)
+
+    # Import R here rather than at module load, since this starts an embedded R interpreter.
+    from rpy2 import robjects as robjects
+
+    if not smoothing_parameter:
+        # Import `NULL` from R.
+        smoothing_parameter = robjects.r["as.null"]()
+
     r_x = robjects.DateVector(series_.index)
     r_y = robjects.FloatVector(series_.values.astype(float))
 
@@ -68,6 +106,77 @@ def fit_and_predict_cubic_spline_in_r(
     return predicted_spline_series
 
 
+def fit_and_predict_smoothing_spline_batch(
+    matrix, index, smoothing_parameter=None, replace_nan=True
+):
+    """Fits a native smoothing spline to every row of a series x dates matrix that shares the same date `index`.
+
+    The spline design and its banded factorization depend only on the dates and the smoothing parameter, so they are
+    built once and every row is solved together. If `replace_nan` is `False`, null values are treated as missing
+    instead of zero: rows are fit only on the dates they have values for (rows missing the same dates share a
+    design) and the result is null on the missing dates.
+
+    `matrix` may be a `np.ndarray` or a `pd.DataFrame` (with one row per series); the same type is returned.
+    """
+    if not index.is_monotonic_increasing:
+        raise ValueError("Index is not sorted.")
+
+    values = np.array(matrix, dtype=float, ndmin=2)
+    if values.shape[1] != len(index):
+        raise ValueError("The matrix must have one column for every date in the index.")
+
+    if replace_nan:
+        values = np.where(np.isnan(values), 0.0, values)
+
+    x = get_spline_x_values(index)
+    predicted_spline_values = np.full(shape=values.shape, fill_value=np.nan)
+
+    # Group together the rows that are missing values on the same dates, since they can share a design.
+    is_present = ~np.isnan(values)
+    present_patterns, pattern_positions = np.unique(
+        is_present, axis=0, return_inverse=True
+    )
+
+    for pattern_position, present_pattern in enumerate(present_patterns):
+        rows = np.flatnonzero(pattern_positions.reshape(-1) == pattern_position)
+        design = prepare_smoothing_spline(x=x[present_pattern])
+        pattern_values = values[np.ix_(rows, present_pattern)]
+
+        if smoothing_parameter:
+            fitted_values = solve_smoothing_spline(
+                design=design,
+                cholesky_factor=factor_smoothing_spline(
+                    design=design, smoothing_parameter=smoothing_parameter
+                ),
+                y=pattern_values.T,
+            ).T
+        else:
+            # Note: like R's `NULL`, a missing (or zero) smoothing parameter chooses one for each row by GCV.
+            fitted_values = np.array(
+                [
+                    fit_smoothing_spline_by_gcv(design=design, y=row_values)[1]
+                    for row_values in pattern_values
+                ]
+            )
+
+        predicted_spline_values[np.ix_(rows, present_pattern)] = fitted_values
+
+    if isinstance(matrix, pd.DataFrame):
+        return pd.DataFrame(
+            data=predicted_spline_values, index=matrix.index, columns=matrix.columns
+        )
+
+    return predicted_spline_values.reshape(np.shape(matrix))
+
+
+def get_spline_x_values(index):
+    """Converts an index to the numeric `x` values a spline is fit on (days, for a `DatetimeIndex`)."""
+    if isinstance(index, pd.DatetimeIndex):
+        return ((index - index[0]) / datetime.timedelta(days=1)).values
+
+    return np.asarray(index, dtype=float)
+
+
 def calculate_consecutive_positive_or_negative_values(series_, positive_values=True):
     meets_criteria = series_ > 0 if positive_values else series_ < 0
     consecutive_positive_values = meets_criteria * (
@@ -79,26 +188,174 @@ def calculate_consecutive_positive_or_negative_values(series_, positive_values=T
     return consecutive_positive_values
 
 
-def calculate_max_run_in_window(series_, positive_values, window_size=14):
-    # Assert that the index is sorted.
-    if not series_.index.is_monotonic_increasing:
-        raise ValueError("Index is not sorted.")
+def calculate_run_lengths(meets_criteria, initial_run_lengths=None):
+    """Calculates, for each position along the last axis, the length of the run of `True` values ending there.
+
+    Works on 1-D or 2-D boolean arrays (e.g. states x dates) in a single vectorized pass. `initial_run_lengths` (a
+    scalar, or one value per row) carries in the length of a run that was already in progress before the first
+    position, e.g. from a previous run over earlier data.
+    """
+    positions = np.arange(meets_criteria.shape[-1])
 
-    returned_series = pd.Series(index=series_.index, data=np.nan)
+    # Track the position of the most recent `False` value; the run length is the distance from it.
+    last_reset_positions = np.maximum.accumulate(
+        np.where(meets_criteria, -1, positions), axis=-1
+    )
+    run_lengths = positions - last_reset_positions
+
+    if initial_run_lengths is not None:
+        # Runs that have not been reset since the first position continue the carried-in run.
+        initial_run_lengths = np.asarray(initial_run_lengths)
+        if meets_criteria.ndim == 2 and initial_run_lengths.ndim == 1:
+            initial_run_lengths = initial_run_lengths[:, np.newaxis]
+        run_lengths = run_lengths + np.where(
+            last_reset_positions == -1, initial_run_lengths, 0
+        )
+
+    return run_lengths
+
+
+def calculate_signed_streaks(meets_criteria, initial_streaks=None):
+    """Calculates, for each position along the last axis, the signed length of the streak of equal values ending there.
 
-    for i in range(window_size - 1, len(series_)):
-        # Start calculating the run of values that happened *within (and only within)* this window.
-        # TODO(lbrown): this is incredibly inefficient, but I can't think of a faster way while following the right
-        #  interpretation of the rules.
-        consecutive_positive_or_negative_values = calculate_consecutive_positive_or_negative_values(
-            series_=series_.iloc[i + 1 - window_size : i + 1],
-            positive_values=positive_values,
+    Streaks of `True` values are positive and streaks of `False` values negative, so the positive and negative streaks
+    of a boolean array are calculated together in a single vectorized pass. Works on boolean arrays with any number of
+    leading axes (e.g. criteria x states x dates). `initial_streaks` (a scalar, or one value per position along the
+    leading axes) carries in a signed streak that was already in progress before the first position, e.g. from a
+    previous run over earlier data; it continues the first streak if it has the same sign.
+    """
+    meets_criteria = np.asarray(meets_criteria, dtype=bool)
+    positions = np.arange(meets_criteria.shape[-1])
+
+    # Track the position at which the most recent streak started; the streak length is the distance from it.
+    is_streak_start = np.empty(shape=meets_criteria.shape, dtype=bool)
+    is_streak_start[..., 0] = True
+    np.not_equal(
+        meets_criteria[..., 1:], meets_criteria[..., :-1], out=is_streak_start[..., 1:]
+    )
+    streak_start_positions = is_streak_start * positions
+    np.maximum.accumulate(streak_start_positions, axis=-1, out=streak_start_positions)
+    streaks = positions + 1 - streak_start_positions
+
+    if initial_streaks is not None:
+        initial_streaks = np.asarray(initial_streaks)
+        if initial_streaks.ndim > 0:
+            initial_streaks = initial_streaks[..., np.newaxis]
+        continues_initial_streak = (streak_start_positions == 0) & np.where(
+            meets_criteria, initial_streaks > 0, initial_streaks < 0
+        )
+        streaks += np.where(
+            continues_initial_streak, np.abs(initial_streaks), 0
+        ).astype(streaks.dtype)
+
+    # Negate the streaks of `False` values in place, rather than allocating another array.
+    np.negative(streaks, out=streaks, where=~meets_criteria)
+    return streaks
+
+
+def calculate_range_max(values, start_positions, window_size):
+    """Calculates `max(values[..., start:end + 1])` for every end position along the last axis.
+
+    `start_positions` must have the same shape as `values`, with each range spanning at most `window_size`
+    positions. Empty ranges (where the start is after the end) return zero. Uses a sparse table, so each query is
+    answered in constant time after an O(n log(window_size)) build.
+    """
+    num_positions = values.shape[-1]
+    flat_values = values.reshape(-1, num_positions)
+    start_positions = start_positions.reshape(-1, num_positions)
+    end_positions = np.broadcast_to(np.arange(num_positions), flat_values.shape)
+
+    # Build the sparse table: `sparse_table[k][:, j]` is the max of `values[:, j:j + 2 ** k]`.
+    sparse_table = [flat_values]
+    while 2 ** len(sparse_table) <= window_size:
+        half_width = 2 ** (len(sparse_table) - 1)
+        previous_level = sparse_table[-1]
+        current_level = previous_level.copy()
+        current_level[:, :-half_width] = np.maximum(
+            previous_level[:, :-half_width], previous_level[:, half_width:]
         )
+        sparse_table.append(current_level)
+    sparse_table = np.stack(sparse_table)
+
+    # Answer each query with the max of two (possibly overlapping) power-of-two ranges.
+    range_lengths = end_positions - start_positions + 1
+    is_empty = range_lengths < 1
+    levels = np.floor(np.log2(np.maximum(range_lengths, 1))).astype(int)
+    left_positions = np.where(is_empty, 0, start_positions)
+    right_positions = np.where(is_empty, 0, end_positions - 2 ** levels + 1)
+    rows = np.arange(flat_values.shape[0])[:, np.newaxis]
+
+    range_max = np.maximum(
+        sparse_table[levels, rows, left_positions],
+        sparse_table[levels, rows, right_positions],
+    )
 
-        # Find the max run.
-        returned_series[i] = consecutive_positive_or_negative_values.max()
+    return np.where(is_empty, 0, range_max).reshape(values.shape)
 
-    return returned_series
+
+def calculate_max_run_in_window(series_, positive_values, window_size=14):
+    """Calculates the longest run of positive (or negative) values that happened *within (and only within)* the
+    trailing window ending at each position.
+
+    `series_` may be a `pd.Series` with a sorted index, or a 1-D or 2-D `np.ndarray` (e.g. states x dates, with each
+    state's values aligned to start in the first column). Null values never count towards a run. The first
+    `window_size - 1` positions of each series are null.
+    """
+    if isinstance(series_, pd.Series):
+        # Assert that the index is sorted.
+        if not series_.index.is_monotonic_increasing:
+            raise ValueError("Index is not sorted.")
+
+        return pd.Series(
+            index=series_.index,
+            data=calculate_max_run_in_window(
+                series_=series_.values.astype(float),
+                positive_values=positive_values,
+                window_size=window_size,
+            ),
+        )
+
+    values = np.atleast_2d(np.asarray(series_, dtype=float))
+    num_positions = values.shape[-1]
+
+    # There are no complete windows to calculate runs in.
+    if num_positions < window_size:
+        return np.full(np.shape(series_), np.nan)
+
+    # Note: comparisons with `nan` are always `False`, so null values break runs.
+    with np.errstate(invalid="ignore"):
+        meets_criteria = values > 0 if positive_values else values < 0
+
+    run_lengths = calculate_run_lengths(meets_criteria)
+
+    # For each window, find the first position at or after its start that does not meet the criteria. The run that
+    # is in progress at the start of the window is truncated to the window; all later runs fit inside it entirely.
+    positions = np.arange(num_positions)
+    next_reset_positions = np.minimum.accumulate(
+        np.where(meets_criteria, num_positions, positions)[..., ::-1], axis=-1
+    )[..., ::-1]
+
+    window_start_positions = np.broadcast_to(
+        np.maximum(positions - window_size + 1, 0), values.shape
+    )
+    first_reset_in_window_positions = np.take_along_axis(
+        next_reset_positions, window_start_positions, axis=-1
+    )
+
+    leading_run_lengths = (
+        np.minimum(first_reset_in_window_positions, positions + 1)
+        - window_start_positions
+    )
+    remaining_run_lengths = calculate_range_max(
+        values=run_lengths,
+        start_positions=first_reset_in_window_positions,
+        window_size=window_size,
+    )
+
+    max_runs = np.maximum(leading_run_lengths, remaining_run_lengths).astype(float)
+    max_runs[..., : window_size - 1] = np.nan
+
+    return max_runs.reshape(np.shape(series_))
 
 
 def generate_lag_column_name_formatter_and_column_names(column_name, num_lags=121):
@@ -118,80 +375,424 @@ def generate_lags(
     suffix_with_date=False,
     date_format="%Y-%m-%d",
 ):
-    # TODO(lbrown): Refactor this method to be more efficient; this is just the quick and dirty way.
+    return generate_lags_for_columns(
+        df=df,
+        lag_specifications=[(column, num_lags, suffix_with_date)],
+        lag_timedelta=lag_timedelta,
+        date_format=date_format,
+    )
+
+
+def generate_lags_for_columns(
+    df,
+    lag_specifications,
+    lag_timedelta=datetime.timedelta(days=1),
+    date_format="%Y-%m-%d",
+):
+    """Generates lag columns for several columns at once, with one row per state for the latest date in `df`.
+
+    Each lag specification is a tuple of `(column, num_lags, suffix_with_date)`. Each source column is pivoted into a
+    state x lag date matrix only once, even if it appears in several specifications.
+    """
     states = df[STATE_FIELD].unique()
+    dates = pd.to_datetime(df[DATE_SOURCE_FIELD])
+
+    # Calculate the latest date in the given data frame, and every date we'll need to look up from it.
+    latest_date = dates.max()
+    max_num_lags = max(num_lags for _, num_lags, _ in lag_specifications)
+    lag_dates = pd.DatetimeIndex(
+        [latest_date - lag * lag_timedelta for lag in range(max_num_lags)]
+    )
+
+    # Find the matrix position of every row that falls on one of the lag dates.
+    state_positions = pd.Index(states).get_indexer(df[STATE_FIELD])
+    lag_positions = lag_dates.get_indexer(dates)
+    is_in_lag_window = lag_positions >= 0
+    state_positions = state_positions[is_in_lag_window]
+    lag_positions = lag_positions[is_in_lag_window]
+
+    # Ensure only one value is present for each state and date.
+    if pd.Series(state_positions * max_num_lags + lag_positions).duplicated().any():
+        raise ValueError("Too many values returned.")
+
+    lag_matrices = {}
+    lag_columns = {}
+    for column, num_lags, suffix_with_date in lag_specifications:
+        if column not in lag_matrices:
+            values = df[column].values[is_in_lag_window]
+            lag_matrix = np.full(
+                shape=(len(states), max_num_lags),
+                fill_value=np.nan,
+                dtype=float
+                if pd.api.types.is_numeric_dtype(values)
+                and not pd.api.types.is_bool_dtype(values)
+                else object,
+            )
+            lag_matrix[state_positions, lag_positions] = values
+            lag_matrices[column] = lag_matrix
+
+        for lag in range(num_lags):
+            if suffix_with_date:
+                lag_column = f"{column}-{lag_dates[lag].strftime(date_format)}"
+            else:
+                lag_column = f"{column} T-{lag}"
+
+            lag_columns[lag_column] = lag_matrices[column][:, lag]
 
-    # Create an empty dataframe to populate with lags.
     lags_df = pd.DataFrame(
-        index=pd.Index(data=states, name=STATE_FIELD), columns=[DATE_SOURCE_FIELD]
+        data={STATE_FIELD: states, DATE_SOURCE_FIELD: latest_date, **lag_columns}
     )
 
-    # Calculate the latest date in the given data frame.
-    latest_date = pd.to_datetime(df[DATE_SOURCE_FIELD]).max()
-    lags_df[DATE_SOURCE_FIELD] = latest_date
+    return lags_df
 
-    for state in states:
-        # Start each state looking up the latest date we have.
-        current_date = latest_date
 
-        for current_lag in range(num_lags):
-            print(f"For field {column}, processing {state} for lag {current_lag}.")
+def join_lags(df, lags_df):
+    """Joins lags generated by `generate_lags_for_columns` to the rows of `df` with the same state and date.
 
-            # Lookup the historical entry.
-            value = df.loc[
-                (df[STATE_FIELD] == state)
-                & (pd.to_datetime(df[DATE_SOURCE_FIELD]) == current_date),
-                column,
-            ]
+    Lags are only filled in for one date, so unlike a merge, this adds them as sparse columns that only store the
+    values of the rows of that date, and doesn't copy `df` into a frame with a dense column for each lag. If most rows
+    are of that date (e.g. `df` only has the latest date), the lags are added as dense columns, which are then smaller.
+    """
+    row_positions = pd.MultiIndex.from_frame(
+        df[[STATE_FIELD, DATE_SOURCE_FIELD]]
+    ).get_indexer(pd.MultiIndex.from_frame(lags_df[[STATE_FIELD, DATE_SOURCE_FIELD]]))
+    is_joined = row_positions >= 0
+    row_positions = row_positions[is_joined]
 
-            # Ensure only one value is returned.
-            if len(value) > 1:
-                raise ValueError("Too many values returned.")
-            elif len(value) == 1:
-                value = value.iloc[0]
-            else:
-                value = None
+    lag_columns = {}
+    for column in lags_df.columns.drop([STATE_FIELD, DATE_SOURCE_FIELD]):
+        values = np.full(
+            shape=len(df), fill_value=np.nan, dtype=lags_df[column].values.dtype
+        )
+        values[row_positions] = lags_df[column].values[is_joined]
+        lag_columns[column] = (
+            pd.arrays.SparseArray(values, fill_value=np.nan)
+            if len(row_positions) < len(df) / 2
+            else values
+        )
 
-            if suffix_with_date:
-                current_lag_column = f"{column}-{current_date.strftime(date_format)}"
-            else:
-                current_lag_column = f"{column} T-{current_lag}"
+    return pd.concat([df, pd.DataFrame(data=lag_columns, index=df.index)], axis=1)
 
-            # Add the current lag column.
-            lags_df.loc[state, current_lag_column] = value
 
-            # Decrement the current date by the lag amount.
-            current_date = current_date - lag_timedelta
+def compact_dtypes(df, bool_fields=(), count_fields=(), float32_fields=()):
+    """Stores fields of `df` in place in compact dtypes, and returns `df`.
 
-    lags_df = lags_df.reset_index()
-    return lags_df
+    `bool_fields` are stored as `bool` and `count_fields` as `int16` (or `int32` if they don't fit), unless they have
+    missing values: booleans are then left as they are, and counts are stored as `float32`, which is exact for them.
+    `float32_fields` are stored as `float32`, which halves their memory at the cost of precision.
+    """
+    for field in bool_fields:
+        if not df[field].isna().any():
+            df[field] = df[field].astype(bool)
+
+    for field in count_fields:
+        if df[field].isna().any():
+            df[field] = df[field].astype(np.float32)
+        elif df[field].abs().max() <= np.iinfo(np.int16).max:
+            df[field] = df[field].astype(np.int16)
+        else:
+            df[field] = df[field].astype(np.int32)
 
+    for field in float32_fields:
+        df[field] = df[field].astype(np.float32)
 
-def calculate_state_summary(transformed_df, columns=None):
-    # Find current date, and drop all other rows.
-    current_date = transformed_df.loc[:, DATE_SOURCE_FIELD].max()
+    return df
 
-    state_summary_df = transformed_df.copy()
-    state_summary_df = state_summary_df.loc[
-        state_summary_df[DATE_SOURCE_FIELD] == current_date, :
+
+def calculate_state_summary(transformed_df, columns=None, latest_non_null=False):
+    """Summarizes the latest data of each state in `transformed_df`, with only `columns` if given.
+
+    By default, the summary is the rows of the latest date in `transformed_df`, so states without data on that date are
+    left out. With `latest_non_null`, each field of a state is instead its latest non-null value, for sources in which
+    states report on different days.
+
+    Only the data in the summary are copied, so several summaries of the same frame can be projected from a summary of
+    all of its columns, which is calculated once.
+    """
+    if columns is None:
+        columns = transformed_df.columns
+
+    if latest_non_null:
+        state_summary_df = (
+            transformed_df.groupby(
+                transformed_df[STATE_FIELD], sort=False, observed=True
+            )[[column for column in columns if column != STATE_FIELD]]
+            .last()
+            .reset_index()
+            .loc[:, columns]
+        )
+    else:
+        # Find current date, and drop all other rows.
+        current_date = transformed_df.loc[:, DATE_SOURCE_FIELD].max()
+        state_summary_df = transformed_df.loc[
+            transformed_df[DATE_SOURCE_FIELD] == current_date, columns
+        ]
+
+    # Store the counts that `compact_dtypes` stores as small integers as floats again, as they were calculated, so
+    #   that they are uploaded as before (e.g. "32.0" rather than "32").
+    count_columns = [
+        column
+        for column, dtype in state_summary_df.dtypes.items()
+        if dtype in (np.int16, np.int32)
     ]
+    if count_columns:
+        state_summary_df = state_summary_df.astype(
+            {column: float for column in count_columns}
+        )
 
-    if columns is not None:
-        state_summary_df = state_summary_df.loc[:, columns]
+    # Store sparse columns (such as lags, see `join_lags`) densely again, since the current date is where they're filled.
+    sparse_columns = [
+        column
+        for column, dtype in state_summary_df.dtypes.items()
+        if isinstance(dtype, pd.SparseDtype)
+    ]
+    if not sparse_columns:
+        return state_summary_df
 
-    return state_summary_df
+    return pd.concat(
+        [
+            state_summary_df.drop(columns=sparse_columns),
+            state_summary_df.loc[:, sparse_columns].sparse.to_dense(),
+        ],
+        axis=1,
+    ).loc[:, state_summary_df.columns]
 
 
 def calculate_consecutive_boolean_series(boolean_series):
     """Calculates the number of consecutive booleans (`True` / `False`) in the given boolean series."""
-    consecutive_true_series = calculate_consecutive_positive_or_negative_values(
-        series_=(boolean_series.astype(bool).replace({False: -1, True: 1})),
-        positive_values=True,
+    signed_streaks = calculate_signed_streaks(
+        meets_criteria=boolean_series.astype(bool).values
     )
 
-    consecutive_false_series = calculate_consecutive_positive_or_negative_values(
-        series_=(boolean_series.astype(bool).replace({False: -1, True: 1})),
-        positive_values=False,
+    consecutive_true_series = pd.Series(
+        data=np.maximum(signed_streaks, 0), index=boolean_series.index
+    )
+    consecutive_false_series = pd.Series(
+        data=np.maximum(-signed_streaks, 0), index=boolean_series.index
     )
 
     return consecutive_true_series, consecutive_false_series
+
+
+def apply_by_state(series_, func):
+    """Applies `func` to each state's date-indexed series within a series indexed by (state, date).
+
+    `func` must return a series (or array) of the same length as its input. The results are returned aligned to the
+    index of `series_`.
+    """
+    return series_.groupby(level=STATE_FIELD, sort=False, group_keys=False).apply(
+        lambda state_series: pd.Series(
+            data=np.asarray(func(state_series.droplevel(level=STATE_FIELD))),
+            index=state_series.index,
+        )
+    )
+
+
+def calculate_state_matrix_positions(index):
+    """Calculates where each row of an index of (state, date) goes in the matrix of `apply_to_state_matrix`.
+
+    Returns the row (state) and column (position within the state) of each row.
+    """
+    state_codes, _ = pd.factorize(index.get_level_values(STATE_FIELD))
+    positions = (
+        pd.Series(data=state_codes).groupby(state_codes, sort=False).cumcount().values
+    )
+    return state_codes, positions
+
+
+def apply_to_state_matrix(series_, func, fill_value=np.nan, matrix_positions=None):
+    """Applies an array kernel to all states at once, within a series indexed by (state, date) and sorted by it.
+
+    Each state's values are placed in its own row of a states x positions matrix, aligned to start in the first
+    column and padded at the end with `fill_value`. `func` receives the matrix and must return one of the same shape;
+    the results are returned aligned to the index of `series_`. When applying several kernels to series with the same
+    index, pass the `calculate_state_matrix_positions` of that index as `matrix_positions` to only calculate it once.
+
+    `series_` can also be a frame, whose columns are then laid out along a leading axis, in a columns x states x
+    positions matrix, so that a kernel along the last axis is applied to every column in one call.
+    """
+    if len(series_) == 0:
+        return series_.copy()
+
+    if matrix_positions is None:
+        matrix_positions = calculate_state_matrix_positions(index=series_.index)
+    state_codes, positions = matrix_positions
+
+    values = series_.values
+    matrix = np.full(
+        shape=(*values.shape[1:], state_codes.max() + 1, positions.max() + 1),
+        fill_value=fill_value,
+        dtype=np.result_type(values.dtype, np.asarray(fill_value).dtype),
+    )
+    if isinstance(series_, pd.DataFrame):
+        # Note: a frame stores each column contiguously, so its values are laid out (and returned) one column at a time.
+        matrix[:, state_codes, positions] = values.T
+        return pd.DataFrame(
+            data=func(matrix)[:, state_codes, positions].T,
+            index=series_.index,
+            columns=series_.columns,
+            copy=False,
+        )
+
+    matrix[state_codes, positions] = values
+
+    return pd.Series(data=func(matrix)[state_codes, positions], index=series_.index)
+
+
+def calculate_streaks_by_state(
+    meets_criteria_df, initial_streaks=None, matrix_positions=None
+):
+    """Calculates the positive and negative streaks of several criteria at once, within a frame indexed by (state, date)
+    and sorted by it, with a boolean column per criteria.
+
+    The positive streak of a criteria is the number of consecutive rows of its state meeting it, up to and including
+    each row, and the negative streak the number of consecutive rows not meeting it. `initial_streaks` optionally
+    carries in the signed streaks (see `calculate_signed_streaks`) of a previous run, as a states x criteria array.
+
+    Returns the positive and negative streaks, as frames like `meets_criteria_df`.
+    """
+    signed_streaks = apply_to_state_matrix(
+        series_=meets_criteria_df,
+        func=lambda matrix: calculate_signed_streaks(
+            meets_criteria=matrix,
+            initial_streaks=None if initial_streaks is None else initial_streaks.T,
+        ),
+        fill_value=False,
+        matrix_positions=matrix_positions,
+    )
+
+    negative_streaks = np.minimum(signed_streaks.values, 0)
+    np.negative(negative_streaks, out=negative_streaks)
+    return (
+        pd.DataFrame(
+            data=np.maximum(signed_streaks.values, 0),
+            index=signed_streaks.index,
+            columns=signed_streaks.columns,
+            copy=False,
+        ),
+        pd.DataFrame(
+            data=negative_streaks,
+            index=signed_streaks.index,
+            columns=signed_streaks.columns,
+            copy=False,
+        ),
+    )
+
+
+def apply_to_state_date_matrix(series_, func, freq="D"):
+    """Applies an array kernel to all states at once, within a series indexed by (state, date) and sorted by it.
+
+    Unlike `apply_to_state_matrix`, each state's values are placed in the column of their date, within a states x dates
+    matrix spanning every `freq` period from the first to the last date of `series_`, and missing dates are null. This
+    suits kernels over time windows (e.g. the last 14 days) rather than over a number of rows.
+    """
+    if len(series_) == 0:
+        return series_.copy()
+
+    state_codes, _ = pd.factorize(series_.index.get_level_values(STATE_FIELD))
+    dates = pd.DatetimeIndex(series_.index.get_level_values(DATE_SOURCE_FIELD))
+    date_positions = ((dates - dates.min()) // pd.Timedelta(1, unit=freq)).values
+
+    matrix = np.full(
+        shape=(state_codes.max() + 1, date_positions.max() + 1),
+        fill_value=np.nan,
+        dtype=np.result_type(series_.values.dtype, np.float64),
+    )
+    matrix[state_codes, date_positions] = series_.values
+
+    return pd.Series(
+        data=func(matrix)[state_codes, date_positions], index=series_.index
+    )
+
+
+def calculate_rolling_aggregation(matrix, window, aggregation):
+    """Calculates a trailing rolling aggregation (e.g. `"mean"` or `"max"`) along the rows of a 2-D matrix.
+
+    Each window needs at least one non-null value, as with `min_periods=1`.
+    """
+    return getattr(
+        pd.DataFrame(matrix.T).rolling(window=window, min_periods=1), aggregation
+    )().values.T
+
+
+def fit_and_predict_cubic_spline_by_state(
+    series_, smoothing_parameter=None, replace_nan=True, backend=SPLINE_BACKEND_R
+):
+    """Fits a smoothing spline to each state's series, within a series indexed by (state, date).
+
+    With the native backend, states are pivoted into a states x dates matrix and all states that share the same dates
+    are fit together.
+    """
+    if backend != SPLINE_BACKEND_NATIVE:
+        return apply_by_state(
+            series_=series_,
+            func=lambda state_series: fit_and_predict_cubic_spline_in_r(
+                series_=state_series,
+                smoothing_parameter=smoothing_parameter,
+                replace_nan=replace_nan,
+                backend=backend,
+            ),
+        )
+
+    if replace_nan:
+        series_ = series_.fillna(value=0)
+
+    # Dates a state has no entry for are missing from the matrix, rather than zero.
+    matrix = series_.unstack(level=DATE_SOURCE_FIELD).sort_index(axis=1)
+    predicted_spline_df = fit_and_predict_smoothing_spline_batch(
+        matrix=matrix,
+        index=matrix.columns,
+        smoothing_parameter=smoothing_parameter,
+        replace_nan=False,
+    )
+
+    return predicted_spline_df.stack().reindex(series_.index)
+
+
+def apply_to_state_partitions(df, func, max_workers=None):
+    """Applies `func` to each state's partition of a frame indexed by (state, date), and concatenates the results.
+
+    `func` must accept and return a frame indexed by (state, date), and must be picklable (e.g. a module-level function
+    or a `functools.partial` of one) so it can be shipped to worker processes.
+
+    With `max_workers` set to `None`, `func` is applied to the whole frame at once in this process, which is the
+    fastest option for functions that are already vectorized across states and the easiest one to debug. Otherwise,
+    each state's partition is processed by a pool of `max_workers` worker processes; each worker imports its own copy
+    of the spline backend (and so runs its own R session). If the pool cannot be started, the partitions are
+    processed serially instead.
+
+    The results are always returned in the state order of `df`.
+    """
+    if max_workers is None:
+        return func(df)
+
+    partitions = [
+        partition_df for _, partition_df in df.groupby(level=STATE_FIELD, sort=False)
+    ]
+
+    # Time each state's partition, returning the spans recorded in worker processes along with the results.
+    func_in_span = functools.partial(
+        call_and_collect_spans, functools.partial(_apply_in_state_span, func)
+    )
+    executor = start_process_executor(max_workers=max_workers)
+    if executor is None:
+        logger.warning("Processing states serially.")
+        results_and_spans = [func_in_span(partition_df) for partition_df in partitions]
+    else:
+        with executor:
+            # Note: `map` yields results in the order of the partitions, regardless of which finishes first.
+            results_and_spans = list(executor.map(func_in_span, partitions))
+
+    results = []
+    for result, spans in results_and_spans:
+        results.append(result)
+        record_spans(spans)
+
+    return pd.concat(results, axis=0)
+
+
+def _apply_in_state_span(func, partition_df):
+    state = partition_df.index.get_level_values(STATE_FIELD)[0]
+    with span(getattr(func, "func", func).__name__, state=state) as span_:
+        span_.record_dataframe(partition_df, prefix="input_")
+        return func(partition_df)
@@ -6,17 +6,35 @@ import pandas as pd
 from pandas.testing import assert_frame_equal
 from pandas.testing import assert_series_equal
 
+from covid.smoothing_spline import calculate_equivalent_smoothing_parameter
+from covid.smoothing_spline import calculate_inverse_bands
+from covid.smoothing_spline import factor_smoothing_spline
+from covid.smoothing_spline import fit_smoothing_spline
+from covid.smoothing_spline import prepare_smoothing_spline
+from covid.transform_utils import apply_to_state_date_matrix
+from covid.transform_utils import apply_to_state_matrix
 from covid.transform_utils import calculate_consecutive_boolean_series
 from covid.transform_utils import calculate_consecutive_positive_or_negative_values
 from covid.transform_utils import calculate_max_run_in_window
+from covid.transform_utils import calculate_rolling_aggregation
+from covid.transform_utils import calculate_run_lengths
+from covid.transform_utils import calculate_signed_streaks
+from covid.transform_utils import calculate_state_summary
+from covid.transform_utils import calculate_streaks_by_state
+from covid.transform_utils import compact_dtypes
 from covid.transform_utils import fit_and_predict_cubic_spline
 from covid.transform_utils import fit_and_predict_cubic_spline_in_r
+from covid.transform_utils import fit_and_predict_smoothing_spline_batch
 from covid.transform_utils import generate_lags
+from covid.transform_utils import generate_lags_for_columns
+from covid.transform_utils import join_lags
+from covid.transform_utils import SPLINE_BACKEND_NATIVE
 
 
 class TransformUtilsTest(unittest.TestCase):
     def test_generate_lags(self):
-        # Test that by default, we suffix the lag column names with the lag amount.
+        # Test that by default, we suffix the lag column names with the lag amount. Missing lags of numeric columns are
+        # `nan`, rather than `None`.
         assert_frame_equal(
             generate_lags(
                 df=pd.DataFrame(
@@ -34,7 +52,7 @@ class TransformUtilsTest(unittest.TestCase):
             ),
             pd.DataFrame(
                 index=[0],
-                data=[("Alaska", datetime.datetime(2020, 1, 3), 3.0, 2.0, 1.0, None)],
+                data=[("Alaska", datetime.datetime(2020, 1, 3), 3.0, 2.0, 1.0, np.nan)],
                 columns=[
                     "State",
                     "date",
@@ -66,7 +84,7 @@ class TransformUtilsTest(unittest.TestCase):
             ),
             pd.DataFrame(
                 index=[0],
-                data=[("Alaska", datetime.datetime(2020, 1, 3), 3.0, 2.0, 1.0, None)],
+                data=[("Alaska", datetime.datetime(2020, 1, 3), 3.0, 2.0, 1.0, np.nan)],
                 columns=[
                     "State",
                     "date",
@@ -79,6 +97,76 @@ class TransformUtilsTest(unittest.TestCase):
             check_dtype=False,
         )
 
+    def test_generate_lags_for_columns(self):
+        # Test that several lag sets are generated at once, including two that share a source column.
+        assert_frame_equal(
+            generate_lags_for_columns(
+                df=pd.DataFrame(
+                    index=[0, 1, 2, 3],
+                    data=[
+                        ("2020-01-01", "Alaska", 1.0, 10.0),
+                        ("2020-01-08", "Alaska", 2.0, 20.0),
+                        ("2020-01-08", "Texas", 3.0, 30.0),
+                        ("2020-01-15", "Alaska", 4.0, 40.0),
+                    ],
+                    columns=["date", "State", "value", "other_value"],
+                ),
+                lag_specifications=[
+                    ("value", 2, False),
+                    ("value", 3, True),
+                    ("other_value", 1, False),
+                ],
+                lag_timedelta=datetime.timedelta(days=7),
+            ),
+            pd.DataFrame(
+                index=[0, 1],
+                data=[
+                    (
+                        "Alaska",
+                        datetime.datetime(2020, 1, 15),
+                        4.0,
+                        2.0,
+                        4.0,
+                        2.0,
+                        1.0,
+                        40.0,
+                    ),
+                    (
+                        "Texas",
+                        datetime.datetime(2020, 1, 15),
+                        None,
+                        3.0,
+                        None,
+                        3.0,
+                        None,
+                        None,
+                    ),
+                ],
+                columns=[
+                    "State",
+                    "date",
+                    "value T-0",
+                    "value T-1",
+                    "value-2020-01-15",
+                    "value-2020-01-08",
+                    "value-2020-01-01",
+                    "other_value T-0",
+                ],
+            ),
+            check_dtype=False,
+        )
+
+        # Test that duplicate entries for a state and date raise an error.
+        with self.assertRaises(ValueError):
+            generate_lags_for_columns(
+                df=pd.DataFrame(
+                    index=[0, 1],
+                    data=[("2020-01-01", "Alaska", 1.0), ("2020-01-01", "Alaska", 2.0)],
+                    columns=["date", "State", "value"],
+                ),
+                lag_specifications=[("value", 2, False)],
+            )
+
     def test_find_consecutive_positive_or_negative_values(self):
         assert_series_equal(
             calculate_consecutive_positive_or_negative_values(
@@ -323,6 +411,176 @@ class TransformUtilsTest(unittest.TestCase):
                 )
             )
 
+    def test_fit_and_predict_cubic_spline_in_r_native_backend(self):
+        # The native backend should reproduce the same fits as R, using the fixtures from the R test above.
+        index = pd.DatetimeIndex(
+            data=[
+                pd.to_datetime("2020-01-01"),
+                pd.to_datetime("2020-01-02"),
+                pd.to_datetime("2020-01-03"),
+                pd.to_datetime("2020-01-04"),
+                pd.to_datetime("2020-01-05"),
+                pd.to_datetime("2020-01-06"),
+            ],
+            freq=datetime.timedelta(days=1),
+        )
+
+        # Test with default smoothing parameter.
+        assert_series_equal(
+            fit_and_predict_cubic_spline_in_r(
+                pd.Series(data=[-1, 1, 2, -4, 3, 5], index=index),
+                backend=SPLINE_BACKEND_NATIVE,
+            ),
+            pd.Series(
+                data=[
+                    -1.1428568397306358,
+                    -0.2857142936746852,
+                    0.5714282888471683,
+                    1.4285710563026406,
+                    2.285714184172537,
+                    3.1428575140383694,
+                ],
+                index=index,
+            ),
+        )
+
+        # Test with null values.
+        assert_series_equal(
+            fit_and_predict_cubic_spline_in_r(
+                pd.Series(data=[np.nan, np.nan, 2, -4, 3, 5], index=index),
+                replace_nan=True,
+                backend=SPLINE_BACKEND_NATIVE,
+            ),
+            pd.Series(
+                data=[
+                    -0.6854102994488032,
+                    -0.21069773360008473,
+                    0.33578816306613873,
+                    1.067404321401707,
+                    2.12766929964248,
+                    3.365246248938551,
+                ],
+                index=index,
+            ),
+        )
+
+        # Test with explicit smoothing parameter.
+        assert_series_equal(
+            fit_and_predict_cubic_spline_in_r(
+                series_=pd.Series(data=[-1, 1, 2, -4, 3, 5], index=index),
+                smoothing_parameter=0.5,
+                backend=SPLINE_BACKEND_NATIVE,
+            ),
+            pd.Series(
+                data=[
+                    -0.5415075617582621,
+                    -0.1765863921621331,
+                    0.07061496437277474,
+                    0.5778703926676914,
+                    2.0462976989861517,
+                    4.023310897893784,
+                ],
+                index=index,
+            ),
+        )
+
+        # Should raise errors due to the index out of order.
+        with self.assertRaises(ValueError):
+            fit_and_predict_cubic_spline_in_r(
+                pd.Series(data=[-1, 1, 2, -4, 3, 5], index=index[::-1]),
+                backend=SPLINE_BACKEND_NATIVE,
+            )
+
+    def test_fit_and_predict_smoothing_spline_batch(self):
+        index = pd.date_range(start="2020-01-01", periods=8, freq="D")
+        matrix = pd.DataFrame(
+            data=[
+                [-1, 1, 2, -4, 3, 5, 4, 8],
+                [np.nan, np.nan, 2, -4, 3, 5, 1, 1],
+                [0, 0, 0, 1, 2, 3, 4, 5],
+            ],
+            index=["Alaska", "Texas", "Utah"],
+            columns=index,
+        )
+
+        # Every row should match fitting that series on its own.
+        for smoothing_parameter in [None, 0.5]:
+            batch_df = fit_and_predict_smoothing_spline_batch(
+                matrix=matrix, index=index, smoothing_parameter=smoothing_parameter
+            )
+
+            for state in matrix.index:
+                assert_series_equal(
+                    batch_df.loc[state],
+                    fit_and_predict_cubic_spline_in_r(
+                        series_=matrix.loc[state],
+                        smoothing_parameter=smoothing_parameter,
+                        backend=SPLINE_BACKEND_NATIVE,
+                    ),
+                    check_names=False,
+                )
+
+        # Without replacing nulls, rows are only fit on the dates they have values for.
+        batch_df = fit_and_predict_smoothing_spline_batch(
+            matrix=matrix, index=index, smoothing_parameter=0.5, replace_nan=False
+        )
+        assert_series_equal(
+            batch_df.loc["Texas"].iloc[2:],
+            fit_and_predict_cubic_spline_in_r(
+                series_=matrix.loc["Texas"].iloc[2:],
+                smoothing_parameter=0.5,
+                backend=SPLINE_BACKEND_NATIVE,
+            ),
+            check_names=False,
+        )
+        self.assertTrue(batch_df.loc["Texas"].iloc[:2].isnull().all())
+
+    def test_calculate_equivalent_smoothing_parameter(self):
+        x = np.arange(200.0)
+        y = np.cumsum(300 + 200 * np.sin(x / 15))
+        fitted_values = fit_smoothing_spline(x=x, y=y, smoothing_parameter=0.5)
+
+        # A fit over the last 90 values, with the same penalty as the full fit, closely follows it near its end.
+        smoothing_parameter = calculate_equivalent_smoothing_parameter(
+            x=x[-90:], reference_x=x, smoothing_parameter=0.5
+        )
+        self.assertGreater(smoothing_parameter, 0.5)
+        np.testing.assert_allclose(
+            fit_smoothing_spline(
+                x=x[-90:], y=y[-90:], smoothing_parameter=smoothing_parameter
+            )[-30:],
+            fitted_values[-30:],
+            rtol=1e-5,
+        )
+        self.assertEqual(
+            calculate_equivalent_smoothing_parameter(
+                x=x, reference_x=x, smoothing_parameter=0.5
+            ),
+            0.5,
+        )
+
+    def test_calculate_inverse_bands(self):
+        design = prepare_smoothing_spline(x=np.arange(60))
+        cholesky_factor = factor_smoothing_spline(
+            design=design, smoothing_parameter=0.5
+        )
+
+        # Rebuild the banded system to invert it outright, and compare the bands of its inverse.
+        upper_factor = np.zeros(
+            shape=(design.num_coefficients, design.num_coefficients)
+        )
+        for offset in range(cholesky_factor.shape[0]):
+            upper_factor += np.diag(cholesky_factor[-1 - offset, offset:], k=offset)
+        inverse = np.linalg.inv(upper_factor.T @ upper_factor)
+
+        inverse_bands = calculate_inverse_bands(cholesky_factor=cholesky_factor)
+        for offset in range(cholesky_factor.shape[0]):
+            np.testing.assert_allclose(
+                inverse_bands[offset, : design.num_coefficients - offset],
+                np.diagonal(inverse, offset=offset),
+                rtol=1e-8,
+            )
+
     def test_get_max_run_in_window(self):
         # A very simple series.
         assert_series_equal(
@@ -584,6 +842,71 @@ class TransformUtilsTest(unittest.TestCase):
             ),
         )
 
+    def test_get_max_run_in_window_for_multiple_series(self):
+        # Each row is processed independently, matching the results for the equivalent series.
+        np.testing.assert_array_equal(
+            calculate_max_run_in_window(
+                positive_values=True,
+                window_size=3,
+                series_=np.array(
+                    [
+                        [1, 2, 3, -1, 1, 2, -1, -1, -3],
+                        [np.nan, 1, 2, -4, np.nan, 5, 6, 7, 8],
+                    ]
+                ),
+            ),
+            np.array(
+                [
+                    [np.nan, np.nan, 3.0, 2.0, 1.0, 2.0, 2.0, 1.0, 0.0],
+                    [np.nan, np.nan, 2.0, 2.0, 1.0, 1.0, 2.0, 3.0, 3.0],
+                ]
+            ),
+        )
+
+        # Series shorter than the window have no complete windows.
+        np.testing.assert_array_equal(
+            calculate_max_run_in_window(
+                positive_values=False, window_size=14, series_=np.array([-1, -2, -3])
+            ),
+            np.array([np.nan, np.nan, np.nan]),
+        )
+
+    def test_calculate_run_lengths(self):
+        meets_criteria = np.array(
+            [[True, True, False, True], [False, True, True, True]]
+        )
+
+        np.testing.assert_array_equal(
+            calculate_run_lengths(meets_criteria=meets_criteria),
+            np.array([[1, 2, 0, 1], [0, 1, 2, 3]]),
+        )
+
+        # Runs in progress at the first position continue from the carried-in lengths.
+        np.testing.assert_array_equal(
+            calculate_run_lengths(
+                meets_criteria=meets_criteria, initial_run_lengths=np.array([5, 7])
+            ),
+            np.array([[6, 7, 0, 1], [0, 1, 2, 3]]),
+        )
+
+    def test_calculate_signed_streaks(self):
+        meets_criteria = np.array(
+            [[True, True, False, True], [False, False, True, True]]
+        )
+
+        np.testing.assert_array_equal(
+            calculate_signed_streaks(meets_criteria=meets_criteria),
+            np.array([[1, 2, -1, 1], [-1, -2, 1, 2]]),
+        )
+
+        # Streaks in progress at the first position only continue from carried-in streaks of the same sign.
+        np.testing.assert_array_equal(
+            calculate_signed_streaks(
+                meets_criteria=meets_criteria, initial_streaks=np.array([5, 3])
+            ),
+            np.array([[6, 7, -1, 1], [-1, -2, 1, 2]]),
+        )
+
     def test_calculate_consecutive_boolean_series(self):
         (
             consecutive_true_series,
@@ -643,3 +966,176 @@ class TransformUtilsTest(unittest.TestCase):
                 ),
             ),
         )
+
+    def test_apply_to_state_matrix(self):
+        series_ = pd.Series(
+            data=[1.0, -1.0, 2.0, 3.0, 4.0],
+            index=pd.MultiIndex.from_tuples(
+                tuples=[
+                    ("Alaska", pd.to_datetime("2020-01-01")),
+                    ("Alaska", pd.to_datetime("2020-01-02")),
+                    ("Alaska", pd.to_datetime("2020-01-03")),
+                    ("Wyoming", pd.to_datetime("2020-01-02")),
+                    ("Wyoming", pd.to_datetime("2020-01-03")),
+                ],
+                names=["State", "date"],
+            ),
+        )
+
+        # Each state is laid out in its own row, so the cumulative sum never crosses states.
+        assert_series_equal(
+            apply_to_state_matrix(
+                series_=series_, func=lambda matrix: np.cumsum(matrix, axis=1)
+            ),
+            pd.Series(data=[1.0, 0.0, 2.0, 3.0, 7.0], index=series_.index),
+        )
+
+    def test_calculate_streaks_by_state(self):
+        meets_criteria_df = pd.DataFrame(
+            data={"a": [True, True, False, False, True], "b": [False] * 5},
+            index=pd.MultiIndex.from_tuples(
+                tuples=[
+                    ("Alaska", pd.to_datetime("2020-01-01")),
+                    ("Alaska", pd.to_datetime("2020-01-02")),
+                    ("Alaska", pd.to_datetime("2020-01-03")),
+                    ("Wyoming", pd.to_datetime("2020-01-02")),
+                    ("Wyoming", pd.to_datetime("2020-01-03")),
+                ],
+                names=["State", "date"],
+            ),
+        )
+
+        # Every criteria is calculated at once, and Wyoming's streaks continue those carried in for it.
+        positive_streaks, negative_streaks = calculate_streaks_by_state(
+            meets_criteria_df=meets_criteria_df,
+            initial_streaks=np.array([[0, 0], [-2, 4]]),
+        )
+        assert_frame_equal(
+            positive_streaks,
+            pd.DataFrame(
+                data={"a": [1, 2, 0, 0, 1], "b": [0] * 5},
+                index=meets_criteria_df.index,
+            ),
+        )
+        assert_frame_equal(
+            negative_streaks,
+            pd.DataFrame(
+                data={"a": [0, 0, 1, 3, 0], "b": [1, 2, 3, 1, 2]},
+                index=meets_criteria_df.index,
+            ),
+        )
+
+    def test_apply_to_state_date_matrix(self):
+        series_ = pd.Series(
+            data=[1.0, 5.0, 2.0, 1.0, 3.0, 2.0],
+            index=pd.MultiIndex.from_tuples(
+                tuples=[
+                    ("Alaska", pd.to_datetime("2020-01-01")),
+                    ("Alaska", pd.to_datetime("2020-01-02")),
+                    ("Alaska", pd.to_datetime("2020-01-03")),
+                    ("Alaska", pd.to_datetime("2020-01-06")),
+                    ("Wyoming", pd.to_datetime("2020-01-02")),
+                    ("Wyoming", pd.to_datetime("2020-01-03")),
+                ],
+                names=["State", "date"],
+            ),
+        )
+
+        # Windows cover days rather than rows, so Alaska's 5 drops out of the window by its last date despite the gap.
+        assert_series_equal(
+            apply_to_state_date_matrix(
+                series_=series_,
+                func=lambda matrix: calculate_rolling_aggregation(
+                    matrix=matrix, window=3, aggregation="max"
+                ),
+            ),
+            pd.Series(data=[1.0, 5.0, 5.0, 1.0, 3.0, 3.0], index=series_.index),
+        )
+
+    def test_join_lags(self):
+        df = pd.DataFrame(
+            data={
+                "State": ["Alaska"] * 3 + ["Wyoming"] * 3,
+                "date": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-03"] * 2),
+                "value": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+            }
+        )
+        joined_df = join_lags(
+            df=df, lags_df=generate_lags(df=df, column="value", num_lags=2)
+        )
+
+        # The lags are sparse, and only filled in for the latest date, as with a left merge.
+        self.assertIsInstance(joined_df["value T-0"].dtype, pd.SparseDtype)
+        lag_columns = ["value T-0", "value T-1"]
+        assert_frame_equal(
+            joined_df.assign(**joined_df[lag_columns].sparse.to_dense()),
+            df.assign(
+                **{
+                    "value T-0": [np.nan, np.nan, 3.0, np.nan, np.nan, 6.0],
+                    "value T-1": [np.nan, np.nan, 2.0, np.nan, np.nan, 5.0],
+                }
+            ),
+        )
+
+    def test_compact_dtypes(self):
+        df = compact_dtypes(
+            df=pd.DataFrame(
+                data={
+                    "criteria": pd.Series([True, False], dtype=object),
+                    "streak": [3.0, 40000.0],
+                    "max_run": [np.nan, 2.0],
+                    "spline": [0.5, 1.5],
+                }
+            ),
+            bool_fields=["criteria"],
+            count_fields=["streak", "max_run"],
+            float32_fields=["spline"],
+        )
+
+        self.assertEqual(df.dtypes.tolist(), [bool, np.int32, np.float32, np.float32])
+        self.assertEqual(df["streak"].tolist(), [3, 40000])
+
+    def test_calculate_state_summary(self):
+        transformed_df = pd.DataFrame(
+            data={
+                "State": ["Alaska", "Alaska", "Wyoming"],
+                "date": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-01"]),
+                "value": [1.0, np.nan, 3.0],
+                "lag": pd.arrays.SparseArray([np.nan, 2.0, np.nan]),
+                "streak": np.array([1, 2, 3], dtype=np.int16),
+            }
+        )
+
+        # By default, only states with data on the latest date are summarized, sparse columns are made dense and
+        # compacted counts are floats again.
+        assert_frame_equal(
+            calculate_state_summary(
+                transformed_df=transformed_df,
+                columns=["State", "value", "lag", "streak"],
+            ),
+            pd.DataFrame(
+                index=[1],
+                data={
+                    "State": ["Alaska"],
+                    "value": [np.nan],
+                    "lag": [2.0],
+                    "streak": [2.0],
+                },
+            ),
+        )
+
+        # Test that `latest_non_null` summarizes each state with the latest non-null value of each field.
+        assert_frame_equal(
+            calculate_state_summary(
+                transformed_df=transformed_df,
+                columns=["State", "date", "value"],
+                latest_non_null=True,
+            ),
+            pd.DataFrame(
+                data={
+                    "State": ["Alaska", "Wyoming"],
+                    "date": pd.to_datetime(["2020-01-02", "2020-01-01"]),
+                    "value": [1.0, 3.0],
+                }
+            ),
+        )
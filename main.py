@@ -1,16 +1,29 @@
 # Define source field names.
+import collections
 import functools
+import json
+import logging
 import os
 
 import pandas as pd
+import requests
 
 from covid.constants import PATH_TO_SERVICE_ACCOUNT_KEY
+from covid.extract import CDC_ILI_SOURCE
+from covid.extract import COVIDTRACKING_HISTORICAL_SOURCE
 from covid.extract import DATE_SOURCE_FIELD
 from covid.extract import extract_cdc_ili_data
 from covid.extract import extract_covidtracking_historical_data
-from covid.load import get_sheets_client
-from covid.load import post_dataframe_to_google_sheets
-from covid.load_utils import sleep_and_log
+from covid.extract_utils import calculate_dataframe_fingerprint
+from covid.instrumentation import finish_run
+from covid.instrumentation import span
+from covid.instrumentation import start_run
+from covid.load import GoogleSheetsSink
+from covid.pipeline import Node
+from covid.pipeline import NODE_KIND_PROCESS
+from covid.pipeline import NODE_KIND_THREAD
+from covid.pipeline import run_pipeline
+from covid.pipeline import select_nodes
 from covid.transform import CRITERIA_1_SUMMARY_COLUMNS
 from covid.transform import CRITERIA_2_SUMMARY_COLUMNS
 from covid.transform import CRITERIA_5_SUMMARY_COLUMNS
@@ -23,6 +36,8 @@ from covid.transform import transform_cdc_ili_data
 from covid.transform import transform_covidtracking_data
 from covid.transform_utils import calculate_state_summary
 
+logger = logging.getLogger(__name__)
+
 # Define the names of the tabs to upload to.
 FOR_WEBSITE_TAB_NAME = "For Website"
 ALL_STATE_DATA_TAB_NAME = "All State Data"
@@ -43,24 +58,117 @@ POLICY_VS_TREND_CHARTS_DATA_WORKBOOK_KEY = (
     "1gRexnz4AJAIYJ6c5fQXR6ps2EDs7JPHu-CU7-5qE3EI"
 )
 
+# Define each workbook that is loaded: the pipeline node calculating each of its tabs, the sources that these are
+# calculated from (so that workbooks whose sources didn't change can be skipped) and the tabs uploaded in append mode.
+Workbook = collections.namedtuple(
+    "Workbook",
+    [
+        "name",
+        "key",
+        "node_names_by_tab_name",
+        "sources",
+        "append_date_fields_by_tab_name",
+    ],
+    defaults=(None,),
+)
+WORKBOOKS = [
+    Workbook(
+        name="criteria_1",
+        key=CDC_CRITERIA_1_GOOGLE_WORKBOOK_KEY,
+        node_names_by_tab_name={STATE_SUMMARY_TAB_NAME: "criteria_1_summary"},
+        sources=[COVIDTRACKING_HISTORICAL_SOURCE],
+    ),
+    Workbook(
+        name="criteria_2",
+        key=CDC_CRITERIA_2_GOOGLE_WORKBOOK_KEY,
+        node_names_by_tab_name={STATE_SUMMARY_TAB_NAME: "criteria_2_summary"},
+        sources=[COVIDTRACKING_HISTORICAL_SOURCE],
+    ),
+    # Write the all data and state summary tabs of Criteria 5 together.
+    Workbook(
+        name="criteria_5",
+        key=CDC_CRITERIA_5_GOOGLE_WORKBOOK_KEY,
+        node_names_by_tab_name={
+            ALL_STATE_DATA_TAB_NAME: "transform_cdc_ili",
+            STATE_SUMMARY_TAB_NAME: "criteria_5_summary",
+        },
+        sources=[CDC_ILI_SOURCE],
+    ),
+    Workbook(
+        name="criteria_6",
+        key=CDC_CRITERIA_6_GOOGLE_WORKBOOK_KEY,
+        node_names_by_tab_name={STATE_SUMMARY_TAB_NAME: "criteria_6_summary"},
+        sources=[COVIDTRACKING_HISTORICAL_SOURCE],
+    ),
+    Workbook(
+        name="combined_summary",
+        key=CDC_CRITERIA_SUMMARY_GOOGLE_WORKBOOK_KEY,
+        node_names_by_tab_name={STATE_SUMMARY_TAB_NAME: "combined_summary"},
+        sources=[COVIDTRACKING_HISTORICAL_SOURCE, CDC_ILI_SOURCE],
+    ),
+    Workbook(
+        name="policy_vs_trend_summary",
+        key=POLICY_VS_TREND_CHARTS_DATA_WORKBOOK_KEY,
+        node_names_by_tab_name={STATE_SUMMARY_TAB_NAME: "policy_vs_trend_summary"},
+        sources=[COVIDTRACKING_HISTORICAL_SOURCE],
+    ),
+]
+
 
 # Note: if you'd like to run the full pipeline, you'll need to generate a service account keyfile for an account
 # that has been given write access to the Google Sheet.
-def extract_transform_and_load_covid_data(post_to_google_sheets=True):
+def extract_transform_and_load_covid_data(
+    post_to_google_sheets=True,
+    max_workers=None,
+    incremental_state_path=None,
+    cache_directory=None,
+    snapshot_directory=None,
+    sink=None,
+    fingerprint_path=None,
+    force=False,
+    metrics_directory=None,
+    use_worker_processes=False,
+):
     """Runs the entire pipeline to produce data for Covid Exit Strategy data sources.
 
     Workbooks are found in: https://drive.google.com/drive/u/1/folders/15j1iyyJtJ8BmK3y-HO6cLp-7R7nAoSml.
 
+    Each extract, transform, summary and load step is a node of a pipeline (see `covid.pipeline`), so that independent
+    steps run concurrently; a timing report of the steps is logged at the end.
+
     Args:
         post_to_google_sheets (bool): whether or not to attempt to post to google sheets; set to False for faster
             debugging of data processing
+        max_workers (int): number of worker processes used to transform states in parallel; `None` transforms all
+            states of each source at once
+        incremental_state_path (str): where to keep the calculated covidtracking criteria between runs, so that each
+            run only recomputes the trailing rows of the states with new or revised data; `None` recomputes everything
+        cache_directory (str): where to cache raw extracts, which are then only downloaded again when the source has
+            changed; `None` always downloads them
+        snapshot_directory (str): where to keep snapshots of what was uploaded to each tab, so that later uploads only
+            send the cells that changed; `None` always rewrites every cell
+        sink (covid.load.Sink): where to write each workbook (e.g. local Parquet files); `None` posts to Google Sheets
+            if `post_to_google_sheets` is set
+        fingerprint_path (str): where to keep a fingerprint of the sources that each workbook was last loaded from, so
+            that workbooks whose sources didn't change since are neither transformed nor loaded again; `None` always
+            runs everything
+        force (bool): whether to run everything, even if sources didn't change
+        metrics_directory (str): where to write a JSON file of metrics for the run: the duration, peak memory (traced
+            with `tracemalloc`, which slows the run down) and output shape of each stage; `None` writes no metrics
+        use_worker_processes (bool): whether to run each source's transform in a worker process of its own, when
+            `max_workers` is `None`; worker processes are forked after threads (and the HTTP session) have started,
+            which can deadlock, so transforms run in threads of this process by default
 
     """
-    print("Starting to ETL...")
-
-    client, credentials = get_sheets_client(
-        credential_file_path=os.path.abspath(PATH_TO_SERVICE_ACCOUNT_KEY)
-    )
+    logger.info("Starting to ETL...")
+    run_start_time = start_run(trace_memory=metrics_directory is not None)
+
+    if sink is None and post_to_google_sheets:
+        # Credentials are only loaded once the first workbook is uploaded.
+        sink = GoogleSheetsSink(
+            credential_file_path=os.path.abspath(PATH_TO_SERVICE_ACCOUNT_KEY),
+            snapshot_directory=snapshot_directory,
+        )
 
     # TODO(lbrown): Un-comment these when we find a path forward for CDC bed data.
     # cdc_beds_current_df = extract_cdc_beds_current_data()
@@ -91,135 +199,221 @@ def extract_transform_and_load_covid_data(post_to_google_sheets=True):
     #     credentials=credentials,
     # )
 
-    covidtracking_df = extract_covidtracking_historical_data()
-    cdc_ili_df = extract_cdc_ili_data()
-
-    transformed_cdc_ili_df = transform_cdc_ili_data(ili_df=cdc_ili_df)
-
-    transformed_covidtracking_df = transform_covidtracking_data(
-        covidtracking_df=covidtracking_df
-    )
-
-    # Upload Criteria 1 workbook for all states.
-    criteria_1_summary_df = calculate_state_summary(
-        transformed_df=transformed_covidtracking_df, columns=CRITERIA_1_SUMMARY_COLUMNS
+    # Transforms that don't already spread states across worker processes only run in a worker process of their own
+    #   when asked to.
+    transform_kind = (
+        NODE_KIND_PROCESS
+        if use_worker_processes and max_workers is None
+        else NODE_KIND_THREAD
     )
 
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=criteria_1_summary_df,
-            workbook_key=CDC_CRITERIA_1_GOOGLE_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
-        )
-
-        sleep_and_log()
-
-    # Upload Criteria 2 workbook for all states.
-    criteria_2_summary_df = calculate_state_summary(
-        transformed_df=transformed_covidtracking_df, columns=CRITERIA_2_SUMMARY_COLUMNS
+    # Share one session between the extracts.
+    session = requests.Session()
+
+    # Extract all sources first, so that workbooks whose sources didn't change can be skipped.
+    extracted_dfs, _ = run_pipeline(
+        nodes=[
+            Node(
+                name=COVIDTRACKING_HISTORICAL_SOURCE,
+                func=functools.partial(
+                    extract_covidtracking_historical_data,
+                    cache_directory=cache_directory,
+                    session=session,
+                ),
+            ),
+            Node(
+                name=CDC_ILI_SOURCE,
+                func=functools.partial(
+                    extract_cdc_ili_data,
+                    cache_directory=cache_directory,
+                    session=session,
+                ),
+            ),
+        ]
     )
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=criteria_2_summary_df,
-            workbook_key=CDC_CRITERIA_2_GOOGLE_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
-        )
-
-        sleep_and_log()
-
-    # Upload Criteria 5 workbook
-    # Upload all data tab for Criteria 5.
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=transformed_cdc_ili_df,
-            workbook_key=CDC_CRITERIA_5_GOOGLE_WORKBOOK_KEY,
-            tab_name=ALL_STATE_DATA_TAB_NAME,
-            credentials=credentials,
+    with span("calculate_fingerprints"):
+        fingerprints_by_source = {
+            source: calculate_dataframe_fingerprint(df)
+            for source, df in extracted_dfs.items()
+        }
+
+    fingerprints_by_workbook_name = {}
+    if fingerprint_path is not None and os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as file:
+            fingerprints_by_workbook_name = json.load(file)
+
+    workbooks = [
+        workbook
+        for workbook in WORKBOOKS
+        if force
+        or fingerprint_path is None
+        or fingerprints_by_workbook_name.get(workbook.name)
+        != {source: fingerprints_by_source[source] for source in workbook.sources}
+    ]
+    for workbook in WORKBOOKS:
+        if workbook not in workbooks:
+            logger.info(
+                f"Skipping workbook {workbook.name}, whose sources didn't change."
+            )
+
+    nodes = [
+        Node(
+            name="transform_covidtracking",
+            func=functools.partial(
+                transform_covidtracking_data,
+                max_workers=max_workers,
+                incremental_state_path=incremental_state_path,
+            ),
+            inputs={"covidtracking_df": COVIDTRACKING_HISTORICAL_SOURCE},
+            kind=transform_kind,
+        ),
+        Node(
+            name="transform_cdc_ili",
+            func=functools.partial(transform_cdc_ili_data, max_workers=max_workers),
+            inputs={"ili_df": CDC_ILI_SOURCE},
+            kind=transform_kind,
+        ),
+        # Summarize the latest covidtracking data once, and project each of its summaries from that.
+        Node(
+            name="covidtracking_summary",
+            func=calculate_state_summary,
+            inputs={"transformed_df": "transform_covidtracking"},
+        ),
+        Node(
+            name="criteria_1_summary",
+            func=functools.partial(
+                calculate_state_summary, columns=CRITERIA_1_SUMMARY_COLUMNS
+            ),
+            inputs={"transformed_df": "covidtracking_summary"},
+        ),
+        Node(
+            name="criteria_2_summary",
+            func=functools.partial(
+                calculate_state_summary, columns=CRITERIA_2_SUMMARY_COLUMNS
+            ),
+            inputs={"transformed_df": "covidtracking_summary"},
+        ),
+        Node(
+            name="criteria_5_summary",
+            func=functools.partial(
+                calculate_state_summary, columns=CRITERIA_5_SUMMARY_COLUMNS
+            ),
+            inputs={"transformed_df": "transform_cdc_ili"},
+        ),
+        Node(
+            name="criteria_6_summary",
+            func=functools.partial(
+                calculate_state_summary, columns=CRITERIA_6_SUMMARY_COLUMNS
+            ),
+            inputs={"transformed_df": "covidtracking_summary"},
+        ),
+        Node(
+            name="combined_summary",
+            func=calculate_combined_summary,
+            inputs={
+                "covidtracking_summary_df": "covidtracking_summary",
+                "criteria_5_summary_df": "criteria_5_summary",
+            },
+        ),
+        Node(
+            name="policy_vs_trend_summary",
+            func=calculate_policy_vs_trend_summary,
+            inputs={"covidtracking_summary_df": "covidtracking_summary"},
+        ),
+    ]
+
+    if sink is not None:
+        load_nodes = [
+            Node(
+                name=f"load_{workbook.name}",
+                func=functools.partial(
+                    write_workbook,
+                    sink=sink,
+                    workbook_key=workbook.key,
+                    append_date_fields_by_tab_name=workbook.append_date_fields_by_tab_name,
+                ),
+                inputs=workbook.node_names_by_tab_name,
+            )
+            for workbook in workbooks
+        ]
+        # Only run the nodes that the workbooks to load depend on.
+        nodes = select_nodes(
+            nodes=nodes + load_nodes, names=[node.name for node in load_nodes]
         )
 
-        sleep_and_log()
-
-    # Upload state summary tab for Criteria 5.
-    criteria_5_summary_df = calculate_state_summary(
-        transformed_df=transformed_cdc_ili_df, columns=CRITERIA_5_SUMMARY_COLUMNS
-    )
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=criteria_5_summary_df,
-            workbook_key=CDC_CRITERIA_5_GOOGLE_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
-        )
+    run_pipeline(nodes=nodes, available_results=extracted_dfs)
 
-        sleep_and_log()
+    # Record the sources that each workbook was loaded from.
+    if sink is not None and fingerprint_path is not None:
+        for workbook in workbooks:
+            fingerprints_by_workbook_name[workbook.name] = {
+                source: fingerprints_by_source[source] for source in workbook.sources
+            }
+        with open(fingerprint_path, "w") as file:
+            json.dump(fingerprints_by_workbook_name, file, indent=2, sort_keys=True)
 
-    # Upload state summary tab for Criteria 6.
-    criteria_6_summary_df = calculate_state_summary(
-        transformed_df=transformed_covidtracking_df, columns=CRITERIA_6_SUMMARY_COLUMNS
-    )
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=criteria_6_summary_df,
-            workbook_key=CDC_CRITERIA_6_GOOGLE_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
+    if metrics_directory is not None:
+        metrics_path = finish_run(
+            start_time=run_start_time, metrics_directory=metrics_directory
         )
-
-        sleep_and_log()
-
-    # Merge all the summary data frames so that we can create a single summary sheet.
-    combined_df = functools.reduce(
-        # Use an inner join so that you'll only get entities that are represented in all criteria.
-        # E.g., you'll not include Guam, NYC, etc which are reported separately in some of the sources.
-        lambda left, right: pd.merge(
-            left, right, on=[STATE_FIELD], how="inner", suffixes=["", "_y"]
-        ),
-        [
-            criteria_1_summary_df,
-            criteria_2_summary_df,
-            # TODO(lbrown): Un-comment this when we find a path forward for CDC bed data.
-            # criteria_3_summary_df,
-            criteria_5_summary_df,
-            criteria_6_summary_df,
-        ],
+        logger.info(f"Wrote the metrics of the run to {metrics_path}.")
+
+
+def calculate_combined_summary(covidtracking_summary_df, criteria_5_summary_df):
+    """Combines the criteria of the covidtracking summary (Criteria 1, 2 and 6) and of the Criteria 5 summary."""
+    covidtracking_columns = [
+        column
+        for column in CRITERIA_COMBINED_SUMMARY_COLUMNS
+        if column in covidtracking_summary_df.columns
+    ]
+    # TODO(lbrown): Add the Criteria 3 summary when we find a path forward for CDC bed data.
+    criteria_5_columns = [
+        column
+        for column in CRITERIA_COMBINED_SUMMARY_COLUMNS
+        if column not in covidtracking_columns
+    ]
+
+    # Use an inner join so that you'll only get entities that are represented in all criteria.
+    # E.g., you'll not include Guam, NYC, etc which are reported separately in some of the sources.
+    combined_df = pd.merge(
+        covidtracking_summary_df.loc[:, covidtracking_columns],
+        criteria_5_summary_df.loc[:, [STATE_FIELD, *criteria_5_columns]],
+        on=[STATE_FIELD],
+        how="inner",
     )
+    return combined_df.loc[:, CRITERIA_COMBINED_SUMMARY_COLUMNS]
 
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=combined_df.loc[:, CRITERIA_COMBINED_SUMMARY_COLUMNS],
-            workbook_key=CDC_CRITERIA_SUMMARY_GOOGLE_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
-        )
-
-        sleep_and_log()
 
-    # Calculate and upload state summary tab for Policy vs. Trend Charts.
-    policy_vs_trend_df = pd.concat(
+def calculate_policy_vs_trend_summary(covidtracking_summary_df):
+    # Calculate the state summary for Policy vs. Trend Charts.
+    return pd.concat(
         [
-            transformed_covidtracking_df.loc[
+            covidtracking_summary_df.loc[
                 :, [LAST_RAN_FIELD, LAST_UPDATED_FIELD, STATE_FIELD, DATE_SOURCE_FIELD]
             ],
-            transformed_covidtracking_df.filter(regex="pvt-*").rename(
+            covidtracking_summary_df.filter(regex="pvt-*").rename(
                 lambda column: column.replace("pvt-", ""), axis="columns"
             ),
         ],
         axis=1,
     )
-    policy_vs_trend_summary_df = calculate_state_summary(
-        transformed_df=policy_vs_trend_df
+
+
+def write_workbook(
+    sink, workbook_key, append_date_fields_by_tab_name=None, **dfs_by_tab_name
+):
+    """Writes the dataframes passed as keyword arguments, by tab name, to a workbook of `sink`."""
+    sink.write(
+        workbook_key=workbook_key,
+        dfs_by_tab_name=dfs_by_tab_name,
+        append_date_fields_by_tab_name=append_date_fields_by_tab_name,
     )
-    if post_to_google_sheets:
-        post_dataframe_to_google_sheets(
-            df=policy_vs_trend_summary_df,
-            workbook_key=POLICY_VS_TREND_CHARTS_DATA_WORKBOOK_KEY,
-            tab_name=STATE_SUMMARY_TAB_NAME,
-            credentials=credentials,
-        )
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
     # Note: for faster debugging during development, you can set `post_to_google_sheets` to `False`.
     extract_transform_and_load_covid_data(post_to_google_sheets=True)
@@ -18,5 +18,5 @@ setup(
     license="GNU GPLv3",
     install_requires=install_requires,
     include_package_data=True,
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
 )